@@ -0,0 +1,214 @@
+import os
+import re
+import sys
+import json
+import hashlib
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+# --- 配置 ---
+STATISTICS_FILE = 'statistics.json'  # 供 Statistics 页面读取的预计算结果
+STATE_FILE = 'statistics_state.json'  # 增量更新所需的每条记录分箱状态
+TOP_ORGANISMS = 10  # 输出的高频目标生物数量
+# 数值直方图：名称 -> 分箱边界（左闭右开，超出范围的值计入首/末箱）
+HISTOGRAMS = {
+    'length': list(range(0, 110, 10)),
+    'net_charge': list(range(-10, 12, 2)),
+    'total': [x / 2 for x in range(0, 21)],
+    'efficacy': [x / 2 for x in range(0, 11)],
+    'toxicity': [x / 2 for x in range(0, 11)],
+    'stability': [x / 2 for x in range(0, 11)],
+    'synthesis': [x / 2 for x in range(0, 11)],
+}
+# 目标生物类别：关键字（小写） -> 规范化类别名
+ORGANISM_CLASSES = [
+    ('gram-positive', 'Gram-positive bacteria'),
+    ('gram-negative', 'Gram-negative bacteria'),
+    ('fung', 'Fungi'),
+    ('yeast', 'Fungi'),
+    ('vir', 'Virus'),
+    ('parasit', 'Parasite'),
+    ('protozo', 'Parasite'),
+    ('bacteri', 'Other bacteria'),
+]
+# 规范化类别 -> 活性类别（对应 Statistics 页面的类别饼图）
+ACTIVITY_BY_CLASS = {
+    'Gram-positive bacteria': 'Antibacterial',
+    'Gram-negative bacteria': 'Antibacterial',
+    'Other bacteria': 'Antibacterial',
+    'Fungi': 'Antifungal',
+    'Virus': 'Antiviral',
+    'Parasite': 'Antiparasitic',
+}
+MULTIPLE_ACTIVITIES = 'Multiple Activities'
+# ---
+
+def normalize_organism_class(name: str) -> Optional[str]:
+    """将 target_organisms 的分组名（如 '[Ref.123] Gram-positive bacterium'）规范化，备注类分组返回 None。"""
+    name = re.sub(r'^\[Ref\.[^\]]*\]\s*', '', str(name)).strip().lower()
+    if not name or name.startswith('note') or name.startswith('only '):
+        return None
+    for keyword, label in ORGANISM_CLASSES:
+        if keyword in name:
+            return label
+    return 'Other'
+
+def _to_float(value: Any) -> float:
+    try:
+        return float(value) if value is not None else np.nan
+    except (TypeError, ValueError):
+        return np.nan
+
+def _record_id(record: Dict[str, Any]) -> str:
+    return str(record.get('DRAMP ID') or record.get('id') or record.get('Sequence') or record.get('sequence') or '')
+
+def _record_hash(record: Dict[str, Any]) -> str:
+    return hashlib.blake2b(json.dumps(record, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'),
+                           digest_size=8).hexdigest()
+
+def _record_categories(record: Dict[str, Any]) -> Dict[str, List[str]]:
+    """提取一条记录的分类特征：目标生物类别、活性类别与目标生物名称。"""
+    target_organisms = record.get('target_organisms') or {}
+    classes = sorted({label for label in map(normalize_organism_class, target_organisms) if label})
+    activities = sorted({ACTIVITY_BY_CLASS[label] for label in classes if label in ACTIVITY_BY_CLASS})
+    if len(activities) > 1:
+        activities = [MULTIPLE_ACTIVITIES]
+    names = sorted({item.get('name', '').strip()
+                    for group, items in target_organisms.items() if normalize_organism_class(group)
+                    for item in (items or []) if isinstance(item, dict) and item.get('name')})
+    return {'organism_class': classes, 'activity_category': activities, 'organism': names}
+
+def _bin_records(records: List[Dict[str, Any]]) -> np.ndarray:
+    """
+    一次性对所有记录做数值分箱，返回 [记录数, 直方图数] 的箱号矩阵，缺失值为 -1。
+
+    支持 score_peptide 的结果（含 scores/weighted_scores/APD3）与 generate_index 的索引条目（含 length）。
+    """
+    columns = {
+        'length': [_to_float(r.get('length', len(r.get('Sequence') or r.get('sequence') or '') or np.nan))
+                   for r in records],
+        'net_charge': [_to_float((r.get('APD3') or {}).get('net_charge')) for r in records],
+        'total': [_to_float(r.get('total')) if 'total' in r else np.nan for r in records],
+    }
+    for category in ('efficacy', 'toxicity', 'stability', 'synthesis'):
+        columns[category] = [_to_float((r.get('weighted_scores') or {}).get(category)) for r in records]
+
+    bins = np.full((len(records), len(HISTOGRAMS)), -1, dtype=np.int64)
+    for col, (name, edges) in enumerate(HISTOGRAMS.items()):
+        values = np.asarray(columns[name], dtype=np.float64)
+        edges = np.asarray(edges, dtype=np.float64)
+        idx = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+        bins[:, col] = np.where(np.isnan(values), -1, idx)
+    return bins
+
+def _empty_aggregates() -> Dict[str, Any]:
+    return {
+        'count': 0,
+        'histograms': {name: [0] * (len(edges) - 1) for name, edges in HISTOGRAMS.items()},
+        'categories': {'organism_class': {}, 'activity_category': {}, 'organism': {}},
+    }
+
+def _apply(aggregates: Dict[str, Any], bins: np.ndarray, categories: List[Dict[str, List[str]]], sign: int):
+    """将一批记录的分箱与分类计数（sign=+1 加入，-1 移除）累加到聚合结果中。"""
+    aggregates['count'] += sign * len(categories)
+    for col, name in enumerate(HISTOGRAMS):
+        column = bins[:, col]
+        counts = np.bincount(column[column >= 0], minlength=len(HISTOGRAMS[name]) - 1)
+        aggregates['histograms'][name] = (np.asarray(aggregates['histograms'][name]) + sign * counts).tolist()
+    for key, table in aggregates['categories'].items():
+        delta = Counter(label for record in categories for label in record[key])
+        for label, count in delta.items():
+            table[label] = table.get(label, 0) + sign * count
+            if table[label] <= 0:
+                del table[label]
+
+def update_statistics(records: Iterable[Dict[str, Any]], state_path: str = STATE_FILE,
+                      output_path: str = STATISTICS_FILE) -> Dict[str, Any]:
+    """
+    根据当前全部记录更新预计算统计结果。
+
+    只对新增或内容变化的记录重新分箱，并从聚合结果中扣除已删除或变化记录的旧贡献，
+    因此只有少量记录变化时无需重新统计整个语料库。
+
+    Args:
+        records: score_peptide 的结果列表（如 all_scores.json）或 generate_index 的索引条目
+        state_path: 增量状态文件路径，不存在时执行全量统计
+        output_path: 输出给前端的统计 JSON
+
+    Returns:
+        写出的统计结果
+    """
+    state = {'records': {}, 'aggregates': _empty_aggregates()}
+    if os.path.exists(state_path):
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                loaded = json.load(f)
+            if loaded.get('histograms') == HISTOGRAMS:
+                state = loaded
+            else:
+                print("统计分箱配置已变化，执行全量统计")
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"读取统计状态 {state_path} 出错，执行全量统计: {str(e)}")
+
+    current = {}
+    for record in records:
+        record_id = _record_id(record)
+        if record_id:
+            current[record_id] = record
+
+    previous = state['records']
+    hashes = {rid: _record_hash(record) for rid, record in current.items()}
+    removed = [rid for rid, entry in previous.items() if hashes.get(rid) != entry['hash']]
+    removed_set = set(removed)
+    changed = [rid for rid in current if rid not in previous or rid in removed_set]
+
+    aggregates = state['aggregates']
+    if removed:
+        old_bins = np.asarray([previous[rid]['bins'] for rid in removed], dtype=np.int64)
+        _apply(aggregates, old_bins, [previous[rid]['categories'] for rid in removed], -1)
+        for rid in removed:
+            del previous[rid]
+    if changed:
+        new_records = [current[rid] for rid in changed]
+        new_bins = _bin_records(new_records)
+        new_categories = [_record_categories(record) for record in new_records]
+        _apply(aggregates, new_bins, new_categories, +1)
+        for rid, row, categories in zip(changed, new_bins.tolist(), new_categories):
+            previous[rid] = {'hash': hashes[rid], 'bins': row, 'categories': categories}
+
+    state['histograms'] = HISTOGRAMS
+    with open(state_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, separators=(',', ':'))
+
+    organisms = aggregates['categories']['organism']
+    statistics = {
+        'count': aggregates['count'],
+        'histograms': {name: {'edges': HISTOGRAMS[name], 'counts': counts}
+                       for name, counts in aggregates['histograms'].items()},
+        'organism_class': aggregates['categories']['organism_class'],
+        'activity_category': aggregates['categories']['activity_category'],
+        'top_organisms': dict(sorted(organisms.items(), key=lambda item: (-item[1], item[0]))[:TOP_ORGANISMS]),
+    }
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(statistics, f, ensure_ascii=False, separators=(',', ':'))
+    print(f"统计结果已更新: {output_path}（{len(changed)} 条新增/变化，{len(removed)} 条移除/变化）")
+    return statistics
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="预计算 Statistics 页面使用的全库统计数据")
+    parser.add_argument("input", help="all_scores.json 或 peptide_index.json")
+    parser.add_argument("--output", help="统计结果输出路径", default=STATISTICS_FILE)
+    parser.add_argument("--state", help="增量状态文件路径", default=STATE_FILE)
+    args = parser.parse_args()
+
+    try:
+        with open(args.input, 'r', encoding='utf-8') as f:
+            input_records = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"错误：读取 '{args.input}' 失败: {e}", file=sys.stderr)
+        sys.exit(1)
+    update_statistics(input_records, args.state, args.output)
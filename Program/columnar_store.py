@@ -0,0 +1,136 @@
+import os
+import shutil
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# --- 配置 ---
+COLUMNAR_DIR = 'all_scores_parquet'  # 列式数据集输出目录名
+PARTITION_COLUMN = 'score_band'  # 分区列：总分向下取整，便于按总分筛选时跳过整个分区
+COMPRESSION = 'zstd'
+# 各列的固定顺序；缺失值写为 null
+SUB_SCORE_COLUMNS = ['mic', 'synergy_bonus', 'hemolysis', 'cytotoxicity', 'boman_score',
+                     'protease', 'ph_thermal', 'half_life', 'length', 'rare_aa', 'disulfide']
+CATEGORY_COLUMNS = ['efficacy', 'toxicity', 'stability', 'synthesis']
+APD3_COLUMNS = ['apd_id', 'length', 'net_charge', 'hydrophobic_ratio', 'molecular_weight',
+                'gravy_value', 'boman_index', 'disulfide_bonds']
+# ---
+
+def _to_float(value: Any) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def flatten_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    将 score_peptide 的嵌套结果展平为一行。
+
+    子评分列以 'score_' 为前缀，类别加权得分以 'weighted_' 为前缀，
+    APD3 物化性质以 'apd3_' 为前缀，避免与子评分中的 'length' 等同名。
+    """
+    scores = result.get('scores') or {}
+    weighted = result.get('weighted_scores') or {}
+    apd3 = result.get('APD3') or {}
+    total = _to_float(result.get('total')) or 0.0
+
+    row = {
+        'dramp_id': str(result.get('DRAMP ID') or ''),
+        'sequence': str(result.get('Sequence') or ''),
+    }
+    for name in SUB_SCORE_COLUMNS:
+        row[f'score_{name}'] = _to_float(scores.get(name))
+    for name in CATEGORY_COLUMNS:
+        row[f'weighted_{name}'] = _to_float(weighted.get(name))
+    row['total'] = total
+    for name in APD3_COLUMNS:
+        value = apd3.get(name)
+        row[f'apd3_{name}'] = (str(value) if value else None) if name == 'apd_id' else _to_float(value)
+    row[PARTITION_COLUMN] = int(total)
+    return row
+
+def _schema():
+    fields = [pa.field('dramp_id', pa.string()), pa.field('sequence', pa.string())]
+    fields += [pa.field(f'score_{name}', pa.float32()) for name in SUB_SCORE_COLUMNS]
+    fields += [pa.field(f'weighted_{name}', pa.float32()) for name in CATEGORY_COLUMNS]
+    fields.append(pa.field('total', pa.float32()))
+    fields += [pa.field(f'apd3_{name}', pa.string() if name == 'apd_id' else pa.float32())
+               for name in APD3_COLUMNS]
+    fields.append(pa.field(PARTITION_COLUMN, pa.int8()))
+    return pa.schema(fields)
+
+def write_columnar_results(results: Iterable[Dict[str, Any]], output_dir: str) -> bool:
+    """
+    将评分结果写为按 score_band 分区、zstd 压缩的 Parquet 数据集（每个肽一行）。
+
+    Args:
+        results: score_peptide 返回的结果列表
+        output_dir: 数据集目录，已存在时会被整体替换
+
+    Returns:
+        是否写入成功（未安装 pyarrow 时返回 False）
+    """
+    if pa is None:
+        print("警告: 未安装 pyarrow，跳过列式数据集的生成（pip install pyarrow）")
+        return False
+
+    rows = [flatten_result(result) for result in results]
+    schema = _schema()
+    table = pa.Table.from_pylist(rows, schema=schema)
+
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    pq.write_to_dataset(
+        table,
+        root_path=output_dir,
+        partition_cols=[PARTITION_COLUMN],
+        compression=COMPRESSION,
+    )
+    print(f"已写入列式数据集: {output_dir}（{len(rows)} 行）")
+    return True
+
+def query_top(dataset_dir: str, sort_column: str, limit: int = 100,
+              filters: Sequence[Tuple[str, str, Any]] = (), columns: Sequence[str] = ('dramp_id',),
+              descending: bool = True):
+    """
+    按列查询评分数据集，只读取排序、过滤与返回所需的列。
+
+    例如“按效力取前 100 且溶血评分 ≥ 7”：
+        query_top(dir, 'weighted_efficacy', 100, [('score_hemolysis', '>=', 7)])
+
+    Args:
+        dataset_dir: write_columnar_results 写出的目录
+        sort_column: 排序列
+        limit: 返回行数
+        filters: (列名, 运算符, 值) 三元组，运算符支持 ==, !=, >, >=, <, <=
+        columns: 需要返回的其他列
+        descending: 是否降序
+
+    Returns:
+        pyarrow.Table
+    """
+    if pa is None:
+        raise ImportError("查询列式数据集需要安装 pyarrow")
+
+    operators = {
+        '==': pc.equal, '!=': pc.not_equal, '>': pc.greater,
+        '>=': pc.greater_equal, '<': pc.less, '<=': pc.less_equal,
+    }
+    expression = None
+    for column, op, value in filters:
+        if op not in operators:
+            raise ValueError(f"不支持的运算符: {op}")
+        condition = operators[op](ds.field(column), value)
+        expression = condition if expression is None else expression & condition
+
+    dataset = ds.dataset(dataset_dir, format='parquet', partitioning='hive')
+    wanted: List[str] = list(dict.fromkeys(list(columns) + [sort_column]))
+    table = dataset.to_table(columns=wanted, filter=expression)
+    order = 'descending' if descending else 'ascending'
+    return table.sort_by([(sort_column, order)]).slice(0, limit)
@@ -0,0 +1,17 @@
+from typing import Any, Optional
+
+def find_value_in_dict(data: Any, target_key: str) -> Optional[Any]:
+    """Recursively search for a key in a nested dictionary or list."""
+    if isinstance(data, dict):
+        if target_key in data:
+            return data[target_key]
+        for key, value in data.items():
+            found = find_value_in_dict(value, target_key)
+            if found is not None:
+                return found
+    elif isinstance(data, list):
+        for item in data:
+            found = find_value_in_dict(item, target_key)
+            if found is not None:
+                return found
+    return None
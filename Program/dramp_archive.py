@@ -0,0 +1,173 @@
+import os
+import re
+import sys
+import json
+import mmap
+import zlib
+import struct
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from dict_utils import find_value_in_dict
+
+# --- 配置 ---
+ARCHIVE_FILE = 'database.pack'  # 默认的打包数据库文件名
+MAGIC = b'DRPK'
+FORMAT_VERSION = 1
+# 文件头：魔数、版本、ID 数字宽度、记录数、偏移表位置、最大 ID 编号、ID 前缀
+HEADER = struct.Struct('<4sHHQQQ16s')
+# 偏移表项：记录偏移、压缩后长度（长度为 0 表示该编号不存在）
+ENTRY = struct.Struct('<QI')
+# ---
+
+def _split_id(dramp_id: str) -> Tuple[str, Optional[int], int]:
+    """将 'DRAMP00001' 拆分为 ('DRAMP', 1, 5)；无法解析时编号为 None。"""
+    match = re.fullmatch(r'([A-Za-z_]*)(\d+)', str(dramp_id).strip())
+    if not match:
+        return str(dramp_id), None, 0
+    return match.group(1), int(match.group(2)), len(match.group(2))
+
+def pack_database(db_dir: str, archive_path: str = ARCHIVE_FILE) -> int:
+    """
+    将数据库目录中的 DRAMPxxxxx.json 打包为单个归档文件。
+
+    每条记录以 zlib 压缩的 JSON 保存，文件末尾是按 ID 编号直接寻址的偏移表，
+    因此读取时无需解析任何索引即可 O(1) 定位记录。
+
+    Returns:
+        打包的记录数
+    """
+    records: Dict[int, bytes] = {}
+    prefix = None
+    id_width = 0
+    skipped = 0
+    for filename in sorted(os.listdir(db_dir)):
+        if not filename.lower().endswith('.json'):
+            continue
+        file_path = os.path.join(db_dir, filename)
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"错误：读取文件 '{file_path}' 失败: {e}", file=sys.stderr)
+            skipped += 1
+            continue
+
+        dramp_id = find_value_in_dict(data, 'DRAMP ID') or os.path.splitext(filename)[0]
+        id_prefix, number, width = _split_id(dramp_id)
+        if number is None or (prefix is not None and id_prefix != prefix):
+            print(f"警告：文件 '{filename}' 的 ID '{dramp_id}' 无法按编号寻址，已跳过。", file=sys.stderr)
+            skipped += 1
+            continue
+        if number in records:
+            print(f"警告：文件 '{filename}' 的 ID '{dramp_id}' 与已打包的记录重复，已跳过。", file=sys.stderr)
+            skipped += 1
+            continue
+        prefix = id_prefix
+        id_width = max(id_width, width)
+        records[number] = zlib.compress(
+            json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 9)
+
+    max_number = max(records) if records else 0
+    tmp_path = archive_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(b'\0' * HEADER.size)
+        table = bytearray(ENTRY.size * (max_number + 1))
+        for number in sorted(records):
+            ENTRY.pack_into(table, number * ENTRY.size, f.tell(), len(records[number]))
+            f.write(records[number])
+        table_offset = f.tell()
+        f.write(table)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, id_width, len(records), table_offset, max_number,
+                            (prefix or '').encode('ascii')))
+    os.replace(tmp_path, archive_path)
+    print(f"已打包 {len(records)} 条记录到 {archive_path}，跳过 {skipped} 个文件。")
+    return len(records)
+
+class DrampArchive:
+    """
+    通过 mmap 只读访问 pack_database 生成的归档文件。
+
+    用法：
+        with DrampArchive('database.pack') as archive:
+            data = archive.get('DRAMP00001')
+            for dramp_id, data in archive.items(): ...
+    """
+
+    def __init__(self, archive_path: str = ARCHIVE_FILE):
+        self.archive_path = archive_path
+        self._file = open(archive_path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._id_width, self.count, self._table_offset, self._max_number, prefix = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"'{archive_path}' 不是有效的 DRAMP 归档文件")
+        if version != FORMAT_VERSION:
+            self.close()
+            raise ValueError(f"不支持的归档版本: {version}")
+        self.prefix = prefix.rstrip(b'\0').decode('ascii')
+
+    def _entry(self, number: int) -> Tuple[int, int]:
+        if number < 0 or number > self._max_number:
+            return 0, 0
+        return ENTRY.unpack_from(self._mm, self._table_offset + number * ENTRY.size)
+
+    def get_raw(self, dramp_id: str) -> Optional[bytes]:
+        """返回记录的 JSON 字节（已解压），不存在时返回 None。"""
+        prefix, number, _ = _split_id(dramp_id)
+        if number is None or prefix.upper() != self.prefix.upper():
+            return None
+        offset, length = self._entry(number)
+        if length == 0:
+            return None
+        return zlib.decompress(self._mm[offset:offset + length])
+
+    def get(self, dramp_id: str) -> Optional[Dict[str, Any]]:
+        """按 DRAMP ID 读取一条记录，不存在时返回 None。"""
+        raw = self.get_raw(dramp_id)
+        return json.loads(raw) if raw is not None else None
+
+    def __contains__(self, dramp_id: str) -> bool:
+        prefix, number, _ = _split_id(dramp_id)
+        return (number is not None and prefix.upper() == self.prefix.upper()
+                and self._entry(number)[1] > 0)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def ids(self) -> Iterator[str]:
+        """按编号升序遍历归档中的全部 ID。"""
+        for number in range(self._max_number + 1):
+            if self._entry(number)[1] > 0:
+                yield f"{self.prefix}{number:0{self._id_width}d}"
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        for dramp_id in self.ids():
+            yield dramp_id, self.get(dramp_id)
+
+    def close(self):
+        if getattr(self, '_mm', None) is not None:
+            self._mm.close()
+            self._mm = None
+        if getattr(self, '_file', None) is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="将 DRAMP 数据库目录打包为单个归档文件")
+    parser.add_argument("--input", help="数据库目录", default="database")
+    parser.add_argument("--output", help="归档文件路径", default=ARCHIVE_FILE)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.input):
+        print(f"错误：数据库目录 '{args.input}' 未找到。", file=sys.stderr)
+        sys.exit(1)
+    pack_database(args.input, args.output)
@@ -1,102 +1,233 @@
 import os
+import re
+import gzip
 import json
 import sys
-from typing import Any, Optional
-
-# --- 辅助函数 ---
-def find_value_in_dict(data: Any, target_key: str) -> Optional[Any]:
-    """Recursively search for a key in a nested dictionary or list."""
-    if isinstance(data, dict):
-        if target_key in data:
-            return data[target_key]
-        for key, value in data.items():
-            found = find_value_in_dict(value, target_key)
-            if found is not None:
-                return found
-    elif isinstance(data, list):
-        for item in data:
-            found = find_value_in_dict(item, target_key)
-            if found is not None:
-                return found
-    return None
+from typing import Any, Dict, List, Optional
+
+try:
+    import brotli  # 可选依赖，用于生成 .br 预压缩文件
+except ImportError:
+    brotli = None
+
+from dict_utils import find_value_in_dict
+from dramp_archive import DrampArchive, ARCHIVE_FILE
+from trigram_index import TrigramIndex, INDEX_FILE as TRIGRAM_INDEX_FILE, WEB_INDEX_FILE as TRIGRAM_WEB_FILE
 
 # --- 配置 ---
 DATABASE_DIR = 'database'  # 相对于脚本位置的数据库目录名
+DATABASE_ARCHIVE = ARCHIVE_FILE  # 打包后的数据库归档（存在时优先于数据库目录读取）
 OUTPUT_FILE = 'peptide_index.json'  # 输出的索引文件名
+SHARD_DIR = 'peptide_index_shards'  # 分片索引输出目录（包含 manifest.json 与各分片）
+MANIFEST_FILE = 'manifest.json'  # 分片索引清单文件名
+ID_RANGE_SIZE = 5000  # 每个分片覆盖的 DRAMP ID 数字区间大小
+LENGTH_BUCKETS = (0, 10, 20, 30, 40, 50, 75, 100, 200)  # 序列长度分桶下界，最后一个桶无上界
+SHARD_FIELDS = ['id', 'name', 'sequence', 'length', 'doc']  # 分片中每条记录的字段顺序（doc 为全局排序下标）
 # ---
 
+def _id_number(dramp_id: str) -> Optional[int]:
+    """提取 DRAMP ID 末尾的数字部分，如 'DRAMP00001' -> 1。"""
+    match = re.search(r'(\d+)$', str(dramp_id))
+    return int(match.group(1)) if match else None
+
+def _length_bucket(length: int) -> int:
+    """返回序列长度所属长度桶的下标。"""
+    bucket = 0
+    for i, lower in enumerate(LENGTH_BUCKETS):
+        if length >= lower:
+            bucket = i
+    return bucket
+
+def _write_precompressed(path: str, payload: bytes):
+    """写入原始文件及其 .gz / .br 预压缩副本，供静态服务器直接返回。"""
+    with open(path, 'wb') as f:
+        f.write(payload)
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(payload, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(payload, quality=11))
+
+def _dump_minified(data: Any) -> bytes:
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _sorted_entries(peptide_index: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """按 DRAMP ID 数字排序，无法解析的 ID 排在最后；分片清单与 trigram 索引共用此顺序。"""
+    return sorted(peptide_index, key=lambda e: (_id_number(e['id']) is None, _id_number(e['id']) or 0, str(e['id'])))
+
+def write_sharded_index(peptide_index: List[Dict[str, Any]], shard_dir: str = SHARD_DIR) -> Dict[str, Any]:
+    """
+    将索引按 ID 区间和长度桶切分为多个压缩的小分片，并生成清单文件。
+
+    清单只包含每个分片的 ID/长度/文档编号范围，以及每个 ID 区间的 ID 列表文件
+    （ids_<ID区间>.json，供分页与 ID 搜索按需加载），大小与记录总数无关。
+    搜索页只需加载清单和与查询条件相关的分片。每个分片以列表形式保存记录，
+    字段顺序见 SHARD_FIELDS，其中 doc 是记录在全局 ID 排序中的下标（即 trigram 索引的文档编号）。
+
+    Returns:
+        写入的清单字典
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    entries = _sorted_entries(peptide_index)
+
+    shards: Dict[tuple, List[list]] = {}
+    id_ranges: Dict[int, List[str]] = {}
+    for doc, entry in enumerate(entries):
+        number = _id_number(entry['id'])
+        id_range = number // ID_RANGE_SIZE if number is not None else -1
+        key = (id_range, _length_bucket(entry['length']))
+        shards.setdefault(key, []).append([entry[field] for field in SHARD_FIELDS[:-1]] + [doc])
+        id_ranges.setdefault(id_range, []).append(entry['id'])
+
+    # 清理上一次生成的分片与 ID 列表，避免清单之外的旧文件残留
+    for filename in os.listdir(shard_dir):
+        if filename.startswith(('shard_', 'ids_')):
+            os.remove(os.path.join(shard_dir, filename))
+
+    def range_name(id_range: int) -> str:
+        return f"{id_range * ID_RANGE_SIZE:05d}" if id_range >= 0 else 'other'
+
+    # 排序后每个 ID 区间在全局顺序中是连续的一段（无法解析的 ID 在最后）
+    id_blocks = []
+    doc_min = 0
+    for id_range, ids in sorted(id_ranges.items(), key=lambda item: (item[0] < 0, item[0])):
+        filename = f"ids_{range_name(id_range)}.json"
+        _write_precompressed(os.path.join(shard_dir, filename), _dump_minified(ids))
+        id_blocks.append({
+            'file': filename,
+            'range': id_range,
+            'doc_min': doc_min,
+            'count': len(ids)
+        })
+        doc_min += len(ids)
+
+    shard_meta = []
+    for (id_range, bucket), records in sorted(shards.items()):
+        filename = f"shard_{range_name(id_range)}_len{LENGTH_BUCKETS[bucket]}.json"
+        payload = _dump_minified(records)
+        _write_precompressed(os.path.join(shard_dir, filename), payload)
+        lengths = [record[SHARD_FIELDS.index('length')] for record in records]
+        shard_meta.append({
+            'file': filename,
+            'id_min': records[0][0],
+            'id_max': records[-1][0],
+            'length_min': min(lengths),
+            'length_max': max(lengths),
+            'doc_min': records[0][-1],
+            'doc_max': records[-1][-1],
+            'count': len(records),
+            'bytes': len(payload)
+        })
+
+    manifest = {
+        'version': 2,
+        'total': len(entries),
+        'fields': SHARD_FIELDS,
+        'id_range_size': ID_RANGE_SIZE,
+        'length_buckets': list(LENGTH_BUCKETS),
+        'id_blocks': id_blocks,
+        'shards': shard_meta
+    }
+    _write_precompressed(os.path.join(shard_dir, MANIFEST_FILE), _dump_minified(manifest))
+    if brotli is None:
+        print("提示：未安装 brotli，仅生成了 .gz 预压缩文件。", file=sys.stderr)
+    return manifest
+
+def write_trigram_index(peptide_index: List[Dict[str, Any]], index_path: str = TRIGRAM_INDEX_FILE,
+                        shard_dir: str = SHARD_DIR) -> TrigramIndex:
+    """构建序列 trigram 倒排索引，保存二进制索引并导出搜索页使用的压缩 JSON。"""
+    index = TrigramIndex.build(_sorted_entries(peptide_index))
+    index.save(index_path)
+    os.makedirs(shard_dir, exist_ok=True)
+    _write_precompressed(os.path.join(shard_dir, TRIGRAM_WEB_FILE), _dump_minified(index.to_web_dict()))
+    return index
+
+def _iter_database(db_path: str, archive_path: str):
+    """
+    依次产出 (文件名, 读取函数)。归档文件存在时从归档读取，否则逐个读取目录中的 JSON 文件；
+    读取函数在调用时才解析数据，便于调用方统一处理解析错误。
+    """
+    if os.path.isfile(archive_path):
+        with DrampArchive(archive_path) as archive:
+            for dramp_id in archive.ids():
+                yield f"{dramp_id}.json", lambda dramp_id=dramp_id: archive.get(dramp_id)
+        return
+
+    for filename in os.listdir(db_path):
+        if filename.lower().endswith('.json'):
+            def load(file_path=os.path.join(db_path, filename)):
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            yield filename, load
+
 def create_peptide_index():
-    """遍历数据库目录，提取信息并生成索引文件。"""
+    """遍历数据库目录（或打包后的归档文件），提取信息并生成索引文件。"""
     # script_dir = os.path.dirname(os.path.abspath(__file__)) # 不再需要
     # db_path = os.path.join(script_dir, DATABASE_DIR) # 使用相对路径
     # output_path = os.path.join(script_dir, OUTPUT_FILE) # 使用相对路径
     db_path = DATABASE_DIR # 直接使用相对路径
+    archive_path = DATABASE_ARCHIVE
     output_path = OUTPUT_FILE # 直接使用相对路径
 
-    if not os.path.isdir(db_path):
-        print(f"错误：数据库目录 '{db_path}' 未找到。", file=sys.stderr)
+    if not os.path.isfile(archive_path) and not os.path.isdir(db_path):
+        print(f"错误：数据库目录 '{db_path}' 或归档文件 '{archive_path}' 未找到。", file=sys.stderr)
         return
 
     peptide_index = []
-    print(f"开始扫描目录: {db_path}")
+    print(f"开始扫描: {archive_path if os.path.isfile(archive_path) else db_path}")
     processed_files = 0
     skipped_files = 0
 
-    for filename in os.listdir(db_path):
-        if filename.lower().endswith('.json'):
-            file_path = os.path.join(db_path, filename)
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-
-                # 提取关键字段，使用 find_value_in_dict 增加健壮性
-                dramp_id = find_value_in_dict(data, 'DRAMP ID')
-                name = find_value_in_dict(data, 'Peptide Name') or 'N/A' # Default to N/A if not found
-                sequence = find_value_in_dict(data, 'Sequence')
-
-                if dramp_id is None:
-                    print(f"警告：文件 '{filename}' 缺少 'DRAMP ID'，已跳过。", file=sys.stderr)
-                    skipped_files += 1
-                    continue
-                
-                # 确保 name 是字符串
-                if not isinstance(name, str):
-                    name = str(name)
-
-                # 确保 sequence 是字符串
-                if not isinstance(sequence, str):
-                    print(f"警告：文件 '{filename}' 的 'Sequence' 不是字符串，将尝试转换或置空。", file=sys.stderr)
-                    try:
-                        sequence = str(sequence) if sequence is not None else ''
-                    except:
-                        sequence = '' # Conversion failed
-
-                length = len(sequence)
-
-                entry = {
-                    'id': dramp_id,
-                    'name': name,
-                    'sequence': sequence,
-                    'length': length
-                }
-                peptide_index.append(entry)
-                processed_files += 1
-                if processed_files % 100 == 0: # 每处理100个文件打印一次进度
-                     print(f"已处理 {processed_files} 个文件..." )
-
-
-            except FileNotFoundError:
-                print(f"错误：文件未找到 '{file_path}'（理论上不应发生）。", file=sys.stderr)
-                skipped_files += 1
-            except json.JSONDecodeError:
-                print(f"错误：解析 JSON 文件失败 '{file_path}'。文件可能已损坏。", file=sys.stderr)
-                skipped_files += 1
-            except Exception as e:
-                print(f"处理文件 '{file_path}' 时发生未知错误: {e}", file=sys.stderr)
+    for filename, load in _iter_database(db_path, archive_path):
+        file_path = os.path.join(db_path, filename)
+        try:
+            data = load()
+
+            # 提取关键字段，使用 find_value_in_dict 增加健壮性
+            dramp_id = find_value_in_dict(data, 'DRAMP ID')
+            name = find_value_in_dict(data, 'Peptide Name') or 'N/A' # Default to N/A if not found
+            sequence = find_value_in_dict(data, 'Sequence')
+
+            if dramp_id is None:
+                print(f"警告：文件 '{filename}' 缺少 'DRAMP ID'，已跳过。", file=sys.stderr)
                 skipped_files += 1
-        else:
-            # print(f"跳过非 JSON 文件: {filename}")
-            pass
+                continue
+            
+            # 确保 name 是字符串
+            if not isinstance(name, str):
+                name = str(name)
+
+            # 确保 sequence 是字符串
+            if not isinstance(sequence, str):
+                print(f"警告：文件 '{filename}' 的 'Sequence' 不是字符串，将尝试转换或置空。", file=sys.stderr)
+                try:
+                    sequence = str(sequence) if sequence is not None else ''
+                except:
+                    sequence = '' # Conversion failed
+
+            length = len(sequence)
+
+            entry = {
+                'id': dramp_id,
+                'name': name,
+                'sequence': sequence,
+                'length': length
+            }
+            peptide_index.append(entry)
+            processed_files += 1
+            if processed_files % 100 == 0: # 每处理100个文件打印一次进度
+                 print(f"已处理 {processed_files} 个文件..." )
+
+
+        except FileNotFoundError:
+            print(f"错误：文件未找到 '{file_path}'（理论上不应发生）。", file=sys.stderr)
+            skipped_files += 1
+        except json.JSONDecodeError:
+            print(f"错误：解析 JSON 文件失败 '{file_path}'。文件可能已损坏。", file=sys.stderr)
+            skipped_files += 1
+        except Exception as e:
+            print(f"处理文件 '{file_path}' 时发生未知错误: {e}", file=sys.stderr)
+            skipped_files += 1
 
     print(f"扫描完成。共处理 {processed_files} 个 JSON 文件，跳过 {skipped_files} 个文件。")
 
@@ -113,6 +244,18 @@ def create_peptide_index():
     except Exception as e:
         print(f"写入索引文件时发生未知错误: {e}", file=sys.stderr)
 
+    try:
+        manifest = write_sharded_index(peptide_index)
+        print(f"成功！分片索引已生成: {SHARD_DIR}（{len(manifest['shards'])} 个分片）")
+    except (IOError, OSError) as e:
+        print(f"错误：写入分片索引 '{SHARD_DIR}' 失败: {e}", file=sys.stderr)
+
+    try:
+        write_trigram_index(peptide_index)
+        print(f"成功！序列 trigram 索引已生成: {TRIGRAM_INDEX_FILE}")
+    except (IOError, OSError) as e:
+        print(f"错误：写入 trigram 索引失败: {e}", file=sys.stderr)
+
 
 if __name__ == "__main__":
     create_peptide_index() 
\ No newline at end of file
@@ -10,25 +10,13 @@ from pathlib import Path
 from typing import Dict, Any, List, Union, Optional
 from concurrent.futures import ThreadPoolExecutor
 
+from columnar_store import write_columnar_results, COLUMNAR_DIR
+from dict_utils import find_value_in_dict
+from dramp_archive import DrampArchive
+
 # 禁用SSL证书验证警告
 warnings.filterwarnings("ignore", message="Unverified HTTPS request")
 
-def find_value_in_dict(data: Any, target_key: str) -> Optional[Any]:
-    """Recursively search for a key in a nested dictionary or list."""
-    if isinstance(data, dict):
-        if target_key in data:
-            return data[target_key]
-        for key, value in data.items():
-            found = find_value_in_dict(value, target_key)
-            if found is not None:
-                return found
-    elif isinstance(data, list):
-        for item in data:
-            found = find_value_in_dict(item, target_key)
-            if found is not None:
-                return found
-    return None
-
 def safe_get(data: Dict, key: str, default: Any = None) -> Any:
     """安全获取字典中的值，如果键不存在则返回默认值"""
     try:
@@ -1258,7 +1246,7 @@ def batch_score(input_dir: str, output_dir: str, config_file: str = None, max_wo
     批量处理input_dir中的所有dramp*.json文件，将结果保存到output_dir目录
     
     Args:
-        input_dir: 输入目录，包含待处理的json文件
+        input_dir: 输入目录，包含待处理的json文件；也可以是 dramp_archive 打包的归档文件
         output_dir: 输出目录，用于保存处理结果
         config_file: 可选，权重配置文件路径
         max_workers: 并行处理的最大工作线程数
@@ -1273,8 +1261,12 @@ def batch_score(input_dir: str, output_dir: str, config_file: str = None, max_wo
     scorer = AntimicrobialPeptideScorer(config_file, use_apd3=use_apd3, 
                                         use_local_apd3=True, apd3_folder=apd3_folder)
     
-    # 获取输入目录中的所有json文件
-    json_files = [f for f in os.listdir(input_dir) if f.lower().startswith('dramp') and f.lower().endswith('.json')]
+    # 获取输入目录（或归档文件）中的所有json文件
+    archive = DrampArchive(input_dir) if os.path.isfile(input_dir) else None
+    if archive:
+        json_files = [f"{dramp_id}.json" for dramp_id in archive.ids()]
+    else:
+        json_files = [f for f in os.listdir(input_dir) if f.lower().startswith('dramp') and f.lower().endswith('.json')]
     
     print(f"找到{len(json_files)}个DRAMP JSON文件，开始处理（使用{max_workers}个线程）...")
     
@@ -1284,9 +1276,12 @@ def batch_score(input_dir: str, output_dir: str, config_file: str = None, max_wo
         output_path = os.path.join(output_dir, f"scored_{json_file}")
         
         try:
-            # 读取JSON文件
-            with open(input_path, 'r', encoding='utf-8') as f:
-                peptide_data = json.load(f)
+            # 读取JSON文件（归档中按ID直接定位）
+            if archive:
+                peptide_data = archive.get(os.path.splitext(json_file)[0])
+            else:
+                with open(input_path, 'r', encoding='utf-8') as f:
+                    peptide_data = json.load(f)
             
             # 评分
             result = scorer.score_peptide(peptide_data)
@@ -1304,25 +1299,30 @@ def batch_score(input_dir: str, output_dir: str, config_file: str = None, max_wo
     
     # 使用线程池并行处理文件
     results = []
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_file = {executor.submit(process_file, file): file for file in json_files}
-        for future in future_to_file:
-            file, result = future.result()
-            if result:
-                results.append(result)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_to_file = {executor.submit(process_file, file): file for file in json_files}
+            for future in future_to_file:
+                file, result = future.result()
+                if result:
+                    results.append(result)
+    finally:
+        if archive:
+            archive.close()
     
     print(f"批量处理完成。{len(results)}/{len(json_files)}个文件处理成功。结果已保存到 {output_dir} 目录。")
     
     return results
 
 # 多个JSON文件合并函数
-def merge_results(input_dir: str, output_file: str):
+def merge_results(input_dir: str, output_file: str, columnar_dir: Optional[str] = None):
     """
     合并input_dir中的所有scored_*.json文件到一个大的JSON文件
     
     Args:
         input_dir: 包含已评分JSON文件的目录
         output_file: 合并后的输出文件路径
+        columnar_dir: 可选，同时写出按列存储的Parquet数据集的目录
     """
     results = []
     
@@ -1345,6 +1345,12 @@ def merge_results(input_dir: str, output_file: str):
         json.dump(results, f, indent=2, ensure_ascii=False)
     
     print(f"已合并 {len(results)} 个结果到文件: {output_file}")
+    
+    # 写出列式数据集，供只需部分列的分析任务使用
+    if columnar_dir:
+        write_columnar_results(results, columnar_dir)
+    
+    return results
 
 # 命令行接口
 if __name__ == "__main__":
@@ -1361,12 +1367,13 @@ if __name__ == "__main__":
     
     # 批量评分命令
     batch_parser = subparsers.add_parser("batch", help="批量处理JSON文件")
-    batch_parser.add_argument("--input", help="输入目录", default="database")
+    batch_parser.add_argument("--input", help="输入目录或打包的归档文件", default="database")
     batch_parser.add_argument("--output", help="输出目录", default="result")
     batch_parser.add_argument("--config", help="配置文件路径", default="weights_config.yaml")
     batch_parser.add_argument("--workers", help="并行工作线程数", type=int, default=4)
     batch_parser.add_argument("--no-apd3", help="禁用APD3数据", action="store_true")
     batch_parser.add_argument("--apd3-folder", help="APD3数据文件夹路径", default="APD3")
+    batch_parser.add_argument("--no-columnar", help="不生成列式(Parquet)数据集", action="store_true")
     
     # 创建配置文件模板命令
     config_parser = subparsers.add_parser("create-config", help="创建权重配置文件模板")
@@ -1391,7 +1398,14 @@ if __name__ == "__main__":
         )
         
         # 合并结果
-        merge_results(args.output, os.path.join(args.output, "all_scores.json"))
+        merged = merge_results(
+            args.output, os.path.join(args.output, "all_scores.json"),
+            columnar_dir=None if args.no_columnar else os.path.join(args.output, COLUMNAR_DIR)
+        )
+        
+        # 增量更新 Statistics 页面使用的预计算统计
+        from aggregate_stats import update_statistics, STATISTICS_FILE, STATE_FILE
+        update_statistics(merged, os.path.join(args.output, STATE_FILE), os.path.join(args.output, STATISTICS_FILE))
     
     elif args.command == "create-config":
         # 创建配置文件模板
@@ -0,0 +1,206 @@
+import io
+import os
+import sys
+import time
+import base64
+import struct
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Sequence
+
+# --- 配置 ---
+GRAM_SIZE = 3  # n-gram 长度
+INDEX_FILE = 'peptide_trigram.idx'  # Python 端使用的二进制索引文件名
+WEB_INDEX_FILE = 'trigram.json'  # 导出给搜索页的索引文件名（与分片索引放在同一目录）
+MAGIC = b'TRGM'
+FORMAT_VERSION = 1
+# ---
+
+def encode_postings(doc_ids: Sequence[int]) -> bytes:
+    """将升序文档编号编码为差分 + varint 字节串。"""
+    out = bytearray()
+    previous = 0
+    for doc_id in doc_ids:
+        delta = doc_id - previous
+        previous = doc_id
+        while delta >= 0x80:
+            out.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return bytes(out)
+
+def decode_postings(data: bytes) -> List[int]:
+    """解码 encode_postings 生成的字节串。"""
+    doc_ids = []
+    current = 0
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        current += value
+        doc_ids.append(current)
+        value = 0
+        shift = 0
+    return doc_ids
+
+def _write_varint(buffer: io.BytesIO, value: int):
+    while value >= 0x80:
+        buffer.write(bytes(((value & 0x7F) | 0x80,)))
+        value >>= 7
+    buffer.write(bytes((value,)))
+
+def _read_varint(data: bytes, pos: int):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def _write_str(buffer: io.BytesIO, text: str):
+    raw = text.encode('utf-8')
+    _write_varint(buffer, len(raw))
+    buffer.write(raw)
+
+def _read_str(data: bytes, pos: int):
+    length, pos = _read_varint(data, pos)
+    return data[pos:pos + length].decode('utf-8'), pos + length
+
+class TrigramIndex:
+    """
+    序列三联体（trigram）倒排索引，用于序列片段（motif）的子串搜索。
+
+    每条序列按大写形式拆分为所有长度为 3 的子串，倒排表记录包含该子串的文档编号。
+    查询时先对查询片段的所有 trigram 倒排表求交得到候选，再逐条校验子串，
+    因此结果与线性扫描完全一致。短于 3 的查询退化为线性扫描。
+    """
+
+    def __init__(self, ids: List[str], sequences: List[str], postings: Dict[str, bytes]):
+        self.ids = ids
+        self.sequences = sequences
+        self._postings = postings
+        self._decode = lru_cache(maxsize=4096)(self._decode_uncached)
+
+    @classmethod
+    def build(cls, entries: Iterable[Dict[str, Any]]) -> 'TrigramIndex':
+        """根据索引条目（包含 'id' 与 'sequence'）构建索引，文档编号即条目顺序。"""
+        ids = []
+        sequences = []
+        grams: Dict[str, List[int]] = {}
+        for doc_id, entry in enumerate(entries):
+            sequence = (entry.get('sequence') or '').upper()
+            ids.append(entry['id'])
+            sequences.append(sequence)
+            for gram in {sequence[i:i + GRAM_SIZE] for i in range(len(sequence) - GRAM_SIZE + 1)}:
+                grams.setdefault(gram, []).append(doc_id)
+        postings = {gram: encode_postings(doc_ids) for gram, doc_ids in grams.items()}
+        return cls(ids, sequences, postings)
+
+    def _decode_uncached(self, gram: str) -> List[int]:
+        return decode_postings(self._postings.get(gram, b''))
+
+    def candidates(self, motif: str) -> List[int]:
+        """返回可能包含 motif 的文档编号（升序）；motif 短于 3 时返回全部文档。"""
+        motif = motif.upper()
+        if len(motif) < GRAM_SIZE:
+            return list(range(len(self.ids)))
+        grams = {motif[i:i + GRAM_SIZE] for i in range(len(motif) - GRAM_SIZE + 1)}
+        if any(gram not in self._postings for gram in grams):
+            return []
+        # 从最短的倒排表开始求交，尽早缩小候选集
+        ordered = sorted(grams, key=lambda gram: len(self._postings[gram]))
+        result = set(self._decode(ordered[0]))
+        for gram in ordered[1:]:
+            if not result:
+                break
+            result.intersection_update(self._decode(gram))
+        return sorted(result)
+
+    def search(self, motif: str) -> List[str]:
+        """返回序列中包含 motif（不区分大小写）的全部 DRAMP ID。"""
+        motif = motif.upper()
+        if not motif:
+            return []
+        return [self.ids[doc_id] for doc_id in self.candidates(motif)
+                if motif in self.sequences[doc_id]]
+
+    def save(self, path: str = INDEX_FILE):
+        """保存为紧凑的二进制格式。"""
+        buffer = io.BytesIO()
+        buffer.write(MAGIC)
+        buffer.write(struct.pack('<BI', FORMAT_VERSION, len(self.ids)))
+        for dramp_id, sequence in zip(self.ids, self.sequences):
+            _write_str(buffer, str(dramp_id))
+            _write_str(buffer, sequence)
+        _write_varint(buffer, len(self._postings))
+        for gram in sorted(self._postings):
+            _write_str(buffer, gram)
+            _write_varint(buffer, len(self._postings[gram]))
+            buffer.write(self._postings[gram])
+        with open(path, 'wb') as f:
+            f.write(buffer.getvalue())
+
+    @classmethod
+    def load(cls, path: str = INDEX_FILE) -> 'TrigramIndex':
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:4] != MAGIC:
+            raise ValueError(f"'{path}' 不是有效的 trigram 索引文件")
+        version, doc_count = struct.unpack_from('<BI', data, 4)
+        if version != FORMAT_VERSION:
+            raise ValueError(f"不支持的 trigram 索引版本: {version}")
+        pos = 4 + struct.calcsize('<BI')
+        ids = []
+        sequences = []
+        for _ in range(doc_count):
+            dramp_id, pos = _read_str(data, pos)
+            sequence, pos = _read_str(data, pos)
+            ids.append(dramp_id)
+            sequences.append(sequence)
+        gram_count, pos = _read_varint(data, pos)
+        postings = {}
+        for _ in range(gram_count):
+            gram, pos = _read_str(data, pos)
+            length, pos = _read_varint(data, pos)
+            postings[gram] = data[pos:pos + length]
+            pos += length
+        return cls(ids, sequences, postings)
+
+    def to_web_dict(self) -> Dict[str, Any]:
+        """
+        导出给搜索页使用的结构：倒排表以 base64 编码的差分 varint 字节保存，
+        文档编号对应分片记录中的 doc 字段（全局 ID 排序下标），候选校验由页面在加载的分片上完成。
+        """
+        return {
+            'version': FORMAT_VERSION,
+            'gram_size': GRAM_SIZE,
+            'count': len(self.ids),
+            'postings': {gram: base64.b64encode(data).decode('ascii')
+                         for gram, data in sorted(self._postings.items())}
+        }
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="序列 trigram 索引查询")
+    parser.add_argument("motif", help="要搜索的序列片段，如 KWK")
+    parser.add_argument("--index", help="索引文件路径", default=INDEX_FILE)
+    parser.add_argument("--limit", help="最多打印的结果数", type=int, default=20)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.index):
+        print(f"错误：索引文件 '{args.index}' 未找到，请先运行 generate_index.py。", file=sys.stderr)
+        sys.exit(1)
+
+    index = TrigramIndex.load(args.index)
+    start = time.perf_counter()
+    matches = index.search(args.motif)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    print(f"在 {len(index.ids)} 条序列中找到 {len(matches)} 条包含 '{args.motif.upper()}' 的序列，耗时 {elapsed_ms:.2f} ms")
+    for dramp_id in matches[:args.limit]:
+        print(dramp_id)
@@ -1,5 +1,6 @@
 import os
 import json
+from contextlib import contextmanager, nullcontext
 import numpy as np
 from tqdm import tqdm
 import gc
@@ -8,17 +9,61 @@ from collections import defaultdict
 
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import AdamW
 from torch.nn.utils import clip_grad_norm_
+from torch.utils.checkpoint import checkpoint
 from transformers import EsmTokenizer
 
 from amp4multitask.modeling_amp import AMPConfig, AMPForMultiTask
-from merged_dataloader import build_dataloader
+from merged_dataloader import build_dataloader, build_multitask_dataloader, set_loader_epoch, loader_state_dict, load_loader_state_dict
+from activation_cache import FrozenActivationCache
+from checkpointing import AsyncCheckpointer, rng_state, set_rng_state
+from compilation import COMPILE_MODES, CompiledModel
+from forward_utils import PRECISIONS, reuse_encoder_outputs, select_rows
+
+NUM_FROZEN_LAYERS = 4
+
+def _checkpointed(forward):
+    """forward that keeps only its inputs for backward and recomputes its activations in the backward pass"""
+    def checkpointed_forward(*args, **kwargs):
+        if torch.is_grad_enabled():
+            return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+        return forward(*args, **kwargs)
+    return checkpointed_forward
+
+class _JointForward(nn.Module):
+    """
+    one encoder forward over the unique sequences of a joint batch, then every task head on the rows
+    labelled for it; a module of its own so that DDP sees a single forward per training step
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, tasks):
+        """tasks maps a task name to (rows, organism_ids); returns the logits of every task"""
+        encoder_outputs = self.model.amp(input_ids=input_ids, attention_mask=attention_mask)
+        logits = {}
+        for task_name, (rows, organism_ids) in tasks.items():
+            with reuse_encoder_outputs(self.model, select_rows(encoder_outputs, rows)):
+                logits[task_name] = self.model(
+                    input_ids=input_ids[rows],
+                    attention_mask=attention_mask[rows],
+                    task_name=task_name,
+                    organism_ids=organism_ids,
+                    return_dict=True
+                    ).logits
+        return logits
 
 class EarlyStopping:
-    def __init__(self, patience=5, delta=0, output_dir=None, checkpoint_path='best_pretrain_model.pth'):
+    def __init__(self, patience=5, delta=0, output_dir=None, checkpoint_path='best_pretrain_model.pth', is_main_process=True,
+                 writer=None):
         self.patience = patience
         self.delta = delta
+        self.is_main_process = is_main_process      # in distributed training only rank 0 writes the checkpoint
+        self.writer = writer                        # AsyncCheckpointer for background writes, else torch.save
         self.counter = 0
         self.best_score = None
         self.early_stop = False
@@ -34,7 +79,8 @@ class EarlyStopping:
             self.save_checkpoint(val_loss, model)
         elif val_loss > self.best_score + self.delta:
             self.counter += 1
-            print(f"EarlyStopping counter: {self.counter}/{self.patience}")
+            if self.is_main_process:
+                print(f"EarlyStopping counter: {self.counter}/{self.patience}")
             if self.counter >= self.patience:
                 self.early_stop = True
         else:
@@ -46,16 +92,59 @@ class EarlyStopping:
     def save_checkpoint(self, val_loss, model):
         if val_loss < self.min_val_loss:
             self.min_val_loss = val_loss
-            torch.save(model.state_dict(), self.checkpoint_path)
+            if not self.is_main_process:
+                return
+            if self.writer is not None:
+                self.writer.save(model.state_dict(), self.checkpoint_path)
+            else:
+                torch.save(model.state_dict(), self.checkpoint_path)
             print(f"Validation loss improved to {val_loss:.4f}. Model saved to {self.checkpoint_path}!")
 
+    def state_dict(self):
+        return {key: getattr(self, key) for key in ('counter', 'best_score', 'early_stop', 'min_val_loss')}
+
+    def load_state_dict(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
 class ampTrainer:
-    def __init__(self, model_root, data_file, save_dir="training_outputs"):
+    def __init__(self, model_root, data_file, save_dir="training_outputs", bucket_by_length=False,
+                 num_workers=0, pin_memory=None, prefetch_factor=2, precision="fp32",
+                 cache_frozen_activations=False, activation_cache_dtype="fp16", backend="gloo", keep_checkpoints=3,
+                 batch_size=64, accumulation_steps=1, activation_checkpointing=False, log_interval=50,
+                 compile_mode="none"):
         self.model_root = model_root
         self.data_file = data_file
         self.save_dir = save_dir
+        self.bucket_by_length = bucket_by_length    # length-bucketed batches with dynamic padding
         os.makedirs(self.save_dir, exist_ok=True)
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # data-parallel training when launched by torchrun with more than one process
+        self.world_size = int(os.environ.get("WORLD_SIZE", 1))
+        if self.world_size > 1 and not dist.is_initialized():
+            dist.init_process_group(backend)
+        self.rank = dist.get_rank() if self.world_size > 1 else 0
+        self.is_main_process = self.rank == 0
+        if torch.cuda.is_available():
+            self.device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+            torch.cuda.set_device(self.device)
+        else:
+            self.device = torch.device("cpu")
+        # data loader parallelism: batches are fetched and collated in worker processes when num_workers > 0
+        self.loader_options = {
+            "num_workers": num_workers,
+            "pin_memory": self.device.type == "cuda" if pin_memory is None else pin_memory,
+            "prefetch_factor": prefetch_factor,
+        }
+        assert precision in PRECISIONS, f"Invalid precision {precision}, choose from {list(PRECISIONS)}"
+        assert precision != "fp16" or self.device.type == "cuda", "fp16 autocast is only supported on CUDA, use bf16 on CPU"
+        self.precision = precision      # mixed precision for train_task, validate and inference
+        # run the frozen encoder prefix once per sequence and train from cached hidden states
+        self.cache_frozen_activations = cache_frozen_activations
+        self.activation_cache_dtype = activation_cache_dtype
+        self.activation_cache = None
+        # best models and per-epoch training states are written in the background by rank 0
+        self.checkpointer = AsyncCheckpointer(os.path.join(self.save_dir, "checkpoints"), keep_last=keep_checkpoints,
+                                              enabled=self.is_main_process)
 
 
         self.task_config = {
@@ -79,15 +168,40 @@ class ampTrainer:
             }
         }
         self.task_order = list(self.task_config.keys())[1:]     # task order starts with task 1: amp_classification
-        print(f"Task order: {self.task_order}")
+        self.log(f"Task order: {self.task_order}")
 
         self.model = self.load_modelFromPretrain()
+        # the modules the training steps run through: the model itself, or its DDP wrappers while training
+        self.forward_model = self.model
+        self.joint_model = _JointForward(self.model)
         self.tokenizer = EsmTokenizer.from_pretrained(
         self.model_root,
         padding_side="left"
         )
+        # compiled single-task forward (torch.compile or TorchScript) for train_task and validate
+        assert compile_mode in COMPILE_MODES, f"Invalid compile mode {compile_mode}, choose from {COMPILE_MODES}"
+        assert compile_mode == "none" or not cache_frozen_activations, "compile does not support cache_frozen_activations"
+        assert compile_mode != "torchscript" or (precision == "fp32" and not activation_checkpointing), \
+            "torchscript only supports fp32 without activation checkpointing"
+        self.compiled_model = self.model if compile_mode == "none" else CompiledModel(
+            self.model, self.tokenizer.pad_token_id, self.tokenizer.padding_side, mode=compile_mode
+        )
 
-        self.batch_size = 64
+        self.batch_size = batch_size    # per loader batch (micro-batch) and process
+        # one optimizer step per accumulation_steps batches: effective batch size batch_size * accumulation_steps
+        self.accumulation_steps = accumulation_steps
+        assert accumulation_steps >= 1, "accumulation_steps must be at least 1"
+        if activation_checkpointing:
+            self.enable_activation_checkpointing()
+        # the running training loss stays on the device and is read back every log_interval steps
+        self.log_interval = log_interval
+        self.loss_functions = {
+            "amp_classification": nn.CrossEntropyLoss(),
+            "bioactivity_classification": nn.BCEWithLogitsLoss(),
+            "half_life_regression": nn.MSELoss(),
+            "hemolysis_regression": nn.MSELoss(),
+            "mic_regression": nn.HuberLoss(delta=1.0),
+        }
         self.optimizer = AdamW(
             self.model.parameters(),
             lr=2e-5
@@ -121,6 +235,126 @@ class ampTrainer:
             raise FileNotFoundError(f"[Error] No pretrained model found at {checkpoint_path}")
         return model
 
+    def log(self, message):
+        """print on the main process only"""
+        if self.is_main_process:
+            print(message)
+
+    @contextmanager
+    def main_process_first(self):
+        """rank 0 runs the block first (e.g. to build the on-disk caches), the other ranks after it"""
+        if not self.is_main_process:
+            dist.barrier()
+        try:
+            yield
+        finally:
+            if self.is_main_process and self.world_size > 1:
+                dist.barrier()
+
+    def _distribute(self, module):
+        """wrap module in DDP when training with several processes; call after freezing layers"""
+        if self.world_size == 1:
+            return module
+        device_ids = [self.device.index] if self.device.type == "cuda" else None
+        # heads of tasks without labels in a batch get no gradient, so unused parameters must be detected
+        return DistributedDataParallel(module, device_ids=device_ids, find_unused_parameters=True)
+
+    def _all_reduce_mean(self, total, count):
+        """mean over all ranks of values whose per-rank sum and count are given"""
+        if self.world_size > 1:
+            totals = torch.tensor([total, count], dtype=torch.float64, device=self.device)
+            dist.all_reduce(totals)
+            total, count = totals.tolist()
+        return total / count if count > 0 else float('inf')
+
+    def _save_training_state(self, name, epoch, early_stopping, scaler, train_loader, history):
+        """everything needed to continue name (a task or 'joint') after epoch, written in the background"""
+        state = {
+            'task': name,
+            'epoch': epoch,
+            'model': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scaler': scaler.state_dict(),
+            'early_stopping': early_stopping.state_dict(),
+            'history': dict(history),
+            'loader': loader_state_dict(train_loader),
+            'rng': rng_state(),
+        }
+        self.checkpointer.save_training_state(state, name, epoch)
+
+    def _restore_training_state(self, state, early_stopping, scaler, train_loader):
+        """restore a state of _save_training_state; returns the number of epochs already done"""
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        scaler.load_state_dict(state['scaler'])
+        early_stopping.load_state_dict(state['early_stopping'])
+        load_loader_state_dict(train_loader, state['loader'])
+        set_rng_state(state['rng'])
+        self.log(f"[Info] Resuming {state['task']} after epoch {state['epoch']}")
+        return state['epoch']
+
+    def load_training_state(self):
+        """the latest training state in save_dir/checkpoints, or None"""
+        return self.checkpointer.load_latest(map_location=self.device)
+
+    def autocast(self):
+        """autocast region for the forward pass in the configured precision (a no-op for fp32)"""
+        dtype = PRECISIONS[self.precision]
+        return torch.autocast(device_type=self.device.type, dtype=dtype, enabled=dtype is not None)
+
+    def grad_scaler(self):
+        """loss scaling is only needed for fp16: bf16 has the fp32 exponent range, so its gradients do not underflow"""
+        return torch.amp.GradScaler(self.device.type, enabled=self.precision == "fp16")
+
+    def enable_activation_checkpointing(self, first_layer=NUM_FROZEN_LAYERS):
+        """
+        recompute the activations of the trainable encoder layers (from first_layer on) in the backward pass
+        instead of keeping them, trading about one extra forward of these layers for activation memory
+        """
+        for layer in self.model.amp.layers[first_layer:]:
+            if 'forward' not in vars(layer):
+                layer.forward = _checkpointed(layer.forward)
+
+    def _accumulation_group(self, step, num_steps):
+        """(size of the accumulation group of batch step, whether the optimizer steps after it)"""
+        group_start = step - step % self.accumulation_steps
+        group_size = min(self.accumulation_steps, num_steps - group_start)
+        return group_size, step + 1 == group_start + group_size
+
+    def _no_sync(self, model, sync):
+        """skip the DDP gradient all-reduce on the batches before an accumulation boundary"""
+        if sync or not isinstance(model, DistributedDataParallel):
+            return nullcontext()
+        return model.no_sync()
+
+    def _optimizer_step(self, scaler):
+        """clip the accumulated gradients and step; the grad scaler unscales them first"""
+        scaler.unscale_(self.optimizer)
+        clip_grad_norm_(self.model.parameters(), 1.0)
+        scaler.step(self.optimizer)
+        scaler.update()
+        self.optimizer.zero_grad(set_to_none=True)
+
+    def _train_epoch(self, train_loader, batch_loss, model, scaler, desc):
+        """
+        one epoch of optimizer steps with gradient accumulation, batch_loss(batch) giving the loss of a batch
+        computed through model; returns the mean batch loss over all ranks
+        """
+        running_loss = torch.zeros((), device=self.device)
+        num_steps = len(train_loader)
+        progress_bar = tqdm(train_loader, desc=desc, disable=not self.is_main_process)
+        for step, batch in enumerate(progress_bar):
+            group_size, boundary = self._accumulation_group(step, num_steps)
+            with self._no_sync(model, boundary):
+                loss = batch_loss(batch)
+                scaler.scale(loss / group_size).backward()
+            if boundary:
+                self._optimizer_step(scaler)
+            running_loss += loss.detach()
+            if (step + 1) % self.log_interval == 0:
+                progress_bar.set_postfix({'loss': round(running_loss.item() / (step + 1), 4)})
+        return self._all_reduce_mean(running_loss.item(), num_steps)
+
     def freeze_encoder_layers(self, num_frozen_layers: int=5):
         """freeze some certain layers of the encoder"""
         assert num_frozen_layers <= len(self.model.amp.layers) and num_frozen_layers > 0, "Invalid number of frozen layers"
@@ -139,69 +373,79 @@ class ampTrainer:
                 for param in layer.parameters():
                     param.requires_grad = False
 
-    def train_task(self, task_name, epochs = 100):
-        """Train a single task"""
-        print(f"\n{'='*50}")
-        print(f"Starting training for task: {task_name}")
-        print(f"{'='*50}\n")
+    def train_task(self, task_name, epochs = 100, resume_state=None):
+        """Train a single task, continuing from resume_state (see load_training_state) if given"""
+        self.log(f"\n{'='*50}")
+        self.log(f"Starting training for task: {task_name}")
+        self.log(f"{'='*50}\n")
         self.model.set_train_mode(task_name)
-        self.freeze_encoder_layers(4)
+        self.freeze_encoder_layers(NUM_FROZEN_LAYERS)
+        self.forward_model = self._distribute(self.compiled_model)
 
-        train_loader, val_loader, _ = build_dataloader(self.data_file, task_name, self.batch_size)
+        with self.main_process_first():
+            train_loader, val_loader, _ = build_dataloader(
+                self.data_file, task_name, self.batch_size, self.tokenizer, bucket_by_length=self.bucket_by_length,
+                **self.loader_options
+            )
+            if self.cache_frozen_activations:
+                self.activation_cache = FrozenActivationCache.load_or_build(
+                    self.model, self.data_file, self.tokenizer, NUM_FROZEN_LAYERS, self.activation_cache_dtype
+                )
 
-        early_stopping = EarlyStopping(output_dir=self.save_dir, checkpoint_path=f"best_{task_name}_model.pth")
+        early_stopping = EarlyStopping(output_dir=self.save_dir, checkpoint_path=f"best_{task_name}_model.pth",
+                                       is_main_process=self.is_main_process, writer=self.checkpointer)
+        scaler = self.grad_scaler()
         train_history = {
         'epoch': [],
         'train_loss': [],
         'val_loss': []
         }
+        start_epoch = 0
+        if resume_state is not None:
+            start_epoch = self._restore_training_state(resume_state, early_stopping, scaler, train_loader)
+            train_history = resume_state['history']
 
-        for epoch in range(epochs):
+        self.optimizer.zero_grad(set_to_none=True)
+        for epoch in range(start_epoch, epochs):
+            if early_stopping.early_stop:   # resumed after early stopping was triggered
+                break
             self.model.train()
-            total_loss = 0.0
-            train_steps = 0
-        
-            progress_bar = tqdm(train_loader, desc=f"Epoch {epoch+1}/{epochs}")
-            for batch in progress_bar:
-                loss = self._compute_loss(task_name, batch)
-
-                self.optimizer.zero_grad()
-                loss.backward()
-                clip_grad_norm_(self.model.parameters(), 1.0)
-                self.optimizer.step()
-
-                total_loss += loss.item()
-                train_steps += 1
-                avg_train_loss = total_loss / train_steps
-                progress_bar.set_postfix({'loss': round(avg_train_loss, 4)})
- 
-                del loss, avg_train_loss
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
+            set_loader_epoch(train_loader, epoch)
+            avg_train_loss = self._train_epoch(
+                train_loader, lambda batch: self._compute_loss(task_name, batch, self.forward_model),
+                self.forward_model, scaler, desc=f"Epoch {epoch+1}/{epochs}"
+            )
 
             val_loss = self.validate(val_loader, task_name)
-            avg_train_loss = total_loss / len(train_loader)
-            print(f"Epoch {epoch+1}/{epochs} | Train Loss: {avg_train_loss:.4f} | Val Loss: {val_loss:.4f}")
+            self.log(f"Epoch {epoch+1}/{epochs} | Train Loss: {avg_train_loss:.4f} | Val Loss: {val_loss:.4f}")
             train_history["epoch"].append(epoch+1)
             train_history["train_loss"].append(avg_train_loss)
             train_history["val_loss"].append(val_loss)
 
             early_stopping(val_loss, self.model)
+            self._save_training_state(task_name, epoch+1, early_stopping, scaler, train_loader, train_history)
             if early_stopping.early_stop:
-                print(f"Early stopping triggered at epoch {epoch+1}")
+                self.log(f"Early stopping triggered at epoch {epoch+1}")
                 break
         
         # after training, loaded the best model
         best_checkpoint_path = os.path.join(self.save_dir, f"best_{task_name}_model.pth")
+        self.checkpointer.wait()
+        if self.world_size > 1:
+            dist.barrier()      # the checkpoint is written by rank 0
         if os.path.exists(best_checkpoint_path):
             self.model.load_state_dict(torch.load(best_checkpoint_path, map_location=self.device, weights_only=True))
-            print(f"[Info] Loaded best model for {task_name} from {best_checkpoint_path}")
+            self.log(f"[Info] Loaded best model for {task_name} from {best_checkpoint_path}")
         else:
             raise FileNotFoundError(f"[Error] No best model found for {task_name}")
 
+        self.activation_cache = None
+        self.forward_model = self.model
+
         # Save final loss history
-        self.save_loss_history(train_history, task_name)
-        print("Training completed!")
+        if self.is_main_process:
+            self.save_loss_history(train_history, task_name)
+        self.log("Training completed!")
 
         gc.collect()
         if torch.cuda.is_available():
@@ -213,87 +457,258 @@ class ampTrainer:
             df.to_csv(filename, index=False)
             print(f"Loss history saved to {filename}")
 
-    def _compute_loss(self, task_name, batch):
-        sequences = batch['Sequence']
-        encoding = self.tokenizer(
-        sequences,
-        padding='max_length',
-        max_length=128,
-        truncation=True,
-        return_tensors='pt'
-        )
-        inputs = encoding['input_ids'].to(self.device)
-        attention_mask = encoding['attention_mask'].to(self.device)
+    def _compute_loss(self, task_name, batch, model=None):
+        """loss of a single-task batch; model defaults to self.model (training passes its DDP wrapper)"""
+        model = self.model if model is None else model
+        inputs = batch['input_ids'].to(self.device, non_blocking=True)
+        attention_mask = batch['attention_mask'].to(self.device, non_blocking=True)
         organism_ids = None
-        labels = batch['label'].to(self.device)
+        labels = batch['label'].to(self.device, non_blocking=True)
 
         if task_name == "mic_regression":
-            organism_ids = batch['organism'].to(self.device)
-
-        outputs = self.model(
-            input_ids=inputs, 
-            attention_mask=attention_mask, 
-            task_name=task_name,
-            organism_ids=organism_ids,
-            return_dict=True
-            )
-        outputs = outputs.logits
-        
+            organism_ids = batch['organism'].to(self.device, non_blocking=True)
+
+        with self._resume_from_cache(batch), self.autocast():
+            outputs = model(
+                input_ids=inputs, 
+                attention_mask=attention_mask, 
+                task_name=task_name,
+                organism_ids=organism_ids,
+                return_dict=True
+                )
+        # losses are computed in fp32 outside the autocast region
+        return self._task_loss(task_name, outputs.logits.float(), labels)
+
+    def _task_loss(self, task_name, outputs, labels):
+        loss_fn = self.loss_functions[task_name]
         if task_name == "amp_classification":
-            loss_fn = nn.CrossEntropyLoss()
-            loss = loss_fn(outputs, labels.long())
-        elif task_name == "bioactivity_classification":
-            loss_fn = nn.BCEWithLogitsLoss()
-            loss = loss_fn(outputs, labels.float())
-        elif task_name == "mic_regression":
-            loss_fn = nn.HuberLoss(delta=1.0)
-            loss = loss_fn(outputs.squeeze(), labels.float())
-        else:
-            loss_fn = nn.MSELoss()
-            loss = loss_fn(outputs.squeeze(), labels.float())
-        return loss
+            return loss_fn(outputs, labels.long())
+        if task_name == "bioactivity_classification":
+            return loss_fn(outputs, labels.float())
+        return loss_fn(outputs.reshape(labels.shape), labels.float())
+
+    def _resume_from_cache(self, batch):
+        """with the frozen activation cache, start the encoder forward of this batch from the cached hidden states"""
+        if self.activation_cache is None:
+            return nullcontext()
+        hidden_states = self.activation_cache.gather(batch['sequence_index'], batch['attention_mask'])
+        return self.activation_cache.resume(self.model, hidden_states.to(self.device, non_blocking=True))
+
+    def _compute_joint_loss(self, batch, task_weights, model=None):
+        """
+        loss of a joint batch through _JointForward (model defaults to self.joint_model, training passes
+        its DDP wrapper); returns the weighted sum of the per-task losses and the per-task losses
+        """
+        model = self.joint_model if model is None else model
+        input_ids = batch['input_ids'].to(self.device, non_blocking=True)
+        attention_mask = batch['attention_mask'].to(self.device, non_blocking=True)
+        tasks = {}
+        for task_name, task_batch in batch['tasks'].items():
+            organism_ids = None
+            if task_name == "mic_regression":
+                organism_ids = task_batch['organism'].to(self.device, non_blocking=True)
+            tasks[task_name] = (task_batch['rows'].to(self.device, non_blocking=True), organism_ids)
+        with self._resume_from_cache(batch), self.autocast():
+            logits = model(input_ids, attention_mask, tasks)
+
+        losses = {}
+        for task_name, task_batch in batch['tasks'].items():
+            labels = task_batch['label'].to(self.device, non_blocking=True)
+            losses[task_name] = self._task_loss(task_name, logits[task_name].float(), labels)
+
+        loss = sum(task_weights[task_name] * task_loss for task_name, task_loss in losses.items())
+        return loss, losses
 
     def validate(self, data_loader, task_name):
+        """mean batch loss over data_loader, averaged over the shards of all ranks in distributed training"""
         self.model.eval()
-        total_loss = 0
+        total_loss = torch.zeros((), device=self.device)
         batch_count = 0
         
         with torch.no_grad():
             for batch in data_loader:
-                loss = self._compute_loss(task_name, batch)
-                total_loss += loss.item()
+                loss = self._compute_loss(task_name, batch, self.compiled_model)
+                total_loss += loss
                 batch_count += 1
-                del batch, loss
-        return total_loss / batch_count if batch_count > 0 else float('inf')
+        return self._all_reduce_mean(total_loss.item(), batch_count)
     
-    def train_all_tasks(self, epochs_per_task=100, start_from=None):
-        if start_from:
+    def train_all_tasks(self, epochs_per_task=100, start_from=None, resume=False):
+        """
+        Train the tasks one after another, each starting from the best model of the previous one.
+        With resume, continue from the latest training state in save_dir/checkpoints instead of start_from.
+        """
+        resume_state = self.load_training_state() if resume else None
+        prev_task = None
+        if resume_state is not None and resume_state['task'] in self.task_order:
+            start_idx = self.task_order.index(resume_state['task'])
+            if resume_state['early_stopping']['early_stop'] or resume_state['epoch'] >= epochs_per_task:
+                # the run stopped between two tasks: continue with the next task from the best model of this one
+                prev_task, resume_state = resume_state['task'], None
+                start_idx += 1
+        elif start_from:
             start_idx = self.task_order.index(start_from)
-            tasks_to_train = self.task_order[start_idx:]
         else:
-            tasks_to_train = self.task_order
+            start_idx = 0
+        tasks_to_train = self.task_order[start_idx:]
 
         for i, task in enumerate(tasks_to_train):
-            print(f"\n=== Starting Task {i+1}/{len(tasks_to_train)}: {task} ===")
-            if i > 0:
-                prev_task = self.task_order[i-1]
+            self.log(f"\n=== Starting Task {i+1}/{len(tasks_to_train)}: {task} ===")
+            if prev_task is not None and resume_state is None:
                 checkpoint_path = os.path.join(self.save_dir, f"best_{prev_task}_model.pth")
                 checkpoint = torch.load(checkpoint_path, map_location=self.device, weights_only=True)
                 self.model.load_state_dict(checkpoint)
 
-            self.train_task(task, epochs=epochs_per_task)
-            print(f"Completed training for {task}\n")
+            self.train_task(task, epochs=epochs_per_task, resume_state=resume_state)
+            self.log(f"Completed training for {task}\n")
+            prev_task, resume_state = task, None
 
             gc.collect()
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
                 torch.cuda.ipc_collect()
 
+    def train_joint(self, epochs=100, tasks=None, task_weights=None, temperature=1.0, resume=False):
+        """
+        Train all task heads together instead of one task after another.
+
+        Every step mixes tasks (see TaskMixingBatchSampler for temperature), encodes each sequence of the
+        batch once and feeds every head that has labels for it; the step loss is the task_weights-weighted
+        sum of the per-task losses. Early stopping follows the weighted sum of the per-task validation
+        losses and keeps the best model in best_joint_model.pth. With resume, continue from the latest
+        joint training state in save_dir/checkpoints. The joint steps run eagerly; with compile only the
+        per-task validation uses the compiled forward.
+        """
+        tasks = tasks or self.task_order
+        task_weights = {task_name: 1.0 for task_name in tasks} | (task_weights or {})
+        self.log(f"\n{'='*50}")
+        self.log(f"Starting joint training for tasks: {tasks}")
+        self.log(f"{'='*50}\n")
+        # set_train_mode selects a single task; in joint mode every head trains
+        for param in self.model.parameters():
+            param.requires_grad = True
+        self.freeze_encoder_layers(NUM_FROZEN_LAYERS)
+        joint_model = self._distribute(self.joint_model)
+
+        with self.main_process_first():
+            train_loader, val_loaders = build_multitask_dataloader(
+                self.data_file, self.batch_size, self.tokenizer, tasks, temperature=temperature, **self.loader_options
+            )
+            if self.cache_frozen_activations:
+                self.activation_cache = FrozenActivationCache.load_or_build(
+                    self.model, self.data_file, self.tokenizer, NUM_FROZEN_LAYERS, self.activation_cache_dtype
+                )
+
+        early_stopping = EarlyStopping(output_dir=self.save_dir, checkpoint_path="best_joint_model.pth",
+                                       is_main_process=self.is_main_process, writer=self.checkpointer)
+        scaler = self.grad_scaler()
+        train_history = defaultdict(list)
+        resume_state = self.load_training_state() if resume else None
+        start_epoch = 0
+        if resume_state is not None and resume_state['task'] == "joint":
+            start_epoch = self._restore_training_state(resume_state, early_stopping, scaler, train_loader)
+            train_history = defaultdict(list, resume_state['history'])
+
+        self.optimizer.zero_grad(set_to_none=True)
+        for epoch in range(start_epoch, epochs):
+            if early_stopping.early_stop:   # resumed after early stopping was triggered
+                break
+            self.model.train()
+            set_loader_epoch(train_loader, epoch)
+            avg_train_loss = self._train_epoch(
+                train_loader, lambda batch: self._compute_joint_loss(batch, task_weights, joint_model)[0],
+                joint_model, scaler, desc=f"Epoch {epoch+1}/{epochs}"
+            )
+
+            val_losses = {task_name: self.validate(val_loaders[task_name], task_name) for task_name in tasks}
+            val_loss = sum(task_weights[task_name] * loss for task_name, loss in val_losses.items())
+            self.log(f"Epoch {epoch+1}/{epochs} | Train Loss: {avg_train_loss:.4f} | Val Loss: {val_loss:.4f} | "
+                     + " | ".join(f"{task_name}: {loss:.4f}" for task_name, loss in val_losses.items()))
+            train_history["epoch"].append(epoch+1)
+            train_history["train_loss"].append(avg_train_loss)
+            train_history["val_loss"].append(val_loss)
+            for task_name, loss in val_losses.items():
+                train_history[f"val_loss_{task_name}"].append(loss)
+
+            early_stopping(val_loss, self.model)
+            self._save_training_state("joint", epoch+1, early_stopping, scaler, train_loader, train_history)
+            if early_stopping.early_stop:
+                self.log(f"Early stopping triggered at epoch {epoch+1}")
+                break
+
+        self.checkpointer.wait()
+        if self.world_size > 1:
+            dist.barrier()      # the checkpoint is written by rank 0
+        self.model.load_state_dict(torch.load(early_stopping.checkpoint_path, map_location=self.device, weights_only=True))
+        self.log(f"[Info] Loaded best joint model from {early_stopping.checkpoint_path}")
+        self.activation_cache = None
+        if self.is_main_process:
+            self.save_loss_history(train_history, "joint")
+        self.log("Joint training completed!")
+
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Multi-task fine-tuning of AMP4multitask (sequential or joint)")
+    parser.add_argument("--model-root", default="amp4multitask")
+    parser.add_argument("--data-file", default="merged_data.json")
+    parser.add_argument("--save-dir", default="training_outputs")
+    parser.add_argument("--epochs", type=int, default=100, help="epochs per task")
+    parser.add_argument("--start-from", choices=["amp_classification", "bioactivity_classification", "half_life_regression",
+                                                 "hemolysis_regression", "mic_regression"])
+    parser.add_argument("--bucket-by-length", action="store_true", help="length-bucketed batches with dynamic padding")
+    parser.add_argument("--num-workers", type=int, default=0, help="data loader worker processes")
+    parser.add_argument("--pin-memory", action=argparse.BooleanOptionalAction, default=None,
+                        help="pin loader batches in page-locked memory (default: on when training on CUDA)")
+    parser.add_argument("--prefetch-factor", type=int, default=2, help="batches prefetched per worker")
+    parser.add_argument("--precision", choices=list(PRECISIONS), default="fp32",
+                        help="autocast precision (bf16 for CPU nodes with bf16 support, fp16 only on CUDA)")
+    parser.add_argument("--cache-frozen-activations", action="store_true",
+                        help="compute the frozen encoder layers once per sequence and train from the cached hidden states")
+    parser.add_argument("--joint", action="store_true", help="train all task heads jointly with task-mixed batches")
+    parser.add_argument("--temperature", type=float, default=1.0,
+                        help="joint task sampling temperature: 1 = proportional to task size, larger = closer to uniform")
+    parser.add_argument("--task-weights", default="",
+                        help="joint loss weights, e.g. mic_regression=2,amp_classification=0.5 (default 1 per task)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the latest training state in <save-dir>/checkpoints (mid-task)")
+    parser.add_argument("--keep-checkpoints", type=int, default=3, help="training states kept per task")
+    parser.add_argument("--batch-size", type=int, default=64, help="batch size per loader batch and process")
+    parser.add_argument("--accumulation-steps", type=int, default=1,
+                        help="batches per optimizer step (effective batch size = batch size * accumulation steps)")
+    parser.add_argument("--activation-checkpointing", action="store_true",
+                        help="recompute the trainable encoder layers in the backward pass to save activation memory")
+    parser.add_argument("--log-interval", type=int, default=50, help="steps between progress bar loss updates")
+    parser.add_argument("--compile", choices=COMPILE_MODES, default="none",
+                        help="compiled forward for single-task training and validation (auto: torch.compile, else TorchScript)")
+    parser.add_argument("--backend", default="gloo",
+                        help="torch.distributed backend when launched with torchrun (gloo for CPU nodes, nccl for GPUs)")
+    args = parser.parse_args()
+
     trainer = ampTrainer(
-        model_root="amp4multitask",
-        data_file="merged_data.json",
-        save_dir="training_outputs"
+        model_root=args.model_root,
+        data_file=args.data_file,
+        save_dir=args.save_dir,
+        bucket_by_length=args.bucket_by_length,
+        num_workers=args.num_workers,
+        pin_memory=args.pin_memory,
+        prefetch_factor=args.prefetch_factor,
+        precision=args.precision,
+        cache_frozen_activations=args.cache_frozen_activations,
+        backend=args.backend,
+        keep_checkpoints=args.keep_checkpoints,
+        batch_size=args.batch_size,
+        accumulation_steps=args.accumulation_steps,
+        activation_checkpointing=args.activation_checkpointing,
+        log_interval=args.log_interval,
+        compile_mode=args.compile
     )
     
-    trainer.train_all_tasks()
+    if args.joint:
+        weights = dict(item.split("=") for item in args.task_weights.split(",") if item)
+        trainer.train_joint(epochs=args.epochs, task_weights={task: float(w) for task, w in weights.items()},
+                            temperature=args.temperature, resume=args.resume)
+    else:
+        trainer.train_all_tasks(epochs_per_task=args.epochs, start_from=args.start_from, resume=args.resume)
+
+    if dist.is_initialized():
+        dist.destroy_process_group()
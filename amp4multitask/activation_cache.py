@@ -0,0 +1,173 @@
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from merged_dataloader import CACHE_DIR, TokenizedCollator, _cache_key, _tokenizer_digest, load_tokenized
+
+CACHE_DTYPES = {"fp16": (torch.float16, np.float16), "bf16": (torch.bfloat16, np.int16)}    # numpy has no bf16, its bits are stored as int16
+BUILD_BATCH_SIZE = 128
+
+class _StopForward(Exception):
+    pass
+
+class _Passthrough(nn.Module):
+    """stands in for a skipped encoder layer and returns its input in the layer's output structure"""
+    def __init__(self, returns_tuple):
+        super().__init__()
+        self.returns_tuple = returns_tuple
+
+    def forward(self, hidden_states=None, *args, **kwargs):
+        return (hidden_states,) if self.returns_tuple else hidden_states
+
+def _replace_hidden_states(args, kwargs, hidden_states):
+    if args:
+        return (hidden_states,) + tuple(args[1:]), kwargs
+    return args, dict(kwargs, hidden_states=hidden_states)
+
+def _frozen_digest(model, num_frozen_layers):
+    """hash of the frozen prefix weights, so the cache is rebuilt whenever they change"""
+    digest = hashlib.blake2b(digest_size=16)
+    modules = [model.amp.word_embeddings, model.amp.emb_layer_norm] + list(model.amp.layers[:num_frozen_layers])
+    for module in modules:
+        for name, tensor in module.state_dict().items():
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+class FrozenActivationCache:
+    """
+    Hidden states entering encoder layer num_frozen_layers, computed once per sequence by the frozen
+    prefix (word embeddings, emb_layer_norm and the first num_frozen_layers layers) and stored in a
+    memory-mapped fp16/bf16 file. Only the real tokens of each sequence are stored, back to back.
+
+    The encoder masks padded keys, so the hidden states of real tokens do not depend on how a batch is
+    padded and gather() can rebuild them for any batch width and padding side. The prefix runs in eval
+    mode, i.e. the cached activations carry no dropout noise from the frozen layers.
+    """
+    def __init__(self, path, metadata):
+        self.num_frozen_layers = metadata['num_frozen_layers']
+        self.returns_tuple = metadata['returns_tuple']
+        self.torch_dtype, np_dtype = CACHE_DTYPES[metadata['dtype']]
+        self.lengths = np.array(metadata['lengths'], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)[:-1]]).astype(np.int64)
+        self.hidden = np.memmap(path, dtype=np_dtype, mode='r', shape=(int(self.lengths.sum()), metadata['hidden_size']))
+
+    @classmethod
+    def load_or_build(cls, model, file_path, tokenizer, num_frozen_layers, dtype="fp16", cache_dir=CACHE_DIR):
+        """open the cache for this data file, tokenizer and frozen weights, building it on the first call"""
+        assert dtype in CACHE_DTYPES, f"Invalid cache dtype {dtype}, choose from {list(CACHE_DTYPES)}"
+        os.makedirs(cache_dir, exist_ok=True)
+        settings = f"{_cache_key(file_path, cache_dir)}:{_tokenizer_digest(tokenizer)}:{_frozen_digest(model, num_frozen_layers)}:{num_frozen_layers}:{dtype}"
+        key = hashlib.blake2b(settings.encode(), digest_size=16).hexdigest()
+        path = os.path.join(cache_dir, f"activations_{key}.bin")
+        meta_path = os.path.join(cache_dir, f"activations_{key}.json")
+        if not os.path.exists(meta_path):
+            cls._build(model, file_path, tokenizer, num_frozen_layers, dtype, path, meta_path)
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+        print(f"[Info] Using frozen activations of {len(metadata['lengths'])} sequences from {path}")
+        return cls(path, metadata)
+
+    @staticmethod
+    @torch.no_grad()
+    def _build(model, file_path, tokenizer, num_frozen_layers, dtype, path, meta_path):
+        input_ids, lengths = load_tokenized(file_path, tokenizer)
+        input_ids, lengths = torch.from_numpy(input_ids), torch.from_numpy(lengths)
+        offsets = torch.cumsum(lengths.long(), 0) - lengths.long()
+        torch_dtype, np_dtype = CACHE_DTYPES[dtype]
+        collator = TokenizedCollator(tokenizer.pad_token_id, tokenizer.padding_side, max_length=None)
+        device = next(model.parameters()).device
+        layers = model.amp.layers
+        captured = {}
+
+        def capture_input(module, args, kwargs):
+            captured['hidden'] = args[0] if args else kwargs['hidden_states']
+            raise _StopForward
+        def capture_output(module, args, output):
+            captured['returns_tuple'] = isinstance(output, tuple)
+
+        hooks = [layers[num_frozen_layers].register_forward_pre_hook(capture_input, with_kwargs=True),
+                 layers[num_frozen_layers - 1].register_forward_hook(capture_output)]
+        was_training = model.training
+        model.eval()
+        hidden_file = None
+        tmp_path = path + ".tmp"
+        try:
+            # sorted by length so that every batch is padded as little as possible
+            for batch_index in torch.split(torch.argsort(lengths, stable=True), BUILD_BATCH_SIZE):
+                batch = collator({'input_ids': input_ids[batch_index], 'length': lengths[batch_index]})
+                try:
+                    model.amp(input_ids=batch['input_ids'].to(device), attention_mask=batch['attention_mask'].to(device))
+                except _StopForward:
+                    pass
+                if hidden_file is None:
+                    hidden_size = captured['hidden'].shape[-1]
+                    hidden_file = np.memmap(tmp_path, dtype=np_dtype, mode='w+', shape=(int(lengths.sum()), hidden_size))
+                real_tokens = captured['hidden'][batch['attention_mask'].to(device).bool()].to(torch_dtype).cpu()
+                real_tokens = real_tokens.view(torch.int16) if dtype == "bf16" else real_tokens
+                start = 0
+                for seq, length in zip(batch_index.tolist(), lengths[batch_index].tolist()):
+                    hidden_file[offsets[seq]:offsets[seq] + length] = real_tokens[start:start + length].numpy()
+                    start += length
+            hidden_file.flush()
+            del hidden_file
+        finally:
+            for hook in hooks:
+                hook.remove()
+            model.train(was_training)
+
+        os.replace(tmp_path, path)
+        metadata = {
+            'num_frozen_layers': num_frozen_layers,
+            'returns_tuple': captured['returns_tuple'],
+            'dtype': dtype,
+            'hidden_size': hidden_size,
+            'lengths': lengths.tolist(),
+        }
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f)
+        print(f"[Info] Saved frozen activations of {len(lengths)} sequences to {path}")
+
+    def gather(self, sequence_index, attention_mask):
+        """
+        hidden states of a collated batch, laid out like its attention_mask (any width and padding side);
+        padded positions are zero
+        """
+        mask = attention_mask.bool().cpu()
+        lengths = self.lengths[sequence_index.numpy()]
+        # the k-th real token of every row comes from offset + k of its sequence
+        rank = torch.cumsum(mask.long(), 1) - 1
+        token_index = torch.from_numpy(self.offsets[sequence_index.numpy()]).unsqueeze(1) + rank
+        assert (mask.sum(1).numpy() == lengths).all(), "batch does not match the cached sequence lengths"
+        hidden = torch.zeros(mask.shape + (self.hidden.shape[1],), dtype=self.torch_dtype)
+        rows = torch.from_numpy(np.asarray(self.hidden[token_index[mask].numpy()]))
+        hidden[mask] = rows.view(self.torch_dtype)
+        return hidden
+
+    @contextmanager
+    def resume(self, model, hidden_states):
+        """
+        run the model forward from layer num_frozen_layers on hidden_states: the frozen layers are
+        swapped for passthroughs and the input of the first trainable layer is replaced by the cache
+        """
+        layers = model.amp.layers
+        frozen = [layers[i] for i in range(self.num_frozen_layers)]
+
+        def inject(module, args, kwargs):
+            incoming = args[0] if args else kwargs['hidden_states']
+            return _replace_hidden_states(args, kwargs, hidden_states.to(device=incoming.device, dtype=incoming.dtype))
+
+        hook = layers[self.num_frozen_layers].register_forward_pre_hook(inject, with_kwargs=True)
+        for i in range(self.num_frozen_layers):
+            layers[i] = _Passthrough(self.returns_tuple)
+        try:
+            yield
+        finally:
+            hook.remove()
+            for i, layer in enumerate(frozen):
+                layers[i] = layer
@@ -0,0 +1,576 @@
+"""
+CPU benchmarks for the multi-task trainer.
+
+Run next to Trainer.py (same layout as training, with the pretrained checkpoint in training_outputs/):
+    python benchmark.py padding --task amp_classification --max-batches 50
+    python benchmark.py loader --workers 0,2,4,8
+    python benchmark.py precision --task mic_regression --max-batches 20
+    python benchmark.py frozen_cache --task mic_regression --max-batches 50
+    python benchmark.py joint --max-batches 0
+    python benchmark.py memory --task mic_regression --settings 64x1,64x1+ckpt,16x4,16x4+ckpt
+    python benchmark.py step --task mic_regression --max-batches 100
+    python benchmark.py compile --tasks amp_classification,mic_regression --max-batches 20
+    python benchmark.py panel --max-batches 20
+    python benchmark.py embedding_cache --max-batches 20
+"""
+import os
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")    # benchmarks are for CPU nodes
+
+import re
+import sys
+import argparse
+import copy
+import json
+import time
+import itertools
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+
+from Trainer import NUM_FROZEN_LAYERS, ampTrainer
+from activation_cache import FrozenActivationCache
+from compilation import CompiledModel
+from merged_dataloader import PARAMS_FILE, build_dataloader, build_multitask_dataloader, load_preprocessed
+from predictor import ALL_ORGANISMS, AMPPredictor
+
+def run_train_steps(trainer, task_name, loader, max_batches=None):
+    """run training steps over the loader and measure time and token throughput"""
+    trainer.model.train()
+    steps = 0
+    real_tokens = 0
+    padded_tokens = 0
+    start = time.perf_counter()
+    for batch in loader:
+        loss = trainer._compute_loss(task_name, batch)
+        trainer.optimizer.zero_grad()
+        loss.backward()
+        trainer.optimizer.step()
+
+        real_tokens += int(batch['attention_mask'].sum())
+        padded_tokens += batch['attention_mask'].numel()
+        steps += 1
+        if max_batches and steps >= max_batches:
+            break
+    elapsed = time.perf_counter() - start
+    return {
+        'steps': steps,
+        'seconds': elapsed,
+        'step_ms': elapsed / max(steps, 1) * 1000,
+        'epoch_seconds': elapsed / max(steps, 1) * len(loader),
+        'tokens_per_second': real_tokens / elapsed,
+        'padded_tokens_per_second': padded_tokens / elapsed,
+        'padding_ratio': 1 - real_tokens / max(padded_tokens, 1)
+    }
+
+def print_report(title, results):
+    print(f"\n{title}")
+    print(f"{'setting':<20}{'steps':>8}{'step ms':>10}{'epoch s':>10}{'tokens/s':>12}{'padding':>10}")
+    for name, r in results.items():
+        print(f"{name:<20}{r['steps']:>8}{r['step_ms']:>10.1f}{r['epoch_seconds']:>10.1f}"
+              f"{r['tokens_per_second']:>12.0f}{r['padding_ratio']:>10.1%}")
+
+def bench_padding(trainer, args):
+    """fixed padding to 128 tokens vs length-bucketed batches with dynamic padding"""
+    results = {}
+    for name, bucket_by_length in [("fixed_128", False), ("length_bucketed", True)]:
+        train_loader, _, _ = build_dataloader(
+            args.data_file, args.task, trainer.batch_size, trainer.tokenizer, bucket_by_length=bucket_by_length
+        )
+        results[name] = run_train_steps(trainer, args.task, train_loader, args.max_batches)
+    print_report(f"Padding benchmark ({args.task}, batch size {trainer.batch_size}, CPU)", results)
+    return results
+
+def bench_loader(trainer, args):
+    """loader-only throughput (batch fetch + collation, no model) for each worker count"""
+    results = {}
+    for num_workers in args.workers:
+        train_loader, _, _ = build_dataloader(
+            args.data_file, args.task, trainer.batch_size, trainer.tokenizer, bucket_by_length=args.bucket_by_length,
+            num_workers=num_workers, pin_memory=args.pin_memory
+        )
+        epochs = []
+        for _ in range(args.loader_epochs):
+            batches = samples = 0
+            start = time.perf_counter()
+            first_batch = None
+            for batch in train_loader:
+                if first_batch is None:
+                    first_batch = time.perf_counter() - start
+                batches += 1
+                samples += len(batch['label'])
+            epochs.append((time.perf_counter() - start, first_batch, batches, samples))
+        # the first epoch pays for worker start-up; later epochs reuse the persistent workers
+        seconds, _, batches, samples = epochs[-1]
+        results[f"workers={num_workers}"] = {
+            'startup_ms': epochs[0][1] * 1000,
+            'epoch_seconds': seconds,
+            'batches_per_second': batches / seconds,
+            'samples_per_second': samples / seconds,
+        }
+        del train_loader
+
+    print(f"\nLoader benchmark ({args.task}, batch size {trainer.batch_size}, "
+          f"{'bucketed' if args.bucket_by_length else 'fixed 128'}, pin_memory={args.pin_memory})")
+    print(f"{'setting':<20}{'startup ms':>12}{'epoch s':>10}{'batches/s':>12}{'samples/s':>12}")
+    for name, r in results.items():
+        print(f"{name:<20}{r['startup_ms']:>12.1f}{r['epoch_seconds']:>10.2f}"
+              f"{r['batches_per_second']:>12.1f}{r['samples_per_second']:>12.0f}")
+    return results
+
+def bench_precision(trainer, args):
+    """fp32 vs bf16 autocast: training steps on the same batches from the same weights, then validation loss"""
+    model_state = copy.deepcopy(trainer.model.state_dict())
+    optimizer_state = copy.deepcopy(trainer.optimizer.state_dict())
+    results = {}
+    for precision in args.precisions:
+        trainer.model.load_state_dict(model_state)
+        trainer.optimizer.load_state_dict(optimizer_state)
+        trainer.precision = precision
+        train_loader, val_loader, _ = build_dataloader(
+            args.data_file, args.task, trainer.batch_size, trainer.tokenizer, bucket_by_length=trainer.bucket_by_length
+        )
+        torch.manual_seed(0)
+        results[precision] = run_train_steps(trainer, args.task, train_loader, args.max_batches)
+        start = time.perf_counter()
+        results[precision]['val_loss'] = trainer.validate(val_loader, args.task)
+        results[precision]['val_seconds'] = time.perf_counter() - start
+    trainer.model.load_state_dict(model_state)
+    trainer.optimizer.load_state_dict(optimizer_state)
+    trainer.precision = "fp32"
+
+    print_report(f"Precision benchmark ({args.task}, batch size {trainer.batch_size}, CPU)", results)
+    baseline = results[args.precisions[0]]
+    print(f"{'setting':<20}{'val loss':>10}{'vs ' + args.precisions[0]:>12}{'val s':>10}{'step speedup':>14}")
+    for name, r in results.items():
+        print(f"{name:<20}{r['val_loss']:>10.4f}{r['val_loss'] - baseline['val_loss']:>+12.4f}"
+              f"{r['val_seconds']:>10.2f}{baseline['step_ms'] / r['step_ms']:>13.2f}x")
+    return results
+
+def bench_frozen_cache(trainer, args):
+    """full forward through the frozen layers vs resuming from cached frozen-prefix activations"""
+    results = {}
+    for name, cached in [("full_forward", False), ("cached_prefix", True)]:
+        train_loader, _, _ = build_dataloader(
+            args.data_file, args.task, trainer.batch_size, trainer.tokenizer, bucket_by_length=trainer.bucket_by_length
+        )
+        if cached:
+            start = time.perf_counter()
+            trainer.activation_cache = FrozenActivationCache.load_or_build(
+                trainer.model, args.data_file, trainer.tokenizer, NUM_FROZEN_LAYERS, trainer.activation_cache_dtype
+            )
+            print(f"[Info] activation cache ready in {time.perf_counter() - start:.1f}s")
+        results[name] = run_train_steps(trainer, args.task, train_loader, args.max_batches)
+    trainer.activation_cache = None
+    print_report(f"Frozen-prefix cache benchmark ({args.task}, {NUM_FROZEN_LAYERS} frozen layers, CPU)", results)
+    return results
+
+def bench_joint(trainer, args):
+    """one epoch of every task trained sequentially vs one epoch of joint training with task-mixed batches"""
+    tasks = trainer.task_order
+    weights = {task_name: 1.0 for task_name in tasks}
+    model_state = copy.deepcopy(trainer.model.state_dict())
+    results = {}
+
+    sequential = {'seconds': 0.0, 'steps': 0, 'labels': 0}
+    for task_name in tasks:
+        train_loader, _, _ = build_dataloader(args.data_file, task_name, trainer.batch_size, trainer.tokenizer)
+        r = run_train_steps(trainer, task_name, train_loader, args.max_batches)
+        sequential['seconds'] += r['seconds']
+        sequential['steps'] += r['steps']
+        sequential['labels'] += min(r['steps'] * trainer.batch_size, len(train_loader.dataset))
+    results['sequential'] = sequential
+
+    trainer.model.load_state_dict(model_state)
+    for param in trainer.model.parameters():
+        param.requires_grad = True
+    trainer.freeze_encoder_layers(NUM_FROZEN_LAYERS)
+    train_loader, _ = build_multitask_dataloader(args.data_file, trainer.batch_size, trainer.tokenizer, tasks,
+                                                 temperature=args.temperature)
+    trainer.model.train()
+    joint = {'seconds': 0.0, 'steps': 0, 'labels': 0}
+    start = time.perf_counter()
+    for batch in train_loader:
+        loss, _ = trainer._compute_joint_loss(batch, weights)
+        trainer.optimizer.zero_grad()
+        loss.backward()
+        trainer.optimizer.step()
+        joint['steps'] += 1
+        joint['labels'] += sum(len(task_batch['rows']) for task_batch in batch['tasks'].values())
+        if args.max_batches and joint['steps'] >= args.max_batches * len(tasks):
+            break
+    joint['seconds'] = time.perf_counter() - start
+    results['joint'] = joint
+    trainer.model.load_state_dict(model_state)
+
+    print(f"\nJoint vs sequential training ({len(tasks)} tasks, batch size {trainer.batch_size}, CPU)")
+    print(f"{'setting':<20}{'steps':>8}{'seconds':>10}{'labels':>10}{'labels/s':>12}")
+    for name, r in results.items():
+        print(f"{name:<20}{r['steps']:>8}{r['seconds']:>10.1f}{r['labels']:>10}{r['labels'] / r['seconds']:>12.0f}")
+    return results
+
+class SavedTensorMeter:
+    """bytes of the tensors autograd keeps for the backward pass during a forward, parameters excluded"""
+    def __init__(self, model):
+        self.parameters = {param.untyped_storage().data_ptr() for param in model.parameters()}
+        self.peak_bytes = 0
+
+    def __enter__(self):
+        self.storages = set()
+        self.bytes = 0
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, lambda tensor: tensor)
+        self.hooks.__enter__()
+        return self
+
+    def _pack(self, tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in self.parameters and storage.data_ptr() not in self.storages:
+            self.storages.add(storage.data_ptr())
+            self.bytes += storage.nbytes()
+        return tensor
+
+    def __exit__(self, *exc_info):
+        self.hooks.__exit__(*exc_info)
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+        self.storages = None
+
+def parse_memory_setting(setting):
+    """'<batch size>x<accumulation steps>[+ckpt]', e.g. 16x4+ckpt"""
+    match = re.fullmatch(r"(\d+)x(\d+)(\+ckpt)?", setting)
+    assert match, f"Invalid setting {setting}, expected e.g. 64x1 or 16x4+ckpt"
+    return int(match.group(1)), int(match.group(2)), match.group(3) is not None
+
+def run_accumulated_steps(trainer, task_name, loader, max_steps=None):
+    """optimizer steps with the trainer's gradient accumulation; time, samples and saved activations"""
+    num_batches = min(len(loader), max_steps * trainer.accumulation_steps) if max_steps else len(loader)
+    scaler = trainer.grad_scaler()
+    meter = SavedTensorMeter(trainer.model)
+    trainer.model.train()
+    trainer.optimizer.zero_grad()
+    steps = samples = 0
+    start = time.perf_counter()
+    for step, batch in enumerate(loader):
+        if step >= num_batches:
+            break
+        group_size, boundary = trainer._accumulation_group(step, num_batches)
+        with meter:
+            loss = trainer._compute_loss(task_name, batch)
+        scaler.scale(loss / group_size).backward()
+        if boundary:
+            trainer._optimizer_step(scaler)
+            steps += 1
+        samples += len(batch['label'])
+    elapsed = time.perf_counter() - start
+    return {
+        'steps': steps,
+        'step_ms': elapsed / max(steps, 1) * 1000,
+        'samples_per_second': samples / elapsed,
+        'saved_activation_mb': meter.peak_bytes / 2**20,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def bench_memory(trainer, args):
+    """
+    micro-batch size x gradient accumulation steps, with and without activation checkpointing: optimizer
+    step time, throughput, activations kept for backward per micro-batch and peak RSS. Every setting runs
+    in a fresh process so that the peak RSS is its own.
+    """
+    if args.in_process:
+        batch_size, accumulation_steps, activation_checkpointing = parse_memory_setting(args.settings[0])
+        trainer.batch_size = batch_size
+        trainer.accumulation_steps = accumulation_steps
+        if activation_checkpointing:
+            trainer.enable_activation_checkpointing()
+        train_loader, _, _ = build_dataloader(
+            args.data_file, args.task, batch_size, trainer.tokenizer, bucket_by_length=trainer.bucket_by_length
+        )
+        result = run_accumulated_steps(trainer, args.task, train_loader, args.max_batches)
+        print("RESULT " + json.dumps(result))
+        return result
+
+    results = {}
+    for setting in args.settings:
+        command = [sys.executable, os.path.abspath(__file__), "memory", "--in-process", "--settings", setting,
+                   "--task", args.task, "--max-batches", str(args.max_batches), "--model-root", args.model_root,
+                   "--data-file", args.data_file, "--save-dir", args.save_dir]
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        results[setting] = json.loads(output.rsplit("RESULT ", 1)[1])
+
+    print(f"\nMemory benchmark ({args.task}, {args.max_batches or 'all'} optimizer steps per setting, CPU)")
+    print(f"{'setting':<20}{'effective':>10}{'steps':>8}{'step ms':>10}{'samples/s':>12}{'saved MB':>10}{'peak RSS MB':>13}")
+    for setting, r in results.items():
+        batch_size, accumulation_steps, _ = parse_memory_setting(setting)
+        print(f"{setting:<20}{batch_size * accumulation_steps:>10}{r['steps']:>8}{r['step_ms']:>10.1f}"
+              f"{r['samples_per_second']:>12.0f}{r['saved_activation_mb']:>10.1f}{r['peak_rss_mb']:>13.0f}")
+    return results
+
+class LimitedLoader:
+    """the first max_batches batches of a loader (all of them for 0), with a matching len()"""
+    def __init__(self, loader, max_batches):
+        self.loader = loader
+        self.max_batches = max_batches
+
+    def __iter__(self):
+        return itertools.islice(iter(self.loader), len(self))
+
+    def __len__(self):
+        return min(len(self.loader), self.max_batches) if self.max_batches else len(self.loader)
+
+LEGACY_LOSS_FUNCTIONS = {
+    "amp_classification": nn.CrossEntropyLoss,
+    "bioactivity_classification": nn.BCEWithLogitsLoss,
+    "half_life_regression": nn.MSELoss,
+    "hemolysis_regression": nn.MSELoss,
+    "mic_regression": lambda: nn.HuberLoss(delta=1.0),
+}
+
+def legacy_epoch(trainer, task_name, loader, scaler):
+    """the training loop before _train_epoch: a loss module per step, loss read back and allocator flushed every step"""
+    total_loss = 0.0
+    train_steps = 0
+    progress_bar = tqdm(loader)
+    for batch in progress_bar:
+        trainer.loss_functions[task_name] = LEGACY_LOSS_FUNCTIONS[task_name]()
+        loss = trainer._compute_loss(task_name, batch)
+
+        trainer.optimizer.zero_grad(set_to_none=False)
+        scaler.scale(loss).backward()
+        scaler.unscale_(trainer.optimizer)
+        torch.nn.utils.clip_grad_norm_(trainer.model.parameters(), 1.0)
+        scaler.step(trainer.optimizer)
+        scaler.update()
+
+        total_loss += loss.item()
+        train_steps += 1
+        avg_train_loss = total_loss / train_steps
+        progress_bar.set_postfix({'loss': round(avg_train_loss, 4)})
+
+        del loss, avg_train_loss
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    return total_loss / len(loader)
+
+def bench_step(trainer, args):
+    """
+    per-step overhead of the training loop: the legacy loop vs the lean _train_epoch on the same batches and
+    weights, alternating args.repeats times and keeping the fastest run of each
+    """
+    model_state = copy.deepcopy(trainer.model.state_dict())
+    optimizer_state = copy.deepcopy(trainer.optimizer.state_dict())
+    loss_function = trainer.loss_functions[args.task]
+    results = {}
+    for _, name in itertools.product(range(args.repeats), ["legacy", "lean"]):
+        trainer.model.load_state_dict(model_state)
+        trainer.optimizer.load_state_dict(optimizer_state)
+        train_loader, _, _ = build_dataloader(
+            args.data_file, args.task, trainer.batch_size, trainer.tokenizer, bucket_by_length=trainer.bucket_by_length
+        )
+        loader = LimitedLoader(train_loader, args.max_batches)
+        scaler = trainer.grad_scaler()
+        trainer.model.train()
+        trainer.optimizer.zero_grad(set_to_none=True)
+        start = time.perf_counter()
+        if name == "legacy":
+            train_loss = legacy_epoch(trainer, args.task, loader, scaler)
+        else:
+            train_loss = trainer._train_epoch(loader, lambda batch: trainer._compute_loss(args.task, batch),
+                                              trainer.model, scaler, desc=name)
+        elapsed = time.perf_counter() - start
+        trainer.loss_functions[args.task] = loss_function
+        if name not in results or elapsed < results[name]['seconds']:
+            results[name] = {'steps': len(loader), 'seconds': elapsed, 'step_ms': elapsed / len(loader) * 1000,
+                             'train_loss': train_loss}
+    trainer.model.load_state_dict(model_state)
+    trainer.optimizer.load_state_dict(optimizer_state)
+
+    print(f"\nTraining step benchmark ({args.task}, batch size {trainer.batch_size}, best of {args.repeats}, CPU)")
+    print(f"{'setting':<20}{'steps':>8}{'step ms':>10}{'train loss':>12}{'speedup':>10}")
+    for name, r in results.items():
+        print(f"{name:<20}{r['steps']:>8}{r['step_ms']:>10.2f}{r['train_loss']:>12.4f}"
+              f"{results['legacy']['step_ms'] / r['step_ms']:>9.2f}x")
+    return results
+
+def run_compiled_pass(trainer, task_name, model, loader, train):
+    """one pass over loader through model (inference or training steps); seconds and samples"""
+    trainer.model.train(train)
+    samples = 0
+    start = time.perf_counter()
+    with torch.set_grad_enabled(train):
+        for batch in loader:
+            loss = trainer._compute_loss(task_name, batch, model)
+            if train:
+                loss.backward()
+                trainer.optimizer.step()
+                trainer.optimizer.zero_grad(set_to_none=True)
+            else:
+                loss.item()
+            samples += len(batch['label'])
+    return time.perf_counter() - start, samples
+
+def bench_compile(trainer, args):
+    """
+    eager vs torch.compile vs TorchScript for each task head: warm-up (compile) time, inference throughput and
+    training step time on the same fixed-128 batches and starting weights
+    """
+    model_state = copy.deepcopy(trainer.model.state_dict())
+    optimizer_state = copy.deepcopy(trainer.optimizer.state_dict())
+    results = {}
+    for task_name in args.tasks:
+        trainer.model.set_train_mode(task_name)
+        trainer.freeze_encoder_layers(NUM_FROZEN_LAYERS)
+        train_loader, _, _ = build_dataloader(args.data_file, task_name, trainer.batch_size, trainer.tokenizer)
+        loader = LimitedLoader(train_loader, args.max_batches)
+        for mode in args.compile_modes:
+            trainer.model.load_state_dict(model_state)
+            trainer.optimizer.load_state_dict(optimizer_state)
+            model = trainer.model if mode == "none" else CompiledModel(
+                trainer.model, trainer.tokenizer.pad_token_id, trainer.tokenizer.padding_side, mode=mode
+            )
+            # the first pass compiles / traces a graph for every batch shape, the second one is timed
+            timings = {}
+            for train in (False, True):
+                warmup, _ = run_compiled_pass(trainer, task_name, model, loader, train)
+                seconds, samples = run_compiled_pass(trainer, task_name, model, loader, train)
+                timings[train] = (warmup, seconds, samples)
+            (infer_warmup, infer_seconds, infer_samples), (train_warmup, train_seconds, _) = timings[False], timings[True]
+            results[f"{task_name}/{mode}"] = {
+                'warmup_seconds': infer_warmup + train_warmup,
+                'inference_batch_ms': infer_seconds / len(loader) * 1000,
+                'inference_samples_per_second': infer_samples / infer_seconds,
+                'train_step_ms': train_seconds / len(loader) * 1000,
+            }
+    trainer.model.load_state_dict(model_state)
+    trainer.optimizer.load_state_dict(optimizer_state)
+    trainer.model.set_train_mode(args.task)
+
+    print(f"\nCompile benchmark (batch size {trainer.batch_size}, fixed 128 padding, {len(loader)} batches, CPU)")
+    print(f"{'setting':<40}{'warm-up s':>11}{'infer ms':>10}{'samples/s':>11}{'step ms':>10}{'infer x':>9}{'step x':>8}")
+    for name, r in results.items():
+        eager = results[f"{name.split('/')[0]}/{args.compile_modes[0]}"]
+        print(f"{name:<40}{r['warmup_seconds']:>11.1f}{r['inference_batch_ms']:>10.1f}"
+              f"{r['inference_samples_per_second']:>11.0f}{r['train_step_ms']:>10.1f}"
+              f"{eager['inference_batch_ms'] / r['inference_batch_ms']:>8.2f}x"
+              f"{eager['train_step_ms'] / r['train_step_ms']:>7.2f}x")
+    return results
+
+def bench_panel(trainer, args):
+    """MIC against all organisms: one full forward per organism vs the panel (one encoder pass per batch)"""
+    predictor = AMPPredictor(trainer.model, trainer.tokenizer, norm_params_path=PARAMS_FILE, device=trainer.device,
+                             batch_size=trainer.batch_size)
+    sequences = [sequence.decode() for sequence in load_preprocessed(args.data_file)['sequences']]
+    sequences = sequences[:args.max_batches * trainer.batch_size] if args.max_batches else sequences
+    results = {}
+    panels = {}
+    for name in ["per_organism", "panel"]:
+        start = time.perf_counter()
+        if name == "per_organism":
+            panels[name] = np.stack([predictor.predict_mic_panel(sequences, [organism]).reshape(-1)
+                                     for organism in ALL_ORGANISMS], axis=1)
+        else:
+            panels[name] = predictor.predict_mic_panel(sequences, ALL_ORGANISMS)
+        elapsed = time.perf_counter() - start
+        results[name] = {'seconds': elapsed, 'sequences_per_second': len(sequences) / elapsed}
+    results['panel']['max_relative_difference'] = float(np.max(np.abs(panels['panel'] / panels['per_organism'] - 1)))
+
+    print(f"\nMIC panel benchmark ({len(sequences)} sequences x {len(ALL_ORGANISMS)} organisms, "
+          f"batch size {trainer.batch_size}, CPU)")
+    print(f"{'setting':<20}{'seconds':>10}{'seqs/s':>10}{'speedup':>10}")
+    for name, r in results.items():
+        print(f"{name:<20}{r['seconds']:>10.2f}{r['sequences_per_second']:>10.1f}"
+              f"{results['per_organism']['seconds'] / r['seconds']:>9.2f}x")
+    print(f"max relative difference of the panel MIC: {results['panel']['max_relative_difference']:.2e}")
+    return results
+
+def bench_embedding_cache(trainer, args):
+    """
+    prediction of all tasks and organisms without the embedding cache, with a cold cache, after reopening
+    it (disk hits) and on a second pass (memory hits)
+    """
+    sequences = [sequence.decode() for sequence in load_preprocessed(args.data_file)['sequences']]
+    sequences = sequences[:args.max_batches * trainer.batch_size] if args.max_batches else sequences
+    options = {'norm_params_path': PARAMS_FILE, 'device': trainer.device, 'batch_size': trainer.batch_size}
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        predictors = {"uncached": AMPPredictor(trainer.model, trainer.tokenizer, **options)}
+        predictors["cold_cache"] = AMPPredictor(trainer.model, trainer.tokenizer, embedding_cache=cache_dir,
+                                                cache_memory_entries=len(sequences), **options)
+        predictions = {}
+        for name in ["uncached", "cold_cache", "disk_hits", "memory_hits"]:
+            if name == "disk_hits":
+                predictors[name] = AMPPredictor(trainer.model, trainer.tokenizer, embedding_cache=cache_dir,
+                                                cache_memory_entries=len(sequences), **options)
+            predictor = predictors["disk_hits" if name == "memory_hits" else name]
+            start = time.perf_counter()
+            predictions[name] = predictor.predict_arrays(sequences, organisms=ALL_ORGANISMS)
+            elapsed = time.perf_counter() - start
+            results[name] = {'seconds': elapsed, 'sequences_per_second': len(sequences) / elapsed}
+            if predictor.embedding_cache is not None:
+                metrics = predictor.embedding_cache.metrics()
+                results[name] |= {'hit_rate': metrics['hit_rate'], 'storage_mb': metrics['storage_bytes'] / 2**20}
+            results[name]['max_relative_difference'] = max(
+                float(np.max(np.abs(values / predictions["uncached"][column] - 1)))
+                for column, values in predictions[name].items()
+            )
+
+    print(f"\nEmbedding cache benchmark ({len(sequences)} sequences, all tasks and organisms, "
+          f"batch size {trainer.batch_size}, CPU)")
+    print(f"{'setting':<20}{'seconds':>10}{'seqs/s':>10}{'hit rate':>10}{'storage MB':>12}{'max rel diff':>14}{'speedup':>10}")
+    for name, r in results.items():
+        print(f"{name:<20}{r['seconds']:>10.2f}{r['sequences_per_second']:>10.1f}{r.get('hit_rate', 0):>10.1%}"
+              f"{r.get('storage_mb', 0):>12.1f}{r['max_relative_difference']:>14.2e}"
+              f"{results['uncached']['seconds'] / r['seconds']:>9.2f}x")
+    return results
+
+BENCHMARKS = {
+    "padding": bench_padding,
+    "loader": bench_loader,
+    "precision": bench_precision,
+    "frozen_cache": bench_frozen_cache,
+    "joint": bench_joint,
+    "memory": bench_memory,
+    "step": bench_step,
+    "compile": bench_compile,
+    "panel": bench_panel,
+    "embedding_cache": bench_embedding_cache,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CPU benchmarks for amp4multitask training")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--task", default="amp_classification")
+    parser.add_argument("--model-root", default="amp4multitask")
+    parser.add_argument("--data-file", default="merged_data.json")
+    parser.add_argument("--save-dir", default="training_outputs")
+    parser.add_argument("--max-batches", type=int, default=50, help="steps per setting (0 = full epoch)")
+    parser.add_argument("--workers", type=lambda text: [int(n) for n in text.split(",")], default=[0, 2, 4],
+                        help="loader benchmark: comma-separated worker counts")
+    parser.add_argument("--loader-epochs", type=int, default=2, help="loader benchmark: epochs per worker count")
+    parser.add_argument("--bucket-by-length", action="store_true", help="loader benchmark: length-bucketed batches")
+    parser.add_argument("--pin-memory", action="store_true", help="loader benchmark: pinned batches")
+    parser.add_argument("--precisions", type=lambda text: text.split(","), default=["fp32", "bf16"],
+                        help="precision benchmark: comma-separated precisions, the first one is the baseline")
+    parser.add_argument("--temperature", type=float, default=1.0, help="joint benchmark: task sampling temperature")
+    parser.add_argument("--settings", type=lambda text: text.split(","), default=["64x1", "64x1+ckpt", "16x4", "16x4+ckpt"],
+                        help="memory benchmark: comma-separated <batch size>x<accumulation steps>[+ckpt]")
+    parser.add_argument("--in-process", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--repeats", type=int, default=3, help="step benchmark: alternating runs per setting")
+    parser.add_argument("--tasks", type=lambda text: text.split(","),
+                        default=["amp_classification", "bioactivity_classification", "half_life_regression",
+                                 "hemolysis_regression", "mic_regression"],
+                        help="compile benchmark: comma-separated task heads")
+    parser.add_argument("--compile-modes", type=lambda text: text.split(","), default=["none", "compile", "torchscript"],
+                        help="compile benchmark: comma-separated modes, the first one is the baseline")
+    parser.add_argument("--output", help="optional JSON file for the results")
+    args = parser.parse_args()
+
+    trainer = ampTrainer(model_root=args.model_root, data_file=args.data_file, save_dir=args.save_dir)
+    trainer.model.set_train_mode(args.task)
+    trainer.freeze_encoder_layers(NUM_FROZEN_LAYERS)
+    results = BENCHMARKS[args.benchmark](trainer, args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,112 @@
+import os
+import re
+import json
+import glob
+import random
+import threading
+
+import numpy as np
+import torch
+
+LATEST_FILE = "latest.json"
+
+def snapshot(obj):
+    """copy of a (nested) state dict with every tensor cloned to CPU, safe to write while training goes on"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+def rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+class AsyncCheckpointer:
+    """
+    Writes checkpoints from a background thread. save() takes a CPU snapshot of the state on the calling
+    thread (a memory copy) and returns; serialization and disk I/O happen in the background. At most one
+    write is in flight: the next save() waits for the previous one. Every file is written to a temporary
+    path and renamed into place, so an interrupted run never leaves a truncated checkpoint behind.
+
+    Training-state checkpoints go to checkpoint_dir as <name>_epoch<N>.pth, only the last keep_last of
+    every name are kept, and latest.json points to the most recent one.
+    """
+    def __init__(self, checkpoint_dir, keep_last=3, enabled=True):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.enabled = enabled      # False on the ranks that do not write (distributed training)
+        self._thread = None
+        self._error = None
+        if enabled:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def save(self, state, path, on_written=None):
+        """write state to path in the background; on_written runs on the writer thread after the rename"""
+        if not self.enabled:
+            return
+        state = snapshot(state)
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(state, path, on_written), daemon=True)
+        self._thread.start()
+
+    def _write(self, state, path, on_written):
+        try:
+            tmp_path = path + ".tmp"
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+            if on_written is not None:
+                on_written(path)
+        except Exception as e:
+            self._error = e
+
+    def wait(self):
+        """block until the pending write is on disk; re-raises a failed write"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("[Error] Writing checkpoint failed") from error
+
+    def save_training_state(self, state, name, epoch):
+        """full training state after epoch (1-based) of name (a task or 'joint')"""
+        path = os.path.join(self.checkpoint_dir, f"{name}_epoch{epoch:03d}.pth")
+        self.save(state, path, on_written=lambda written: self._rotate(name, written))
+
+    def _rotate(self, name, written):
+        checkpoints = sorted(glob.glob(os.path.join(self.checkpoint_dir, f"{glob.escape(name)}_epoch*.pth")),
+                             key=lambda path: int(re.search(r"_epoch(\d+)\.pth$", path).group(1)))
+        for path in checkpoints[:-self.keep_last] if self.keep_last > 0 else []:
+            os.remove(path)
+        latest_path = os.path.join(self.checkpoint_dir, LATEST_FILE)
+        with open(latest_path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump({'name': name, 'path': os.path.basename(written)}, f)
+        os.replace(latest_path + ".tmp", latest_path)
+
+    def load_latest(self, map_location=None):
+        """the most recent training state written to checkpoint_dir, or None"""
+        latest_path = os.path.join(self.checkpoint_dir, LATEST_FILE)
+        if not os.path.exists(latest_path):
+            return None
+        with open(latest_path, 'r', encoding='utf-8') as f:
+            path = os.path.join(self.checkpoint_dir, json.load(f)['path'])
+        # the state holds numpy and python RNG states besides tensors
+        state = torch.load(path, map_location=map_location, weights_only=False)
+        print(f"[Info] Resuming from {path}")
+        return state
@@ -0,0 +1,102 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from transformers.modeling_outputs import SequenceClassifierOutput
+
+COMPILE_MODES = ["none", "auto", "compile", "torchscript"]
+SHAPE_BUCKET = 16       # batch widths are padded up to a multiple of this, so a task has at most 128 / 16 graphs
+RECOMPILE_LIMIT = 128   # graphs per code object kept by torch.compile (one per task, mode and bucketed shape)
+
+def compile_available():
+    return hasattr(torch, "compile")
+
+def _raise_recompile_limit(limit):
+    config = torch._dynamo.config
+    name = "recompile_limit" if hasattr(config, "recompile_limit") else "cache_size_limit"
+    setattr(config, name, max(getattr(config, name), limit))
+
+class _TaskForward(nn.Module):
+    """the forward of one task head with tensor-only inputs and outputs, as torch.compile and TorchScript need"""
+    def __init__(self, model, task_name):
+        super().__init__()
+        self.model = model
+        self.task_name = task_name
+
+    def forward(self, input_ids, attention_mask, organism_ids=None):
+        return self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            task_name=self.task_name,
+            organism_ids=organism_ids,
+            return_dict=True
+            ).logits
+
+class CompiledModel(nn.Module):
+    """
+    Drop-in replacement for calling AMPForMultiTask(input_ids=..., attention_mask=..., task_name=...,
+    organism_ids=...) that runs a compiled graph of the task head.
+
+    Batches are padded to a multiple of SHAPE_BUCKET tokens (on the tokenizer's padding side, masked out)
+    and a graph is kept per task, train/eval mode of model and bucketed batch shape. mode "compile" uses
+    torch.compile, "torchscript" traces the forward with torch.jit.trace, and "auto" uses torch.compile
+    and falls back to TorchScript if it is unavailable or fails to compile. The compiled graphs share the
+    parameters of model, so training and checkpoints work on model as usual.
+
+    TorchScript graphs are traced in fp32 and do not keep activation checkpointing or autocast.
+    """
+    def __init__(self, model, pad_token_id, padding_side="right", mode="auto", bucket=SHAPE_BUCKET):
+        super().__init__()
+        assert mode in COMPILE_MODES[1:], f"Invalid compile mode {mode}, choose from {COMPILE_MODES[1:]}"
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.padding_side = padding_side
+        self.bucket = bucket
+        self.backend = "torchscript" if mode == "torchscript" or not compile_available() else "compile"
+        self.fallback = mode == "auto"
+        self._task_forwards = {}    # task -> _TaskForward, not registered so that parameters are not duplicated
+        self._graphs = {}           # (task, training, shape) -> compiled callable
+
+    def _pad_to_bucket(self, input_ids, attention_mask):
+        width = input_ids.shape[1]
+        extra = math.ceil(width / self.bucket) * self.bucket - width
+        if extra == 0:
+            return input_ids, attention_mask
+        padding = (extra, 0) if self.padding_side == "left" else (0, extra)
+        return F.pad(input_ids, padding, value=self.pad_token_id), F.pad(attention_mask, padding, value=0)
+
+    def _graph(self, task_name, inputs):
+        # the trainer switches model.train() / model.eval(), not this wrapper
+        key = (task_name, self.model.training, tuple(inputs[0].shape), inputs[2] is None)
+        if key in self._graphs:
+            return self._graphs[key]
+        if task_name not in self._task_forwards:
+            self._task_forwards[task_name] = _TaskForward(self.model, task_name)
+        task_forward = self._task_forwards[task_name]
+        if self.backend == "compile":
+            _raise_recompile_limit(RECOMPILE_LIMIT)
+            # torch.compile keeps its own graph per guarded shape; one compiled wrapper per task is enough
+            compiled = [graph for (task, *_), graph in self._graphs.items() if task == task_name]
+            graph = compiled[0] if compiled else torch.compile(task_forward, dynamic=False)
+        else:
+            example = inputs if inputs[2] is not None else inputs[:2]
+            with torch.no_grad():
+                graph = torch.jit.trace(task_forward, example, check_trace=False)
+        self._graphs[key] = graph
+        return graph
+
+    def forward(self, input_ids=None, attention_mask=None, task_name=None, organism_ids=None, return_dict=True):
+        input_ids, attention_mask = self._pad_to_bucket(input_ids, attention_mask)
+        inputs = (input_ids, attention_mask, organism_ids)
+        graph = self._graph(task_name, inputs)
+        try:
+            logits = graph(*inputs) if organism_ids is not None else graph(input_ids, attention_mask)
+        except Exception as e:
+            if not (self.fallback and self.backend == "compile"):
+                raise
+            print(f"[Warning] torch.compile failed ({type(e).__name__}: {e}), falling back to TorchScript")
+            self.backend = "torchscript"
+            self._graphs.clear()
+            return self.forward(input_ids, attention_mask, task_name, organism_ids, return_dict)
+        return SequenceClassifierOutput(logits=logits)
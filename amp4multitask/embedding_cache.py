@@ -0,0 +1,195 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from transformers.modeling_outputs import BaseModelOutputWithPooling
+
+from merged_dataloader import _tokenizer_digest
+
+EMBEDDING_CACHE_DIR = "embedding_cache"
+INDEX_FILE = "index.jsonl"
+METRICS_FILE = "metrics.json"
+
+def _tensor_bytes(tensor):
+    tensor = tensor.int_repr() if tensor.is_quantized else tensor
+    return tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes()
+
+def encoder_digest(model):
+    """hash of the encoder weights (fp32 or int8); task heads do not change the embeddings"""
+    digest = hashlib.blake2b(digest_size=16)
+    for name, value in model.amp.state_dict().items():
+        digest.update(name.encode())
+        for tensor in value if isinstance(value, tuple) else (value,):
+            if isinstance(tensor, torch.Tensor):
+                digest.update(_tensor_bytes(tensor))
+    return digest.hexdigest()
+
+def sequence_key(sequence):
+    return hashlib.blake2b(sequence.encode(), digest_size=16).hexdigest()
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed cache of encoder outputs for inference.
+
+    Entries are keyed by the sequence and live in a directory keyed by the encoder weights and the
+    tokenizer, so a new checkpoint starts a new cache. Every entry holds the last-layer hidden states of
+    the real tokens of the sequence (and the pooled output when the encoder returns one). The entries are
+    appended as fp16 rows to memory-mapped files: tokens.bin ([tokens, hidden]) and pooled.bin
+    ([entries, hidden]). index.jsonl records their offsets and is written after the data, so an
+    interrupted write only loses its own entries. The most recently used entries are also kept in
+    memory, up to memory_entries of them.
+
+    The encoder masks padded keys, so the hidden states of real tokens do not depend on how a batch is
+    padded. The heads see the fp16-rounded states whether an entry was a hit or was just computed, so a
+    hit gives the same prediction as a miss. Only one process may write to a cache directory.
+    """
+    def __init__(self, path, memory_entries=4096):
+        self.path = path
+        self.memory_entries = memory_entries
+        os.makedirs(path, exist_ok=True)
+        self.index = {}     # key -> (token offset, token count, pooled row or -1)
+        self.hidden_size = None
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+            complete = []
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:     # a line torn by an interrupted write
+                    continue
+                if not line.endswith("\n"):
+                    continue
+                complete.append(line)
+                self.index[entry['key']] = (entry['offset'], entry['length'], entry['pooled'])
+                self.hidden_size = entry['hidden']
+            # keep only the complete lines, so that the next entry starts on a fresh line
+            if len(complete) < len(lines):
+                with open(index_path + ".tmp", 'w', encoding='utf-8') as f:
+                    f.writelines(complete)
+                os.replace(index_path + ".tmp", index_path)
+        self.num_tokens = max((offset + length for offset, length, _ in self.index.values()), default=0)
+        self.num_pooled = max((pooled for _, _, pooled in self.index.values()), default=-1) + 1
+        # drop rows written after the last indexed ones, so that new entries land at their indexed offsets
+        for name, rows in [("tokens.bin", self.num_tokens), ("pooled.bin", self.num_pooled)]:
+            if os.path.exists(self._file(name)):
+                os.truncate(self._file(name), rows * 2 * (self.hidden_size or 0))
+        self._maps = {}
+        self._memory = OrderedDict()    # LRU front: key -> (tokens, pooled)
+        self.counters = {'lookups': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    @classmethod
+    def open(cls, model, tokenizer, cache_dir=EMBEDDING_CACHE_DIR, memory_entries=4096):
+        """the cache of the encoder weights of model and of tokenizer under cache_dir"""
+        settings = f"{encoder_digest(model)}:{_tokenizer_digest(tokenizer)}"
+        key = hashlib.blake2b(settings.encode(), digest_size=16).hexdigest()
+        cache = cls(os.path.join(cache_dir, key), memory_entries)
+        print(f"[Info] Using embedding cache {cache.path} with {len(cache.index)} entries")
+        return cache
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _rows(self, name, start, count):
+        """rows start:start+count of an fp16 file; the map is reopened when the file has grown past it"""
+        rows = self._maps.get(name)
+        if rows is None or start + count > len(rows):
+            size = os.path.getsize(self._file(name)) // (2 * self.hidden_size)
+            rows = self._maps[name] = np.memmap(self._file(name), dtype=np.float16, mode='r', shape=(size, self.hidden_size))
+        return torch.from_numpy(np.array(rows[start:start + count]))
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def lookup(self, sequences):
+        """(tokens, pooled) entry of every sequence, None for the misses"""
+        entries = []
+        for sequence in sequences:
+            key = sequence_key(sequence)
+            self.counters['lookups'] += 1
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                entries.append(self._memory[key])
+            elif key in self.index:
+                offset, length, pooled_row = self.index[key]
+                entry = (self._rows("tokens.bin", offset, length),
+                         self._rows("pooled.bin", pooled_row, 1)[0] if pooled_row >= 0 else None)
+                self._remember(key, entry)
+                self.counters['disk_hits'] += 1
+                entries.append(entry)
+            else:
+                self.counters['misses'] += 1
+                entries.append(None)
+        return entries
+
+    def store(self, sequences, encoder_outputs, attention_mask):
+        """add the encoder outputs of a batch of sequences; returns their (tokens, pooled) entries"""
+        hidden = encoder_outputs.last_hidden_state
+        pooled = getattr(encoder_outputs, 'pooler_output', None)
+        self.hidden_size = hidden.shape[-1]
+        mask = attention_mask.bool()
+        entries = []
+        index_lines = []
+        with open(self._file("tokens.bin"), 'ab') as tokens_file, open(self._file("pooled.bin"), 'ab') as pooled_file:
+            for row, sequence in enumerate(sequences):
+                tokens = hidden[row][mask[row]].to(torch.float16).cpu()
+                pooled_row = pooled[row].to(torch.float16).cpu() if pooled is not None else None
+                key = sequence_key(sequence)
+                if key not in self.index:
+                    tokens_file.write(tokens.numpy().tobytes())
+                    entry = {'key': key, 'offset': self.num_tokens, 'length': len(tokens), 'pooled': -1,
+                             'hidden': self.hidden_size}
+                    self.num_tokens += len(tokens)
+                    if pooled_row is not None:
+                        pooled_file.write(pooled_row.numpy().tobytes())
+                        entry['pooled'] = self.num_pooled
+                        self.num_pooled += 1
+                    index_lines.append(json.dumps(entry) + "\n")
+                    self.index[key] = (entry['offset'], entry['length'], entry['pooled'])
+                entries.append((tokens, pooled_row))
+                self._remember(key, entries[-1])
+        with open(self._file(INDEX_FILE), 'a', encoding='utf-8') as f:
+            f.writelines(index_lines)
+        return entries
+
+    @staticmethod
+    def collate(entries, attention_mask, dtype=torch.float32):
+        """encoder outputs of a batch from its entries, laid out like attention_mask; padded positions are zero"""
+        mask = attention_mask.bool()
+        hidden_size = entries[0][0].shape[-1]
+        hidden = torch.zeros(mask.shape + (hidden_size,), dtype=dtype, device=attention_mask.device)
+        hidden[mask] = torch.cat([tokens for tokens, _ in entries]).to(device=hidden.device, dtype=dtype)
+        pooled = None
+        if entries[0][1] is not None:
+            pooled = torch.stack([pooled_row for _, pooled_row in entries]).to(device=hidden.device, dtype=dtype)
+        return BaseModelOutputWithPooling(last_hidden_state=hidden, pooler_output=pooled)
+
+    def metrics(self):
+        """hit rates since the cache was opened and the storage size"""
+        counters = self.counters
+        lookups = max(counters['lookups'], 1)
+        storage = sum(os.path.getsize(self._file(name)) for name in ["tokens.bin", "pooled.bin", INDEX_FILE]
+                      if os.path.exists(self._file(name)))
+        return counters | {
+            'hit_rate': (counters['memory_hits'] + counters['disk_hits']) / lookups,
+            'memory_hit_rate': counters['memory_hits'] / lookups,
+            'entries': len(self.index),
+            'memory_entries': len(self._memory),
+            'storage_bytes': storage,
+        }
+
+    def export_metrics(self, path=None):
+        """write metrics() as JSON, by default to metrics.json in the cache directory"""
+        path = path or self._file(METRICS_FILE)
+        metrics = self.metrics()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(metrics, f, indent=2)
+        return metrics
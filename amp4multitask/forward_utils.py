@@ -0,0 +1,25 @@
+from contextlib import contextmanager
+
+import torch
+
+# compute dtype of the autocast regions; parameters and optimizer state always stay fp32
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+def select_rows(outputs, rows):
+    """index the batch dimension of every tensor in a (possibly nested) model output"""
+    if isinstance(outputs, torch.Tensor):
+        return outputs.index_select(0, rows)
+    if isinstance(outputs, dict):
+        return type(outputs)(**{key: select_rows(value, rows) for key, value in outputs.items()})
+    if isinstance(outputs, (tuple, list)):
+        return type(outputs)(select_rows(value, rows) for value in outputs)
+    return outputs
+
+@contextmanager
+def reuse_encoder_outputs(model, encoder_outputs):
+    """make the encoder return precomputed outputs, so a task head runs on a shared encoder pass"""
+    model.amp.forward = lambda *args, **kwargs: encoder_outputs
+    try:
+        yield
+    finally:
+        del model.amp.forward
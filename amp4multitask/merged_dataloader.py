@@ -1,12 +1,17 @@
+import re
 import json
+import hashlib
+from array import array
 from collections import Counter
 import pandas as pd
 import numpy as np
 import math
 import os
+import random
 
 import torch
-from torch.utils.data import Dataset, DataLoader, random_split
+import torch.distributed as dist
+from torch.utils.data import Dataset, DataLoader, Sampler, RandomSampler, DistributedSampler, random_split
 
 valid_aminos = ["A", "F", "C", "U", "D", "N", "E", "Q", "G", "H", "L", "I",
                 "K", "O", "M", "P", "R", "S", "T", "V", "W", "Y", "B", "Z",
@@ -15,18 +20,18 @@ MAX_SEQ_LENGTH = 100
 MIN_LABEL_COUNT = 100
 MIN_ORGANISM_COUNT = 500
 PARAMS_FILE = "normalization_parameters.csv"
+CACHE_DIR = "preprocessed_cache"
+CACHE_VERSION = 1
+MAX_TOKEN_LENGTH = 128
+TASK_NAMES = ['amp_classification', 'bioactivity_classification', 'mic_regression', 'half_life_regression', 'hemolysis_regression']
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
 
 def filt_seq(seq):
     if len(seq) > 0 and len(seq) < MAX_SEQ_LENGTH:
         return all(char in valid_aminos for char in seq)
     return False  
 
-def create_bioactivity_projection(labels):
-    label_count = Counter()
-    for label in labels:
-        if 'bioactivity_classification' in label:
-            label_count.update(label['bioactivity_classification'])
-
+def create_bioactivity_projection(label_count):
     selected_labels = [label for label, count in label_count.items() 
                        if count >= MIN_LABEL_COUNT]
     selected_labels = sorted(selected_labels)
@@ -34,16 +39,7 @@ def create_bioactivity_projection(labels):
     print(f"[Info] selected {len(selected_labels)} kind of projection: {label_to_idx}")
     return label_to_idx
 
-def create_orgainsm_projection(labels):
-    all_orgs = [
-        org 
-        for label in labels 
-        if 'mic_regression' in label 
-        for org in label['mic_regression'] 
-        if pd.notna(org)
-    ]
-    org_counter = Counter(all_orgs)
-
+def create_orgainsm_projection(org_counter):
     valid_organisms = {org for org, count in org_counter.items() 
                       if count >= MIN_ORGANISM_COUNT and pd.notna(org)}
     valid_organisms = sorted(valid_organisms)
@@ -52,89 +48,194 @@ def create_orgainsm_projection(labels):
     print(org_to_idx)
     return org_to_idx
 
-def calculate_mic_stats_by_organism(labels, organism_projection):
-    idx_to_org = {idx: org for org, idx in organism_projection.items()}
-    mic_values = {org_idx: [] for org_idx in idx_to_org.keys()}
-    
-    for label in labels:
-        if 'mic_regression' in label:
-            for org, value in label['mic_regression'].items():
-                if org in organism_projection and value > 0:
-                    org_idx = organism_projection[org]
-                    log_val = -math.log10(value)
-                    mic_values[org_idx].append(log_val)
-    
-    # calculate average value and mean standard deviation for each organism
+def calculate_mic_stats_by_organism(organisms, log_values):
+    """per-organism (mean, std) of the -log10 MIC values, grouped by a stable sort on the organism index"""
+    order = np.argsort(organisms, kind='stable')
+    org_ids, starts = np.unique(organisms[order], return_index=True)
     mic_stats = {}
-    for org_idx, values in mic_values.items():
-        if values:  # make sure there are values
-            mean = np.mean(values)
-            std = np.std(values)
-            mic_stats[org_idx] = (mean, std)
-    
+    for org_idx, values in zip(org_ids.tolist(), np.split(log_values[order], starts[1:])):
+        mic_stats[org_idx] = (np.mean(values), np.std(values))
     return mic_stats
 
 def save_normalization_parameters(params):
     """保存所有标准化参数到CSV文件"""
-    df = pd.DataFrame(columns=["parameter_type", "organism", "mean", "std"])
-    
-    for org_idx, (mean, std) in params["mic_params"].items():
-        org_name = params["idx_to_org"].get(org_idx, f"organism_{org_idx}")
-        df = pd.concat([df, pd.DataFrame([{
-            "parameter_type": "mic_regression",
-            "organism": org_name,
-            "mean": mean,
-            "std": std
-        }])], ignore_index=True)
-    
-    df = pd.concat([df, pd.DataFrame([{
-        "parameter_type": "half_life_regression",
-        "organism": None,
-        "mean": params["hl_mean"],
-        "std": params["hl_std"]
-    }])], ignore_index=True)
-    
-    df = pd.concat([df, pd.DataFrame([{
-        "parameter_type": "hemolysis_regression",
-        "organism": None,
-        "mean": params["hem_mean"],
-        "std": params["hem_std"]
-    }])], ignore_index=True)
-    
-    df.to_csv(PARAMS_FILE, index=False)
+    rows = [{
+        "parameter_type": "mic_regression",
+        "organism": params["idx_to_org"].get(org_idx, f"organism_{org_idx}"),
+        "mean": mean,
+        "std": std
+    } for org_idx, (mean, std) in params["mic_params"].items()]
+    rows.append({"parameter_type": "half_life_regression", "organism": None,
+                 "mean": params["hl_mean"], "std": params["hl_std"]})
+    rows.append({"parameter_type": "hemolysis_regression", "organism": None,
+                 "mean": params["hem_mean"], "std": params["hem_std"]})
+
+    df = pd.DataFrame(rows, columns=["parameter_type", "organism", "mean", "std"])
+    tmp_path = f"{PARAMS_FILE}.{os.getpid()}.tmp"
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, PARAMS_FILE)
     print(f"[Info] Saved normalization parameters to {PARAMS_FILE}")
 
-def convert_and_normalize(labels, organism_projection):
+class _JSONStream:
+    """a read buffer over a JSON text file that decodes one value at a time with raw_decode"""
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read(self):
+        chunk = self.f.read(self.chunk_size)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """next non-whitespace character, '' at the end of the file"""
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self._read()
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"expected one of {chars!r} at character {self.pos}, got {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a value that ends with the buffer (e.g. a number) may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read()
+
+def iter_json_items(file_path, chunk_size=1 << 20):
+    """
+    stream the (key, value) pairs of the top-level object of a JSON file, reading chunk_size
+    characters at a time, so only one value is decoded in memory at once
+    """
+    with open(file_path, 'r', encoding='utf-8') as f:
+        stream = _JSONStream(f, chunk_size)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            yield key, stream.value()
+            if stream.expect(',}') == '}':
+                return
+
+def _collect_columns(items):
+    """
+    a single pass over (sequence, label) pairs that keeps only compact columns: the valid sequences,
+    every regression value with the position of its sample among the valid ones (-1 when the sample
+    is filtered out, since normalization statistics cover all samples), and the classification labels
+    of valid samples. Bioactivity and organism names are counted on the fly for the projections.
+    """
+    sequences = []
+    regression = {task_name: (array('q'), array('d')) for task_name in ('half_life_regression', 'hemolysis_regression')}
+    amp_index, amp_label = array('q'), array('q')
+    bio_index, bio_rows, bio_codes = array('q'), array('q'), array('q')
+    mic_index, mic_codes, mic_values = array('q'), array('q'), array('d')
+    bio_names, org_names = {}, {}
+    label_count, org_counter = Counter(), Counter()
+
+    for seq, label in items:
+        valid = filt_seq(seq) and bool(label)
+        position = len(sequences) if valid else -1
+        if valid:
+            sequences.append(seq.upper())
+
+        for task_name, (index, values) in regression.items():
+            if label.get(task_name) is not None:
+                index.append(position)
+                values.append(label[task_name])
+
+        if 'mic_regression' in label:
+            org_counter.update(label['mic_regression'].keys())
+            for org, value in label['mic_regression'].items():
+                mic_index.append(position)
+                mic_codes.append(org_names.setdefault(org, len(org_names)))
+                mic_values.append(float('nan') if value is None else value)
+
+        if 'bioactivity_classification' in label:
+            label_count.update(label['bioactivity_classification'])
+            if valid and label['bioactivity_classification'] is not None:
+                row = len(bio_index)
+                bio_index.append(position)
+                for name in label['bioactivity_classification']:
+                    bio_rows.append(row)
+                    bio_codes.append(bio_names.setdefault(name, len(bio_names)))
+
+        if valid and label.get('amp_classification') is not None:
+            amp_index.append(position)
+            amp_label.append(int(label['amp_classification']))
+
+    bioactivity_projection = create_bioactivity_projection(label_count)
+    organism_projection = create_orgainsm_projection(org_counter)
+
+    columns = {task_name: (np.array(index, dtype=np.int64), np.array(values, dtype=np.float64))
+               for task_name, (index, values) in regression.items()}
+    # keep only projected organisms with a positive MIC, in the order they appear
+    org_to_idx = np.array([organism_projection.get(org, -1) for org in org_names], dtype=np.int64)
+    mic_organisms = org_to_idx[np.array(mic_codes, dtype=np.int64)]
+    mic_values = np.array(mic_values, dtype=np.float64)
+    keep = (mic_organisms >= 0) & (mic_values > 0)
+    columns['mic_regression'] = (np.array(mic_index, dtype=np.int64)[keep], mic_organisms[keep], mic_values[keep])
+    columns['amp_classification'] = (np.array(amp_index, dtype=np.int64), np.array(amp_label, dtype=np.int64))
+
+    label_to_col = np.array([bioactivity_projection.get(name, -1) for name in bio_names], dtype=np.int64)
+    cols = label_to_col[np.array(bio_codes, dtype=np.int64)]
+    multihot = np.zeros((len(bio_index), len(bioactivity_projection)), dtype=np.uint8)
+    multihot[np.array(bio_rows, dtype=np.int64)[cols >= 0], cols[cols >= 0]] = 1
+    columns['bioactivity_classification'] = (np.array(bio_index, dtype=np.int64), multihot)
+
+    sequences = np.array(sequences, dtype='S')
+    return sequences, columns, bioactivity_projection, organism_projection
+
+def _elementwise(func, values):
+    """
+    apply a math function to a float64 array; numpy's SIMD log10/log1p may differ from libm in the
+    last bit, and the per-value conversions must match the saved normalization parameters exactly
+    """
+    return np.fromiter(map(func, values.tolist()), dtype=np.float64, count=len(values))
+
+def convert_and_normalize(columns, organism_projection):
+    """
+    normalize the regression columns of _collect_columns:
+    half life -log10 and MIC -log10 (per organism), hemolysis log1p, then z-score.
+
+    Returns (normalized, normalization_params), normalized mapping each regression task to
+    (sample positions, [organism indices,] float32 normalized labels)
+    """
     idx_to_org = {idx: org for org, idx in organism_projection.items()}
-    def calculate_parameters4half_life(labels):
-        values = []
-        for label in labels:
-            if 'half_life_regression' in label and label['half_life_regression'] is not None:
-                values.append(label['half_life_regression'])
-
-        assert len(values) > 0, "No half life values found"
-
-        converted = -np.log10(np.array(values))
-        mean = np.mean(converted)
-        std = np.std(converted)
-        return mean, std  
-    
-    def calculate_parameters4hemolysis(labels):
-        values = []
-        for label in labels:
-            if 'hemolysis_regression' in label and label['hemolysis_regression'] is not None:
-                values.append(label['hemolysis_regression'])
-
-        assert len(values) > 0, "No hemolysis values found"
-        converted = np.log1p(values)
-        mean = np.mean(converted)
-        std = np.std(converted)
-        return mean, std
-    
-    mic_stats_by_org = calculate_mic_stats_by_organism(labels, organism_projection)
 
-    hl_mean, hl_std = calculate_parameters4half_life(labels)
-    hem_mean, hem_std = calculate_parameters4hemolysis(labels)
+    hl_index, hl_values = columns['half_life_regression']
+    hem_index, hem_values = columns['hemolysis_regression']
+    assert len(hl_values) > 0, "No half life values found"
+    assert len(hem_values) > 0, "No hemolysis values found"
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hl_converted = -np.log10(hl_values)
+    hem_converted = np.log1p(hem_values)
+    hl_mean, hl_std = np.mean(hl_converted), np.std(hl_converted)
+    hem_mean, hem_std = np.mean(hem_converted), np.std(hem_converted)
+
+    mic_index, mic_organisms, mic_values = columns['mic_regression']
+    mic_log = -_elementwise(math.log10, mic_values)
+    mic_stats_by_org = calculate_mic_stats_by_organism(mic_organisms, mic_log)
 
     # save normalization parameters
     normalization_params = {
@@ -147,118 +248,576 @@ def convert_and_normalize(labels, organism_projection):
     }
     save_normalization_parameters(normalization_params)
 
-    # apply the conversion and normalization
-    for label in labels:
-        if 'half_life_regression' in label and label['half_life_regression'] is not None:
-            value = label['half_life_regression']
-            if value <= 0:
-                label['half_life_regression'] = torch.tensor(float('nan'))
-            else:
-                log_val = -math.log10(value)
-                normed = (log_val - hl_mean) / hl_std
-                label['half_life_regression'] = torch.tensor(normed, dtype=torch.float)
-        
-        if 'hemolysis_regression' in label and label['hemolysis_regression'] is not None:
-            value = label['hemolysis_regression']
-            if value <= 0:
-                label['hemolysis_regression'] = torch.tensor(float('nan'))
-            else:
-                log_val = math.log1p(value)
-                normed = (log_val - hem_mean) / hem_std
-                label['hemolysis_regression'] = torch.tensor(normed, dtype=torch.float)
+    # apply the conversion and normalization; non-positive values become NaN
+    hl_label = np.full(len(hl_values), np.nan, dtype=np.float32)
+    positive = hl_values > 0
+    hl_label[positive] = (-_elementwise(math.log10, hl_values[positive]) - hl_mean) / hl_std
+    hem_label = np.full(len(hem_values), np.nan, dtype=np.float32)
+    positive = hem_values > 0
+    hem_label[positive] = (_elementwise(math.log1p, hem_values[positive]) - hem_mean) / hem_std
 
-        if 'mic_regression' in label:
-            new_mic_regression = {}
-            for org, value in list(label['mic_regression'].items()):
-                if org in organism_projection and value > 0:
-                    org_idx = organism_projection[org]
-                    log_val = -math.log10(value)
-                    
-                    # 使用对应微生物的统计量进行标准化
-                    if org_idx in mic_stats_by_org:
-                        mean, std = mic_stats_by_org[org_idx]
-                        normed = (log_val - mean) / std
-                    else:
-                        # 如果找不到该微生物的统计量，使用全局平均值作为后备
-                        # (实际不会发生，因为我们已经过滤了样本量不足的微生物)
-                        normed = log_val
-                    
-                    new_mic_regression[org_idx] = normed
-            label['mic_regression'] = new_mic_regression
-    return labels
+    # 使用对应微生物的统计量进行标准化（每个 organism 都至少有一个值，因此统计量总是存在）
+    mic_mean = np.zeros(len(organism_projection))
+    mic_std = np.ones(len(organism_projection))
+    for org_idx, (mean, std) in mic_stats_by_org.items():
+        mic_mean[org_idx], mic_std[org_idx] = mean, std
+    mic_label = ((mic_log - mic_mean[mic_organisms]) / mic_std[mic_organisms]).astype(np.float32)
+
+    normalized = {
+        'half_life_regression': (hl_index, hl_label),
+        'hemolysis_regression': (hem_index, hem_label),
+        'mic_regression': (mic_index, mic_organisms, mic_label),
+    }
+    return normalized, normalization_params
+
+def _load_samples(file_path):
+    """stream the merged data file into the flat arrays stored by load_preprocessed"""
+    sequences, columns, bioactivity_projection, organism_projection = _collect_columns(iter_json_items(file_path))
+    normalized, normalization_params = convert_and_normalize(columns, organism_projection)
+    columns.update(normalized)
+
+    arrays = {'sequences': sequences}
+    for task_name in TASK_NAMES:
+        index, *organisms, label = columns[task_name]
+        keep = index >= 0
+        arrays[f'{task_name}_index'] = index[keep]
+        arrays[f'{task_name}_label'] = label[keep]
+        if organisms:
+            arrays[f'{task_name}_organism'] = organisms[0][keep]
+
+    metadata = {
+        'bioactivity_projection': bioactivity_projection,
+        'organism_projection': organism_projection,
+        'normalization_params': {
+            'mic_params': {str(idx): [float(mean), float(std)] for idx, (mean, std) in normalization_params['mic_params'].items()},
+            'hl_mean': float(normalization_params['hl_mean']),
+            'hl_std': float(normalization_params['hl_std']),
+            'hem_mean': float(normalization_params['hem_mean']),
+            'hem_std': float(normalization_params['hem_std']),
+        }
+    }
+    arrays['metadata'] = np.array(json.dumps(metadata))
+    return arrays
 
 def load_data(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-        
-    seqs = list(data.keys())
-    labels = list(data.values())
-    bioactivity_projection = create_bioactivity_projection(labels)
-    organism_projection = create_orgainsm_projection(labels)
-    labels = convert_and_normalize(labels, organism_projection)
-
-    valid_samples = []
-    for seq, label in zip(seqs, labels):
-        if not filt_seq(seq) or not label:
+    """per-sample dicts (Sequence plus one entry per labelled task) rebuilt from the preprocessed arrays"""
+    data = load_preprocessed(file_path)
+    samples = [{'Sequence': sequence.decode()} for sequence in data['sequences']]
+    for task_name in TASK_NAMES:
+        index, labels = data[f'{task_name}_index'], torch.from_numpy(data[f'{task_name}_label'])
+        if task_name == 'mic_regression':
+            for i, org_idx, value in zip(index.tolist(), data[f'{task_name}_organism'].tolist(), labels.tolist()):
+                samples[i].setdefault(task_name, {})[org_idx] = value
             continue
+        if task_name == 'bioactivity_classification':
+            labels = labels.float()
+        for i, value in zip(index.tolist(), labels):
+            samples[i][task_name] = value
+    return samples
 
-        label['Sequence'] = seq.upper()
+def _file_digest(file_path, cache_dir):
+    """blake2b digest of the data file, memoized by (size, mtime) so unchanged files are not re-hashed"""
+    stat = os.stat(file_path)
+    source = os.path.abspath(file_path)
+    memo_path = os.path.join(cache_dir, "digests.json")
+    memo_key = f"{source}:{stat.st_size}:{stat.st_mtime_ns}"
+    memo = {}
+    if os.path.exists(memo_path):
+        with open(memo_path, 'r', encoding='utf-8') as f:
+            memo = json.load(f)
+    if memo_key not in memo:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        # the digests of older versions of the file are never looked up again
+        memo = {k: v for k, v in memo.items() if k.rsplit(":", 2)[0] != source}
+        memo[memo_key] = digest.hexdigest()
+        with open(memo_path, 'w', encoding='utf-8') as f:
+            json.dump(memo, f)
+    return memo[memo_key]
 
-        if 'amp_classification' in label:
-            label['amp_classification'] = torch.tensor(label['amp_classification'], dtype=torch.long)
-        
-        if 'bioactivity_classification' in label:
-            multihot = [0] * len(bioactivity_projection)
-            for l in label['bioactivity_classification']:
-                if l in bioactivity_projection:
-                    multihot[bioactivity_projection[l]] = 1
-            label['bioactivity_classification'] = torch.tensor(multihot, dtype=torch.float)
-        
-        valid_samples.append(label)
-    return valid_samples
+def _cache_key(file_path, cache_dir):
+    settings = f"{CACHE_VERSION}:{MAX_SEQ_LENGTH}:{MIN_LABEL_COUNT}:{MIN_ORGANISM_COUNT}"
+    return hashlib.blake2b(f"{_file_digest(file_path, cache_dir)}:{settings}".encode(), digest_size=16).hexdigest()
+
+_preprocessed = {}
+_params_key = None  # cache key of the statistics normalization_parameters.csv holds
+
+def _prune_cache(file_path, key, cache_dir):
+    """remove the npz files built from an older version of file_path or with other filter settings"""
+    sources_path = os.path.join(cache_dir, "sources.json")
+    sources = {}
+    if os.path.exists(sources_path):
+        with open(sources_path, 'r', encoding='utf-8') as f:
+            sources = json.load(f)
+    source = os.path.abspath(file_path)
+    stale = sources.get(source)
+    if stale == key:
+        return
+    sources[source] = key
+    with open(sources_path, 'w', encoding='utf-8') as f:
+        json.dump(sources, f)
+    if stale is None or stale in sources.values():     # another data file still uses the entry
+        return
+    for name in os.listdir(cache_dir):
+        if name.startswith(stale) and name.endswith(".npz"):
+            os.remove(os.path.join(cache_dir, name))
+            print(f"[Info] Removed stale preprocessed data {name}")
+
+def _write_normalization_parameters(key, data):
+    """rewrite normalization_parameters.csv with the statistics of data unless it already holds them"""
+    global _params_key
+    if _params_key == key and os.path.exists(PARAMS_FILE):
+        return
+    params = data['normalization_params']
+    save_normalization_parameters({
+        "mic_params": {int(idx): tuple(stats) for idx, stats in params['mic_params'].items()},
+        "hl_mean": params['hl_mean'],
+        "hl_std": params['hl_std'],
+        "hem_mean": params['hem_mean'],
+        "hem_std": params['hem_std'],
+        "idx_to_org": {idx: org for org, idx in data['organism_projection'].items()}
+    })
+    _params_key = key
+
+def load_preprocessed(file_path, cache_dir=CACHE_DIR):
+    """
+    Load the normalized labels, projections and per-task index lists of a merged data file.
+
+    The result is cached on disk as npz, keyed by the hash of the data file and the filter
+    constants, so only the first call for a given file pays for parsing and normalization.
+    Only the latest entry of every data file is kept. The normalization statistics are stored
+    in the entry, and normalization_parameters.csv is rewritten from them whenever another
+    entry is loaded, so it always matches the data that was loaded last.
+    """
+    global _params_key
+    os.makedirs(cache_dir, exist_ok=True)
+    key = _cache_key(file_path, cache_dir)
+    if key in _preprocessed:
+        _write_normalization_parameters(key, _preprocessed[key])
+        return _preprocessed[key]
+
+    cache_path = os.path.join(cache_dir, f"{key}.npz")
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            arrays = {name: cached[name] for name in cached.files}
+        print(f"[Info] Loaded preprocessed data from {cache_path}")
+    else:
+        arrays = _load_samples(file_path)   # convert_and_normalize writes normalization_parameters.csv
+        _params_key = key
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, cache_path)
+        print(f"[Info] Saved preprocessed data to {cache_path}")
+    _prune_cache(file_path, key, cache_dir)
+
+    arrays.update(json.loads(arrays.pop('metadata').item()))
+    _write_normalization_parameters(key, arrays)
+    _preprocessed[key] = arrays
+    return arrays
+
+def _tokenizer_digest(tokenizer):
+    vocab = sorted(tokenizer.get_vocab().items())
+    settings = [type(tokenizer).__name__, tokenizer.pad_token_id, MAX_TOKEN_LENGTH, vocab]
+    return hashlib.blake2b(json.dumps(settings).encode(), digest_size=8).hexdigest()
+
+_tokenized = {}
+
+def load_tokenized(file_path, tokenizer, cache_dir=CACHE_DIR):
+    """
+    Tokenize every sequence of the preprocessed data once and cache the result on disk.
+
+    Returns int16 input_ids of shape [num_sequences, longest], right-padded with the pad token,
+    and the int16 token length (special tokens included) of every sequence.
+    """
+    data = load_preprocessed(file_path, cache_dir)
+    key = f"{_cache_key(file_path, cache_dir)}_tokens_{_tokenizer_digest(tokenizer)}"
+    if key in _tokenized:
+        return _tokenized[key]
+
+    cache_path = os.path.join(cache_dir, f"{key}.npz")
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            input_ids, lengths = cached['input_ids'], cached['lengths']
+    else:
+        encoded = tokenizer(
+            [seq.decode() for seq in data['sequences']],
+            truncation=True,
+            max_length=MAX_TOKEN_LENGTH
+        )['input_ids']
+        lengths = np.array([len(ids) for ids in encoded], dtype=np.int16)
+        input_ids = np.full((len(encoded), int(lengths.max(initial=0))), tokenizer.pad_token_id, dtype=np.int16)
+        for row, ids in zip(input_ids, encoded):
+            row[:len(ids)] = ids
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, input_ids=input_ids, lengths=lengths)
+        os.replace(tmp_path, cache_path)
+        print(f"[Info] Saved {len(lengths)} tokenized sequences to {cache_path}")
+
+    _tokenized[key] = (input_ids, lengths)
+    return input_ids, lengths
+
+def _distributed_context(num_replicas=None, rank=None):
+    """(num_replicas, rank) of the initialized process group, or a single process"""
+    if num_replicas is None:
+        num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+    if rank is None:
+        rank = dist.get_rank() if num_replicas > 1 else 0
+    return num_replicas, rank
+
+def _shard_batches(batches, num_replicas, rank, pad):
+    """
+    every num_replicas-th batch starting at rank; with pad, the list is first extended by repeating
+    batches so that all ranks run the same number of steps (required by DDP during training)
+    """
+    if num_replicas == 1:
+        return batches
+    if pad and batches:
+        batches = batches + [batches[i % len(batches)] for i in range(-len(batches) % num_replicas)]
+    return batches[rank::num_replicas]
+
+def _shard_length(num_batches, num_replicas, rank, pad):
+    if pad:
+        return math.ceil(num_batches / num_replicas)
+    return len(range(rank, num_batches, num_replicas))
+
+class ShardSampler(Sampler):
+    """every num_replicas-th index starting at rank, without the padding of DistributedSampler (for evaluation)"""
+    def __init__(self, data_source, num_replicas, rank):
+        self.num_samples = len(data_source)
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        return iter(range(self.rank, self.num_samples, self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, self.num_samples, self.num_replicas))
+
+def set_loader_epoch(loader, epoch):
+    """pass the epoch to the samplers that shuffle per epoch (DistributedSampler and the batch samplers here)"""
+    for sampler in (loader.sampler, loader.batch_sampler):
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+
+def _loader_generators(loader):
+    """the generators that drive a loader's shuffle and worker seeds"""
+    generators = {'loader': loader.generator}
+    if isinstance(getattr(loader.sampler, 'generator', None), torch.Generator):
+        generators['sampler'] = loader.sampler.generator
+    return {name: generator for name, generator in generators.items() if generator is not None}
+
+def loader_state_dict(loader):
+    """generator states of a loader between epochs; with set_loader_epoch they reproduce the following epochs"""
+    return {name: generator.get_state() for name, generator in _loader_generators(loader).items()}
+
+def load_loader_state_dict(loader, state):
+    for name, generator in _loader_generators(loader).items():
+        if name in state:
+            generator.set_state(state[name])
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Yield batches of indices whose sequences have similar lengths, so dynamic padding wastes little.
+
+    With shuffle, the indices are shuffled, cut into chunks of batch_size * bucket_size_multiplier,
+    each chunk is sorted by length and split into batches, and the batch order is shuffled again;
+    a new permutation is drawn every epoch. Without shuffle, all indices are sorted by length.
+    With num_replicas > 1 every rank builds the same batches and takes its share of them.
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size_multiplier=50, drop_last=False, seed=0,
+                 num_replicas=1, rank=0):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        if not self.shuffle:
+            order = torch.argsort(self.lengths, stable=True)
+            return list(torch.split(order, self.batch_size))
+
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        permutation = torch.randperm(len(self.lengths), generator=generator)
+        batches = []
+        for chunk in torch.split(permutation, self.bucket_size):
+            chunk = chunk[torch.argsort(self.lengths[chunk], stable=True)]
+            batches.extend(torch.split(chunk, self.batch_size))
+        order = torch.randperm(len(batches), generator=generator).tolist()
+        return [batches[i] for i in order]
+
+    def __iter__(self):
+        batches = self._batches()
+        if self.shuffle:
+            self.epoch += 1
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        for batch in _shard_batches(batches, self.num_replicas, self.rank, pad=self.shuffle):
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            num_batches = len(self.lengths) // self.batch_size
+        else:
+            num_batches = math.ceil(len(self.lengths) / self.batch_size)
+        return _shard_length(num_batches, self.num_replicas, self.rank, pad=self.shuffle)
+
+class TaskMixingBatchSampler(Sampler):
+    """
+    Batch sampler for joint multi-task training over the concatenated index space of several tasks.
+
+    Every draw picks a task with probability proportional to (number of samples) ** (1 / temperature):
+    temperature 1 samples tasks in proportion to their size, larger temperatures flatten the mix towards
+    uniform so small tasks are seen more often. The drawn task then yields the next sample of its own
+    shuffled order, reshuffled whenever it is exhausted. One epoch is num_batches batches, by default
+    as many as needed to cover the total number of samples once, shared out across num_replicas ranks.
+    """
+    def __init__(self, task_sizes, batch_size, temperature=1.0, num_batches=None, seed=0, num_replicas=1, rank=0):
+        assert temperature > 0, "temperature must be positive"
+        self.task_sizes = list(task_sizes)
+        self.batch_size = batch_size
+        weights = torch.tensor(self.task_sizes, dtype=torch.float64) ** (1.0 / temperature)
+        self.probabilities = weights / weights.sum()
+        self.offsets = [0] + torch.cumsum(torch.tensor(self.task_sizes), 0).tolist()[:-1]
+        self.num_batches = num_batches or math.ceil(sum(self.task_sizes) / batch_size)
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        tasks = torch.multinomial(self.probabilities, self.num_batches * self.batch_size,
+                                  replacement=True, generator=generator)
+        indices = torch.empty_like(tasks)
+        for task, (size, offset) in enumerate(zip(self.task_sizes, self.offsets)):
+            where = (tasks == task).nonzero().squeeze(1)
+            if len(where) == 0:
+                continue
+            rounds = math.ceil(len(where) / size)
+            order = torch.cat([torch.randperm(size, generator=generator) for _ in range(rounds)])
+            indices[where] = order[:len(where)] + offset
+        batches = list(torch.split(indices, self.batch_size))
+        for batch in _shard_batches(batches, self.num_replicas, self.rank, pad=True):
+            yield batch.tolist()
+
+    def __len__(self):
+        return _shard_length(self.num_batches, self.num_replicas, self.rank, pad=True)
+
+class TokenizedCollator:
+    """
+    pad a bulk-fetched batch (see AMPDataset.__getitems__) on the tokenizer's padding side,
+    to max_length or, when max_length is None, to the longest sample of the batch
+    """
+    def __init__(self, pad_token_id, padding_side="right", max_length=MAX_TOKEN_LENGTH):
+        self.pad_token_id = pad_token_id
+        self.padding_side = padding_side
+        self.max_length = max_length
+
+    def __call__(self, batch):
+        rows = batch.pop('input_ids')
+        lengths = batch.pop('length').long()
+        width = self.max_length or int(lengths.max())
+
+        positions = torch.arange(width).expand(len(lengths), width)
+        if self.padding_side == "left":
+            positions = positions - (width - lengths).unsqueeze(1)
+        attention_mask = (positions >= 0) & (positions < lengths.unsqueeze(1))
+        input_ids = rows.gather(1, positions.clamp(0, rows.size(1) - 1)).long()
+        input_ids.masked_fill_(~attention_mask, self.pad_token_id)
+
+        batch['input_ids'] = input_ids
+        batch['attention_mask'] = attention_mask.long()
+        return batch
+
+def collate_sequences(batch):
+    """collate a bulk-fetched batch of the untokenized dataset; sequences are decoded only here"""
+    batch['Sequence'] = [sequence.decode() for sequence in batch['Sequence'].tolist()]
+    return batch
 
 class AMPDataset(Dataset):
-    def __init__(self, file_path, task_name):
+    """
+    struct-of-arrays dataset: every sample is a position in contiguous tensors
+    (sequence index, label and, for mic_regression, organism) instead of a dict of 0-d tensors.
+    Batches are fetched in bulk through __getitems__ and must be collated with
+    TokenizedCollator (tokenized) or collate_sequences (raw sequences)
+    """
+    def __init__(self, file_path, task_name, tokenizer=None):
         super().__init__()
         assert task_name in ['amp_classification', 'bioactivity_classification', 'mic_regression', 'half_life_regression', 'hemolysis_regression'], "Invalid task name"
 
-        self.samples = load_data(file_path)
-        self.valid_samples = []
-
+        data = load_preprocessed(file_path)
+        self.sequence_index = torch.from_numpy(data[f'{task_name}_index'].astype(np.int64))
+        self.labels = torch.from_numpy(data[f'{task_name}_label'])
+        if task_name == 'bioactivity_classification':
+            self.labels = self.labels.float()
+        self.organisms = None
         if task_name == 'mic_regression':
-            for sample in self.samples:
-                if task_name in sample and sample[task_name]:
-                    organisms = list(sample[task_name].keys())
-                    values = list(sample[task_name].values())
-                    assert len(organisms) == len(values), f"Mismatch between number of organisms and values. Organisms: {len(organisms)}, Values: {len(values)}"
-
-                    for o, v in zip(organisms, values):
-                        modified_sample = {
-                            'Sequence': sample['Sequence'],
-                            'organism': torch.tensor(o, dtype=torch.long),
-                            'label': torch.tensor(v, dtype=torch.float)
-                        }
-                        self.valid_samples.append(modified_sample)
+            self.organisms = torch.from_numpy(data[f'{task_name}_organism'].astype(np.int64))
 
+        self.sequences = None
+        self.input_ids = None
+        self.lengths = None
+        self.sample_lengths = None
+        if tokenizer is not None:
+            input_ids, lengths = load_tokenized(file_path, tokenizer)
+            self.input_ids = torch.from_numpy(input_ids)
+            self.lengths = torch.from_numpy(lengths)
+            self.sample_lengths = self.lengths[self.sequence_index]
         else:
-            for sample in self.samples:
-                if task_name in sample:
-                    modified_sample = {
-                        'Sequence': sample['Sequence'],
-                        'label': sample[task_name]
-                    }
-                    self.valid_samples.append(modified_sample)
-        
-        print(f"[Info] Loaded {len(self.valid_samples)} samples for task {task_name}")
+            self.sequences = data['sequences']
+
+        print(f"[Info] Loaded {len(self)} samples for task {task_name}")
 
     def __len__(self):
-        return len(self.valid_samples)
-    
+        return len(self.sequence_index)
+
+    def __getitems__(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        sequence_index = self.sequence_index[indices]
+        batch = {'label': self.labels[indices]}
+        if self.organisms is not None:
+            batch['organism'] = self.organisms[indices]
+        if self.input_ids is not None:
+            batch['sequence_index'] = sequence_index
+            batch['input_ids'] = self.input_ids[sequence_index]
+            batch['length'] = self.lengths[sequence_index]
+        else:
+            batch['Sequence'] = self.sequences[sequence_index.numpy()]
+        return batch
+
     def __getitem__(self, idx):
-        return self.valid_samples[idx]
+        sample = {key: value[0] for key, value in self.__getitems__([idx]).items()}
+        if 'Sequence' in sample:
+            sample['Sequence'] = sample['Sequence'].decode()
+        return sample
+
+class MultiTaskDataset(Dataset):
+    """
+    The train samples of several tasks behind one index space (task after task, like ConcatDataset).
+
+    __getitems__ collects the sequences of the drawn samples and returns them once, as the rows of one
+    token batch, together with, per task, the labels of every train sample of those sequences and the row
+    each label belongs to. A sequence labelled for several tasks is therefore encoded once and feeds
+    several heads. Pad with TokenizedCollator (the 'tasks' entry is passed through).
+    """
+    def __init__(self, subsets):
+        super().__init__()
+        self.tasks = list(subsets)
+        self.datasets = {task_name: subset.dataset for task_name, subset in subsets.items()}
+        self.samples = {task_name: torch.as_tensor(subset.indices, dtype=torch.long) for task_name, subset in subsets.items()}
+        first = self.datasets[self.tasks[0]]
+        assert first.input_ids is not None, "MultiTaskDataset requires tokenized datasets"
+        self.input_ids, self.lengths = first.input_ids, first.lengths
+        self.task_sizes = [len(self.samples[task_name]) for task_name in self.tasks]
+        self.offsets = torch.cumsum(torch.tensor(self.task_sizes), 0)
+
+        # train samples of every task sorted by sequence, to look up all labels of a set of sequences
+        self.sorted_samples = {}
+        self.sorted_sequences = {}
+        for task_name in self.tasks:
+            sequences = self.datasets[task_name].sequence_index[self.samples[task_name]]
+            order = torch.argsort(sequences, stable=True)
+            self.sorted_samples[task_name] = self.samples[task_name][order]
+            self.sorted_sequences[task_name] = sequences[order]
+
+    def __len__(self):
+        return sum(self.task_sizes)
 
-def build_dataloader(file_path, task_name, batch_size):
-    dataset = AMPDataset(file_path, task_name)
+    def __getitems__(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        task_ids = torch.searchsorted(self.offsets, indices, right=True)
+        drawn = []
+        for task_id, task_name in enumerate(self.tasks):
+            local = indices[task_ids == task_id] - (self.offsets[task_id] - self.task_sizes[task_id])
+            drawn.append(self.datasets[task_name].sequence_index[self.samples[task_name][local]])
+        sequences = torch.unique(torch.cat(drawn))
+
+        tasks = {}
+        for task_name in self.tasks:
+            sorted_sequences = self.sorted_sequences[task_name]
+            start = torch.searchsorted(sorted_sequences, sequences)
+            end = torch.searchsorted(sorted_sequences, sequences, right=True)
+            counts = end - start
+            if counts.sum() == 0:
+                continue
+            # expand the [start, end) range of every sequence into sample positions
+            positions = torch.repeat_interleave(start - torch.cumsum(counts, 0) + counts, counts) + torch.arange(int(counts.sum()))
+            dataset = self.datasets[task_name]
+            sample_index = self.sorted_samples[task_name][positions]
+            task_batch = {
+                'rows': torch.repeat_interleave(torch.arange(len(sequences)), counts),
+                'label': dataset.labels[sample_index],
+            }
+            if dataset.organisms is not None:
+                task_batch['organism'] = dataset.organisms[sample_index]
+            tasks[task_name] = task_batch
+
+        return {
+            'sequence_index': sequences,
+            'input_ids': self.input_ids[sequences],
+            'length': self.lengths[sequences],
+            'tasks': tasks,
+        }
+
+def seed_worker(worker_id):
+    """seed numpy and random in each loader worker from the per-worker torch seed"""
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+def _loader_options(num_workers, pin_memory, persistent_workers, prefetch_factor, seed):
+    options = {
+        'num_workers': num_workers,
+        'pin_memory': pin_memory,
+        'worker_init_fn': seed_worker,
+        # workers are seeded with base seed + worker id, the base seed drawn from this generator
+        'generator': torch.Generator().manual_seed(seed),
+    }
+    if num_workers > 0:
+        options['persistent_workers'] = persistent_workers
+        options['prefetch_factor'] = prefetch_factor
+    return options
+
+def build_dataloader(file_path, task_name, batch_size, tokenizer=None, bucket_by_length=False,
+                     num_workers=0, pin_memory=False, persistent_workers=True, prefetch_factor=2, seed=1234,
+                     num_replicas=None, rank=None):
+    """
+    Build train/val/test loaders. With a tokenizer, sequences are tokenized once (and cached on disk)
+    and every batch carries ready 'input_ids'/'attention_mask' tensors instead of raw strings.
+    With bucket_by_length (requires a tokenizer), batches group sequences of similar length and
+    are padded only to their longest member instead of to MAX_TOKEN_LENGTH.
+
+    With num_workers > 0 the batch fetch and collation (padding, attention masks) run in worker
+    processes, prefetch_factor batches ahead per worker, and the workers are kept alive across epochs
+    when persistent_workers is set. pin_memory returns page-locked batches for faster host-to-GPU copies.
+    Shuffling and worker seeds derive from seed, so the batches do not change with the worker count.
+
+    In distributed training (num_replicas/rank default to the initialized process group) every rank
+    gets its shard: DistributedSampler or a rank-aware bucket sampler for training, padded so that all
+    ranks run the same number of steps, and an unpadded ShardSampler for validation and test.
+    """
+    assert tokenizer is not None or not bucket_by_length, "bucket_by_length requires a tokenizer"
+    dataset = AMPDataset(file_path, task_name, tokenizer)
+    collate_fn = collate_sequences
+    if tokenizer is not None:
+        collate_fn = TokenizedCollator(tokenizer.pad_token_id, tokenizer.padding_side,
+                                       max_length=None if bucket_by_length else MAX_TOKEN_LENGTH)
     num_samples = len(dataset)
 
     num_train = int(num_samples * 0.8)
@@ -271,23 +830,80 @@ def build_dataloader(file_path, task_name, batch_size):
         generator=torch.Generator().manual_seed(1234)
         )
     
+    def loader_options():
+        return _loader_options(num_workers, pin_memory, persistent_workers, prefetch_factor, seed)
+
+    num_replicas, rank = _distributed_context(num_replicas, rank)
+    if bucket_by_length:
+        def bucketed_loader(subset, shuffle):
+            sampler = LengthBucketBatchSampler(dataset.sample_lengths[subset.indices], batch_size, shuffle=shuffle, seed=seed,
+                                               num_replicas=num_replicas, rank=rank)
+            return DataLoader(subset, batch_sampler=sampler, collate_fn=collate_fn, **loader_options())
+        return bucketed_loader(train_dataset, True), bucketed_loader(val_dataset, False), bucketed_loader(test_dataset, False)
+
+    # the shuffle has its own generator so the batch order does not depend on num_workers
+    train_sampler = RandomSampler(train_dataset, generator=torch.Generator().manual_seed(seed))
+    val_sampler = test_sampler = None
+    if num_replicas > 1:
+        train_sampler = DistributedSampler(train_dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed)
+        val_sampler = ShardSampler(val_dataset, num_replicas, rank)
+        test_sampler = ShardSampler(test_dataset, num_replicas, rank)
     train_loader = DataLoader(
         train_dataset,
         batch_size=batch_size,
-        shuffle=True
+        sampler=train_sampler,
+        collate_fn=collate_fn,
+        **loader_options()
     )
     val_loader = DataLoader(
         val_dataset,
         batch_size=batch_size,
-        shuffle=False
+        sampler=val_sampler,
+        collate_fn=collate_fn,
+        **loader_options()
     )
     test_loader = DataLoader(
         test_dataset,
         batch_size=batch_size,
-        shuffle=False
+        sampler=test_sampler,
+        collate_fn=collate_fn,
+        **loader_options()
     )
     return train_loader, val_loader, test_loader
 
+def build_multitask_dataloader(file_path, batch_size, tokenizer, tasks=TASK_NAMES, temperature=1.0, num_batches=None,
+                               num_workers=0, pin_memory=False, persistent_workers=True, prefetch_factor=2, seed=1234,
+                               num_replicas=None, rank=None):
+    """
+    Build the joint training loader over several tasks and the validation loader of every task.
+
+    The train/val split of every task is the one of build_dataloader, so validation losses are comparable
+    with sequential training. Training batches are drawn by TaskMixingBatchSampler (see temperature) and
+    padded to their longest sequence.
+
+    Returns (train_loader, {task_name: val_loader})
+    """
+    subsets = {}
+    val_loaders = {}
+    for task_name in tasks:
+        train_loader, val_loaders[task_name], _ = build_dataloader(
+            file_path, task_name, batch_size, tokenizer, num_workers=num_workers, pin_memory=pin_memory,
+            persistent_workers=persistent_workers, prefetch_factor=prefetch_factor, seed=seed,
+            num_replicas=num_replicas, rank=rank
+        )
+        subsets[task_name] = train_loader.dataset
+
+    dataset = MultiTaskDataset(subsets)
+    num_replicas, rank = _distributed_context(num_replicas, rank)
+    sampler = TaskMixingBatchSampler(dataset.task_sizes, batch_size, temperature, num_batches, seed=seed,
+                                     num_replicas=num_replicas, rank=rank)
+    probabilities = {task_name: round(p, 3) for task_name, p in zip(dataset.tasks, sampler.probabilities.tolist())}
+    print(f"[Info] Joint training over {len(dataset)} samples, task probabilities: {probabilities}")
+    collate_fn = TokenizedCollator(tokenizer.pad_token_id, tokenizer.padding_side, max_length=None)
+    train_loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_fn,
+                              **_loader_options(num_workers, pin_memory, persistent_workers, prefetch_factor, seed))
+    return train_loader, val_loaders
+
 if __name__ == '__main__':
     file_path = "merged_data.json"
     train_loader, val_loader, test_loader = build_dataloader(file_path, "half_life_regression", 64)
\ No newline at end of file
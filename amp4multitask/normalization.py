@@ -0,0 +1,84 @@
+"""
+Denormalization of the regression outputs of amp4multitask.
+
+merged_dataloader.convert_and_normalize z-scores -log10(MIC) per organism, -log10(half life) and
+log1p(hemolysis), and writes the statistics to normalization_parameters.csv. Denormalizer reads that file
+once and inverts the normalization on whole arrays or tensors of predictions.
+
+unit:
+- μg/ml for MIC
+- min for half life
+- score for hemolysis
+"""
+import numpy as np
+import pandas as pd
+import torch
+
+# organism id of the mic_regression head -> organism name in normalization_parameters.csv
+organism2id = {
+            'Acinetobacter baumannii': 0, 'Bacillus subtilis': 1, 'Candida albicans': 2,
+            'Enterococcus faecalis': 3, 'Escherichia coli': 4, 'Klebsiella pneumoniae': 5,
+            'Micrococcus luteus': 6, 'Pseudomonas aeruginosa': 7, 'Salmonella enterica': 8,
+            'Staphylococcus aureus': 9, 'Staphylococcus epidermidis': 10
+            }
+id2organism = {v: k for k, v in organism2id.items()}
+REGRESSION_TASKS = ["mic_regression", "half_life_regression", "hemolysis_regression"]
+
+class Denormalizer:
+    """
+    mean/std of every regression target parsed once from normalization_parameters.csv: arrays indexed by
+    organism id for mic_regression (the ids come from organism2id, not from the row order of the file) and
+    one pair per task for half_life_regression and hemolysis_regression
+    """
+    def __init__(self, norm_params_path, organism2id=organism2id):
+        norm_params = pd.read_csv(norm_params_path)
+        self.organism2id = organism2id
+
+        mic_params = norm_params[norm_params['parameter_type'] == 'mic_regression'].set_index('organism')
+        missing = set(organism2id) - set(mic_params.index)
+        if missing:
+            raise ValueError(f"[Error] No mic_regression parameters for {sorted(missing)} in {norm_params_path}")
+        self.mic_mean = np.zeros(len(organism2id))
+        self.mic_std = np.ones(len(organism2id))
+        for organism, organism_id in organism2id.items():
+            self.mic_mean[organism_id] = mic_params.at[organism, 'mean']
+            self.mic_std[organism_id] = mic_params.at[organism, 'std']
+
+        self.task_params = {}
+        for task_name in ["half_life_regression", "hemolysis_regression"]:
+            params = norm_params[norm_params['parameter_type'] == task_name]
+            if len(params) == 0:
+                raise ValueError(f"[Error] No {task_name} parameters in {norm_params_path}")
+            self.task_params[task_name] = (params['mean'].values[0], params['std'].values[0])
+
+    def organism_ids(self, organisms):
+        """organism ids of a list of organism names"""
+        unknown = [organism for organism in organisms if organism not in self.organism2id]
+        if unknown:
+            raise ValueError(f"[Error] Unknown organisms {unknown}, choose from {list(self.organism2id)}")
+        return np.array([self.organism2id[organism] for organism in organisms], dtype=np.int64)
+
+    def __call__(self, task_name, values, organism_ids=None):
+        """
+        Denormalize a numpy array or tensor of predictions of task_name in one call. For mic_regression,
+        organism_ids must broadcast against values, e.g. [N] ids for N predictions or [K] ids for an
+        N x K panel. The other tasks are returned unchanged.
+        """
+        if task_name not in REGRESSION_TASKS:
+            return values   # the rest of tasks are not normalized
+        if task_name == "mic_regression":
+            assert organism_ids is not None, "mic_regression needs organism_ids"
+            organism_ids = np.asarray(organism_ids.cpu() if isinstance(organism_ids, torch.Tensor) else organism_ids)
+            mean, std = self.mic_mean[organism_ids], self.mic_std[organism_ids]
+        else:
+            mean, std = self.task_params[task_name]
+
+        if isinstance(values, torch.Tensor):
+            mean = torch.as_tensor(mean, dtype=values.dtype, device=values.device)
+            std = torch.as_tensor(std, dtype=values.dtype, device=values.device)
+            log_values = values * std + mean
+            return torch.expm1(log_values) if task_name == "hemolysis_regression" else torch.pow(10, -log_values)
+        log_values = np.asarray(values, dtype=np.float64) * std + mean
+        if task_name == "hemolysis_regression":
+            return np.expm1(log_values)     # e^(log_val) - 1
+        return 10 ** -log_values    # 10^(-log10(value)) = value
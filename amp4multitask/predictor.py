@@ -0,0 +1,319 @@
+"""
+Batched multi-task inference for amp4multitask.
+
+    predictor = AMPPredictor.from_pretrained("amp4multitask")
+    predictions = predictor.predict(["KGGK", "GLFDIVKKVVGALGSL"], tasks=["amp_classification", "mic_regression"])
+
+or stream a FASTA file to CSV / JSONL:
+    python predictor.py peptides.fasta predictions.csv --tasks amp_classification,mic_regression
+    python predictor.py peptides.fasta predictions.jsonl --organisms "Escherichia coli,Staphylococcus aureus"
+    python predictor.py peptides.fasta mic_panel.csv --tasks mic_regression --organisms all
+
+unit:
+- probability for amp_probability
+- μg/ml for mic_<organism>
+- min for half_life
+- score for hemolysis
+"""
+import argparse
+import itertools
+
+import numpy as np
+import pandas as pd
+import torch
+from transformers import AutoModel, AutoTokenizer
+
+from forward_utils import PRECISIONS, reuse_encoder_outputs, select_rows
+from merged_dataloader import MAX_TOKEN_LENGTH, PARAMS_FILE
+from compilation import COMPILE_MODES, CompiledModel
+from normalization import Denormalizer, organism2id
+from embedding_cache import EmbeddingCache
+
+PREDICTION_TASKS = ["amp_classification", "mic_regression", "half_life_regression", "hemolysis_regression"]
+# output columns of the tasks; mic_regression has one column per organism (see mic_column)
+TASK_COLUMNS = {"amp_classification": "amp_probability", "half_life_regression": "half_life",
+                "hemolysis_regression": "hemolysis"}
+DEFAULT_ORGANISMS = ['Escherichia coli']
+ALL_ORGANISMS = list(organism2id)
+
+def read_fasta(path):
+    """stream (record id, sequence) pairs from a FASTA file; sequences may span several lines"""
+    with open(path, 'r', encoding='utf-8') as f:
+        record_id, parts = None, []
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                if record_id is not None:
+                    yield record_id, "".join(parts)
+                record_id, parts = line[1:].strip(), []
+            elif line:
+                parts.append(line)
+        if record_id is not None:
+            yield record_id, "".join(parts)
+
+def load_model(model_path="amp4multitask", checkpoint=None, quantized=None):
+    """
+    the model with its remote code from model_path; checkpoint optionally points to a state dict written by
+    the trainer (e.g. training_outputs/best_mic_regression_model.pth), quantized to an int8 artifact of
+    quantize.py that replaces the weights
+    """
+    model = AutoModel.from_pretrained(model_path, trust_remote_code=True)
+    if checkpoint is not None:
+        model.load_state_dict(torch.load(checkpoint, map_location="cpu", weights_only=True))
+        print(f"[Info] Loaded model weights from {checkpoint}")
+    if quantized is not None:
+        from quantize import load_quantized     # quantize.py imports this module
+        model = load_quantized(quantized, model)
+    return model
+
+def mic_column(organism):
+    return "mic_" + organism.replace(" ", "_")
+
+class AMPPredictor:
+    """
+    Predict several tasks for an iterable of sequences.
+
+    Sequences are read in chunks of batch_size * chunk_batches, sorted by length inside a chunk and padded
+    per batch to their longest member, and every task runs under torch.inference_mode on the same batches.
+    Predictions come back in input order, denormalized: the AMP probability, MIC (μg/ml) for each of the
+    chosen organisms, half life (min) and hemolysis score.
+
+    With more than one organism, MIC runs as a panel (see predict_mic_panel): the encoder runs once per
+    batch and the organism-conditioned head runs on panel_rows (sequence, organism) pairs at a time.
+
+    With embedding_cache (a directory), encoder outputs are read from and added to a persistent
+    EmbeddingCache of the model's encoder weights; for cached sequences only the task heads run.
+    """
+    def __init__(self, model, tokenizer, norm_params_path=PARAMS_FILE, device=None, batch_size=64,
+                 chunk_batches=50, precision="fp32", compile_mode="none", panel_rows=256, embedding_cache=None,
+                 cache_memory_entries=4096):
+        self.device = torch.device(device) if device is not None else \
+            torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = model.to(self.device).eval()
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.chunk_size = batch_size * chunk_batches
+        self.panel_rows = panel_rows
+        assert precision in PRECISIONS, f"Invalid precision {precision}, choose from {list(PRECISIONS)}"
+        self.precision = precision
+        assert compile_mode in COMPILE_MODES, f"Invalid compile mode {compile_mode}, choose from {COMPILE_MODES}"
+        self.forward_model = self.model if compile_mode == "none" else CompiledModel(
+            self.model, tokenizer.pad_token_id, tokenizer.padding_side, mode=compile_mode
+        ).eval()
+        self.denormalize = Denormalizer(norm_params_path)
+        self.embedding_cache = None if embedding_cache is None else EmbeddingCache.open(
+            self.model, tokenizer, embedding_cache, memory_entries=cache_memory_entries
+        )
+
+    @classmethod
+    def from_pretrained(cls, model_path="amp4multitask", tokenizer_path=None, checkpoint=None, quantized=None,
+                        **kwargs):
+        """predictor of load_model(model_path, checkpoint, quantized); int8 models run on the CPU only"""
+        model = load_model(model_path, checkpoint, quantized)
+        if quantized is not None:
+            kwargs["device"] = "cpu"
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_path or model_path)
+        return cls(model, tokenizer, **kwargs)
+
+    def autocast(self):
+        dtype = PRECISIONS[self.precision]
+        return torch.autocast(device_type=self.device.type, dtype=dtype, enabled=dtype is not None)
+
+    def _batches(self, sequences):
+        """(positions in sequences, input_ids, attention_mask) of length-sorted, dynamically padded batches"""
+        order = np.argsort([len(sequence) for sequence in sequences], kind='stable')
+        for start in range(0, len(order), self.batch_size):
+            positions = order[start:start + self.batch_size]
+            encoding = self.tokenizer(
+                [sequences[i] for i in positions],
+                padding='longest',
+                max_length=MAX_TOKEN_LENGTH,
+                truncation=True,
+                return_tensors='pt'
+            )
+            yield (torch.from_numpy(positions),
+                   encoding['input_ids'].to(self.device, non_blocking=True),
+                   encoding['attention_mask'].to(self.device, non_blocking=True))
+
+    def _encode(self, sequences, input_ids, attention_mask):
+        """encoder outputs of a batch through the embedding cache; the encoder only runs on the misses"""
+        entries = self.embedding_cache.lookup(sequences)
+        missing = [row for row, entry in enumerate(entries) if entry is None]
+        if missing:
+            rows = torch.tensor(missing, device=self.device)
+            with self.autocast():
+                encoder_outputs = self.model.amp(input_ids=input_ids[rows], attention_mask=attention_mask[rows])
+            stored = self.embedding_cache.store([sequences[row] for row in missing], encoder_outputs, attention_mask[rows])
+            for row, entry in zip(missing, stored):
+                entries[row] = entry
+        return EmbeddingCache.collate(entries, attention_mask)
+
+    def _logits(self, task_name, input_ids, attention_mask, organism_ids=None, encoder_outputs=None):
+        if encoder_outputs is not None:
+            with reuse_encoder_outputs(self.model, encoder_outputs), self.autocast():
+                outputs = self.model(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    task_name=task_name,
+                    organism_ids=organism_ids,
+                    return_dict=True
+                    )
+            return outputs.logits.float()
+        with self.autocast():
+            outputs = self.forward_model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                task_name=task_name,
+                organism_ids=organism_ids,
+                return_dict=True
+                )
+        return outputs.logits.float()
+
+    def _mic_panel(self, input_ids, attention_mask, organism_ids, encoder_outputs=None):
+        """
+        normalized MIC of every sequence of the batch for every organism in organism_ids, [batch, organisms];
+        one encoder pass (unless encoder_outputs are given), then the mic_regression head on the
+        (sequence, organism) pairs
+        """
+        batch_size, num_organisms = len(input_ids), len(organism_ids)
+        if encoder_outputs is None:
+            with self.autocast():
+                encoder_outputs = self.model.amp(input_ids=input_ids, attention_mask=attention_mask)
+        # pairs are ordered sequence-major: row i * num_organisms + j is sequence i with organism j
+        rows = torch.arange(batch_size, device=self.device).repeat_interleave(num_organisms)
+        pair_organisms = organism_ids.repeat(batch_size)
+        logits = []
+        # the head sees the encoder outputs of every pair, so the pairs go in slices of panel_rows
+        step = max(self.panel_rows // num_organisms, 1) * num_organisms
+        for start in range(0, len(rows), step):
+            pairs = rows[start:start + step]
+            with reuse_encoder_outputs(self.model, select_rows(encoder_outputs, pairs)), self.autocast():
+                logits.append(self.model(
+                    input_ids=input_ids[pairs],
+                    attention_mask=attention_mask[pairs],
+                    task_name="mic_regression",
+                    organism_ids=pair_organisms[start:start + step],
+                    return_dict=True
+                    ).logits.float())
+        return torch.cat(logits).reshape(batch_size, num_organisms)
+
+    def _predict_batch(self, sequences, input_ids, attention_mask, tasks, organism_ids):
+        """normalized outputs of one batch: task -> [batch] tensor, [batch, organisms] for mic_regression"""
+        encoder_outputs = None
+        if self.embedding_cache is not None:
+            encoder_outputs = self._encode(sequences, input_ids, attention_mask)
+        outputs = {}
+        if "amp_classification" in tasks:
+            logits = self._logits("amp_classification", input_ids, attention_mask, encoder_outputs=encoder_outputs)
+            outputs["amp_classification"] = torch.softmax(logits, dim=-1)[:, 1]     # the positive class
+        if "mic_regression" in tasks and len(organism_ids) == 1:
+            outputs["mic_regression"] = self._logits("mic_regression", input_ids, attention_mask,
+                                                     organism_ids.expand(len(input_ids)), encoder_outputs).reshape(-1, 1)
+        elif "mic_regression" in tasks:
+            outputs["mic_regression"] = self._mic_panel(input_ids, attention_mask, organism_ids, encoder_outputs)
+        for task_name in ["half_life_regression", "hemolysis_regression"]:
+            if task_name in tasks:
+                outputs[task_name] = self._logits(task_name, input_ids, attention_mask,
+                                                  encoder_outputs=encoder_outputs).reshape(-1)
+        return outputs
+
+    def predict_arrays(self, sequences, tasks=None, organisms=None):
+        """predictions of a list of sequences as a dict of column name -> numpy array, in input order"""
+        tasks = tasks or PREDICTION_TASKS
+        assert set(tasks) <= set(PREDICTION_TASKS), f"Invalid tasks {tasks}, choose from {PREDICTION_TASKS}"
+        organisms = organisms or DEFAULT_ORGANISMS
+        organism_ids = self.denormalize.organism_ids(organisms)
+        sequences = [sequence.strip().upper() for sequence in sequences]
+
+        outputs = {}
+        with torch.inference_mode():
+            device_organism_ids = torch.from_numpy(organism_ids).to(self.device)
+            for positions, input_ids, attention_mask in self._batches(sequences):
+                batch_sequences = [sequences[i] for i in positions.tolist()]
+                batch_outputs = self._predict_batch(batch_sequences, input_ids, attention_mask, tasks, device_organism_ids)
+                for task_name, values in batch_outputs.items():
+                    if task_name not in outputs:
+                        outputs[task_name] = torch.empty((len(sequences),) + values.shape[1:])
+                    outputs[task_name][positions] = values.cpu()
+
+        columns = {}
+        for task_name, values in outputs.items():
+            values = self.denormalize(task_name, values.numpy(), organism_ids)
+            if task_name == "mic_regression":
+                columns.update({mic_column(organism): values[:, j] for j, organism in enumerate(organisms)})
+            else:
+                columns[TASK_COLUMNS[task_name]] = values
+        return columns
+
+    def predict_mic_panel(self, sequences, organisms=None):
+        """MIC (μg/ml) of a list of sequences against organisms (default: all), a [sequences, organisms] array"""
+        organisms = organisms or ALL_ORGANISMS
+        predictions = self.predict_arrays(sequences, ["mic_regression"], organisms)
+        return np.stack([predictions[mic_column(organism)] for organism in organisms], axis=1)
+
+    def iter_predictions(self, sequences, tasks=None, organisms=None, ids=None):
+        """stream DataFrames of predictions, one per chunk of the (possibly unbounded) iterable of sequences"""
+        sequences = iter(sequences)
+        ids = iter(ids) if ids is not None else itertools.count()
+        while chunk := list(itertools.islice(sequences, self.chunk_size)):
+            chunk_ids = list(itertools.islice(ids, len(chunk)))
+            predictions = self.predict_arrays(chunk, tasks, organisms)
+            yield pd.DataFrame({"id": chunk_ids, "sequence": chunk} | predictions)
+
+    def predict(self, sequences, tasks=None, organisms=None, ids=None):
+        """predictions of all sequences in one DataFrame with an id, the sequence and one column per output"""
+        return pd.concat(list(self.iter_predictions(sequences, tasks, organisms, ids)), ignore_index=True)
+
+def write_predictions(chunks, output_path):
+    """append prediction DataFrames to a .csv or .jsonl file as they arrive"""
+    jsonl = output_path.endswith((".jsonl", ".json"))
+    rows = 0
+    with open(output_path, 'w', encoding='utf-8', newline='') as f:
+        for i, chunk in enumerate(chunks):
+            if jsonl:
+                f.write(chunk.to_json(orient="records", lines=True, force_ascii=False))
+            else:
+                chunk.to_csv(f, header=i == 0, index=False)
+            rows += len(chunk)
+            print(f"[Info] {rows} sequences predicted")
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Predict AMP properties for the sequences of a FASTA file")
+    parser.add_argument("input", help="FASTA file")
+    parser.add_argument("output", help="output file, .csv or .jsonl")
+    parser.add_argument("--tasks", type=lambda text: text.split(","), default=PREDICTION_TASKS,
+                        help="comma-separated tasks")
+    parser.add_argument("--organisms", type=lambda text: ALL_ORGANISMS if text == "all" else text.split(","),
+                        default=DEFAULT_ORGANISMS, help="comma-separated organisms for mic_regression, or all")
+    parser.add_argument("--model-path", default="amp4multitask")
+    parser.add_argument("--tokenizer-path", default=None, help="defaults to --model-path")
+    parser.add_argument("--checkpoint", default=None, help="state dict written by the trainer")
+    parser.add_argument("--quantized", default=None, help="int8 model written by quantize.py")
+    parser.add_argument("--norm-params", default=PARAMS_FILE)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--precision", choices=list(PRECISIONS), default="fp32")
+    parser.add_argument("--compile", choices=COMPILE_MODES, default="none")
+    parser.add_argument("--embedding-cache", default=None,
+                        help="directory of a persistent embedding cache; cached sequences only run the task heads")
+    parser.add_argument("--cache-memory-entries", type=int, default=4096, help="embedding cache entries kept in memory")
+    args = parser.parse_args()
+
+    predictor = AMPPredictor.from_pretrained(
+        args.model_path, tokenizer_path=args.tokenizer_path, checkpoint=args.checkpoint, quantized=args.quantized,
+        norm_params_path=args.norm_params, device=args.device, batch_size=args.batch_size,
+        precision=args.precision, compile_mode=args.compile, embedding_cache=args.embedding_cache,
+        cache_memory_entries=args.cache_memory_entries
+    )
+    records = read_fasta(args.input)
+    ids, sequences = itertools.tee(records)
+    write_predictions(
+        predictor.iter_predictions((sequence for _, sequence in sequences), args.tasks, args.organisms,
+                                   ids=(record_id for record_id, _ in ids)),
+        args.output
+    )
+    if predictor.embedding_cache is not None:
+        metrics = predictor.embedding_cache.export_metrics()
+        print(f"[Info] Embedding cache: hit rate {metrics['hit_rate']:.1%}, {metrics['entries']} entries, "
+              f"{metrics['storage_bytes'] / 2**20:.1f} MB")
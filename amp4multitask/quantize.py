@@ -0,0 +1,237 @@
+"""
+Int8 dynamic quantization of amp4multitask for CPU inference.
+
+    python quantize.py --checkpoint training_outputs/best_mic_regression_model.pth --output amp4multitask_int8.pt
+    python quantize.py --checkpoint training_outputs/best_mic_regression_model.pth --output amp4multitask_int8.pt --calibrate
+
+The weights of the nn.Linear layers are stored as int8 and their activations are quantized on the fly per
+batch. With --calibrate, every encoder layer and task head is first quantized on its own. Each one is
+checked on a sample of the training split of merged_data.json, and those whose outputs drift more than
+--max-drift stay fp32. The artifact is written to --output. A report (<output>.report.json) holds the
+int8-vs-fp32 metrics of every task on the test split, and the CPU throughput and latency. Load the
+artifact with AMPPredictor.from_pretrained(quantized=...) or predictor.py --quantized.
+"""
+import io
+import re
+import json
+import copy
+import time
+import argparse
+import itertools
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+from transformers import AutoTokenizer
+
+from merged_dataloader import TASK_NAMES, PARAMS_FILE, build_dataloader, load_preprocessed
+from predictor import AMPPredictor, load_model
+
+QUANTIZED_DTYPE = torch.qint8
+
+def quantizable_linears(model):
+    """names of the nn.Linear modules dynamic quantization replaces"""
+    return [name for name, module in model.named_modules() if type(module) is nn.Linear]
+
+def _module_group(name):
+    """calibration unit of a linear layer: its encoder layer, or the module itself for the task heads"""
+    match = re.match(r"(.*\.layers\.\d+)\.", name)
+    return match.group(1) if match else name
+
+def quantize(model, modules=None):
+    """int8 dynamic-quantized copy of model (CPU); modules limits quantization to these nn.Linear names"""
+    modules = quantizable_linears(model) if modules is None else modules
+    return quantize_dynamic(copy.deepcopy(model).cpu().eval(), set(modules), dtype=QUANTIZED_DTYPE)
+
+def _task_inputs(batch, task_name):
+    organism_ids = batch['organism'] if task_name == "mic_regression" else None
+    return batch['input_ids'], batch['attention_mask'], organism_ids
+
+def _outputs(model, task_name, batch):
+    """task outputs of a batch: probabilities for the classification tasks, normalized values otherwise"""
+    input_ids, attention_mask, organism_ids = _task_inputs(batch, task_name)
+    logits = model(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        task_name=task_name,
+        organism_ids=organism_ids,
+        return_dict=True
+        ).logits.float()
+    if task_name == "amp_classification":
+        return torch.softmax(logits, dim=-1)
+    if task_name == "bioactivity_classification":
+        return torch.sigmoid(logits)
+    return logits.reshape(-1)
+
+@torch.inference_mode()
+def calibrate(model, task_batches, max_drift=0.02):
+    """
+    Quantize one calibration unit (an encoder layer with all its linear layers, or a task head) at a time and
+    measure the relative drift ||int8 - fp32|| / ||fp32|| of every task output on task_batches. Returns the
+    linear layers of the units whose mean drift stays within max_drift, and the drift of every unit.
+    """
+    model = model.cpu().eval()
+    reference = {task_name: [_outputs(model, task_name, batch) for batch in batches]
+                 for task_name, batches in task_batches.items()}
+    groups = {}
+    for name in quantizable_linears(model):
+        groups.setdefault(_module_group(name), []).append(name)
+
+    drifts = {}
+    for group, modules in groups.items():
+        quantized = quantize(model, modules)
+        task_drifts = []
+        for task_name, batches in task_batches.items():
+            errors = [(_outputs(quantized, task_name, batch) - expected).norm() / expected.norm().clamp(min=1e-8)
+                      for batch, expected in zip(batches, reference[task_name])]
+            task_drifts.append(torch.stack(errors).mean().item())
+        drifts[group] = float(np.mean(task_drifts))
+        print(f"[Info] {group}: drift {drifts[group]:.4f}")
+    kept = [group for group, drift in drifts.items() if drift > max_drift]
+    if kept:
+        print(f"[Info] Keeping {len(kept)} of {len(groups)} units in fp32: {kept}")
+    modules = [name for group, names in groups.items() if drifts[group] <= max_drift for name in names]
+    return modules, drifts
+
+def save_quantized(quantized_model, modules, path, metadata=None):
+    """
+    Save a quantized model. The remote-code class cannot be pickled, so the artifact holds the state dict
+    and the quantized module names. load_quantized replays the quantization on a freshly loaded model.
+    """
+    torch.save({
+        'state_dict': quantized_model.state_dict(),
+        'modules': list(modules),
+        'dtype': str(QUANTIZED_DTYPE),
+        'metadata': metadata or {},
+    }, path)
+    print(f"[Info] Saved int8 model to {path}")
+
+def load_quantized(path, model):
+    """
+    the int8 model of a save_quantized artifact; model is the (fp32) model of the same architecture and is
+    left unchanged, so it can still serve as the fp32 reference
+    """
+    artifact = torch.load(path, map_location="cpu", weights_only=False)     # holds packed int8 weights
+    assert artifact['dtype'] == str(QUANTIZED_DTYPE), f"Unsupported quantized dtype {artifact['dtype']}"
+    quantized = quantize(model, artifact['modules'])
+    quantized.load_state_dict(artifact['state_dict'])
+    print(f"[Info] Loaded int8 model from {path} ({len(artifact['modules'])} quantized linear layers)")
+    return quantized
+
+def _state_dict_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+@torch.inference_mode()
+def accuracy_report(fp32_model, int8_model, task_batches):
+    """
+    int8 vs fp32 on every task: accuracy (label-wise for bioactivity) or the MAE of the normalized
+    regression targets, and the mean absolute difference of the two models' outputs
+    """
+    report = {}
+    for task_name, batches in task_batches.items():
+        scores = {"fp32": [], "int8": []}
+        differences = []
+        for batch in batches:
+            labels = batch['label']
+            outputs = {"fp32": _outputs(fp32_model, task_name, batch), "int8": _outputs(int8_model, task_name, batch)}
+            for name, output in outputs.items():
+                if task_name == "amp_classification":
+                    scores[name].append((output.argmax(dim=-1) == labels).float())
+                elif task_name == "bioactivity_classification":
+                    scores[name].append(((output > 0.5) == labels.bool()).float().reshape(-1))
+                else:
+                    scores[name].append((output - labels.float()).abs())
+            differences.append((outputs["int8"] - outputs["fp32"]).abs().reshape(-1))
+        fp32_score, int8_score = (torch.cat(scores[name]).mean().item() for name in ["fp32", "int8"])
+        report[task_name] = {
+            'metric': "accuracy" if task_name.endswith("classification") else "mae",
+            'fp32': fp32_score,
+            'int8': int8_score,
+            'delta': int8_score - fp32_score,
+            'output_mae': torch.cat(differences).mean().item(),
+            'samples': sum(len(batch['label']) for batch in batches),
+        }
+    return report
+
+def speed_report(models, tokenizer, sequences, batch_size=64, latency_samples=50):
+    """CPU throughput of batched prediction (all tasks) and the median latency of single sequences"""
+    report = {}
+    for name, model in models.items():
+        predictor = AMPPredictor(model, tokenizer, norm_params_path=PARAMS_FILE, device="cpu", batch_size=batch_size)
+        predictor.predict_arrays(sequences[:batch_size])     # warm-up
+        start = time.perf_counter()
+        predictor.predict_arrays(sequences)
+        elapsed = time.perf_counter() - start
+        latencies = []
+        for sequence in sequences[:latency_samples]:
+            start = time.perf_counter()
+            predictor.predict_arrays([sequence])
+            latencies.append(time.perf_counter() - start)
+        report[name] = {
+            'sequences_per_second': len(sequences) / elapsed,
+            'latency_ms': float(np.median(latencies)) * 1000,
+            'size_mb': _state_dict_mb(model),
+        }
+    return report
+
+def print_report(report):
+    print(f"\n{'task':<30}{'metric':>10}{'fp32':>10}{'int8':>10}{'delta':>10}{'output mae':>12}")
+    for task_name, r in report['accuracy'].items():
+        print(f"{task_name:<30}{r['metric']:>10}{r['fp32']:>10.4f}{r['int8']:>10.4f}{r['delta']:>+10.4f}"
+              f"{r['output_mae']:>12.5f}")
+    speed = report['speed']
+    print(f"\n{'model':<10}{'seqs/s':>10}{'latency ms':>12}{'size MB':>10}{'speedup':>10}")
+    for name, r in speed.items():
+        print(f"{name:<10}{r['sequences_per_second']:>10.1f}{r['latency_ms']:>12.2f}{r['size_mb']:>10.1f}"
+              f"{r['sequences_per_second'] / speed['fp32']['sequences_per_second']:>9.2f}x")
+
+def build_report(fp32_model, int8_model, tokenizer, data_file, batch_size=64, max_batches=20):
+    """accuracy on the test split (max_batches per task) and speed on the same sequences"""
+    task_batches = {}
+    for task_name in TASK_NAMES:
+        _, _, test_loader = build_dataloader(data_file, task_name, batch_size, tokenizer, bucket_by_length=True)
+        task_batches[task_name] = list(itertools.islice(test_loader, max_batches))
+    sequences = [sequence.decode() for sequence in load_preprocessed(data_file)['sequences'][:batch_size * max_batches]]
+    return {
+        'accuracy': accuracy_report(fp32_model, int8_model, task_batches),
+        'speed': speed_report({"fp32": fp32_model, "int8": int8_model}, tokenizer, sequences, batch_size),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Int8 dynamic quantization of amp4multitask for CPU inference")
+    parser.add_argument("--model-path", default="amp4multitask")
+    parser.add_argument("--checkpoint", default=None, help="state dict written by the trainer")
+    parser.add_argument("--data-file", default="merged_data.json")
+    parser.add_argument("--output", default="amp4multitask_int8.pt")
+    parser.add_argument("--calibrate", action="store_true",
+                        help="keep the encoder layers / heads whose outputs drift more than --max-drift in fp32")
+    parser.add_argument("--calibration-batches", type=int, default=4, help="training batches per task for calibration")
+    parser.add_argument("--max-drift", type=float, default=0.02, help="relative output drift allowed per unit")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--max-batches", type=int, default=20, help="test batches per task for the report")
+    args = parser.parse_args()
+
+    model = load_model(args.model_path, args.checkpoint).cpu().eval()
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, padding_side="left")
+    modules = quantizable_linears(model)
+    drifts = None
+    if args.calibrate:
+        calibration_batches = {}
+        for task_name in TASK_NAMES:
+            train_loader, _, _ = build_dataloader(args.data_file, task_name, args.batch_size, tokenizer,
+                                                  bucket_by_length=True)
+            calibration_batches[task_name] = list(itertools.islice(train_loader, args.calibration_batches))
+        modules, drifts = calibrate(model, calibration_batches, args.max_drift)
+
+    int8_model = quantize(model, modules)
+    save_quantized(int8_model, modules, args.output,
+                   metadata={'model_path': args.model_path, 'checkpoint': args.checkpoint, 'drifts': drifts})
+    report = build_report(model, int8_model, tokenizer, args.data_file, args.batch_size, args.max_batches)
+    report['quantized_modules'] = len(modules)
+    report['linear_modules'] = len(quantizable_linears(model))
+    print_report(report)
+    with open(args.output + ".report.json", 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
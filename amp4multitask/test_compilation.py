@@ -0,0 +1,54 @@
+import pytest
+import torch
+import torch.nn as nn
+from transformers.modeling_outputs import SequenceClassifierOutput
+
+from compilation import CompiledModel, compile_available
+
+PAD_TOKEN_ID = 1
+
+class TinyMultiTaskModel(nn.Module):
+    """stand-in for AMPForMultiTask with the same call signature and dropout in the forward"""
+    def __init__(self, vocab_size=32, hidden_size=16):
+        super().__init__()
+        self.embeddings = nn.Embedding(vocab_size, hidden_size)
+        self.dropout = nn.Dropout(0.5)
+        self.heads = nn.ModuleDict({"amp_classification": nn.Linear(hidden_size, 2)})
+
+    def forward(self, input_ids=None, attention_mask=None, task_name=None, organism_ids=None, return_dict=True):
+        hidden = self.dropout(self.embeddings(input_ids))
+        mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1)
+        return SequenceClassifierOutput(logits=self.heads[task_name](pooled))
+
+def _batch(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(2, 32, (4, 16), generator=generator)
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[:, 12:] = 0
+    input_ids[attention_mask == 0] = PAD_TOKEN_ID
+    return input_ids, attention_mask
+
+MODES = ["torchscript"] + (["compile"] if compile_available() else [])
+
+@pytest.mark.parametrize("mode", MODES)
+def test_eval_outputs_are_deterministic_after_train_step(mode):
+    torch.manual_seed(0)
+    model = TinyMultiTaskModel()
+    compiled = CompiledModel(model, PAD_TOKEN_ID, padding_side="right", mode=mode)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    input_ids, attention_mask = _batch()
+
+    # the trainer switches the mode of the wrapped model, never of the wrapper
+    model.train()
+    logits = compiled(input_ids=input_ids, attention_mask=attention_mask, task_name="amp_classification").logits
+    logits.sum().backward()
+    optimizer.step()
+
+    model.eval()
+    with torch.no_grad():
+        first = compiled(input_ids=input_ids, attention_mask=attention_mask, task_name="amp_classification").logits
+        second = compiled(input_ids=input_ids, attention_mask=attention_mask, task_name="amp_classification").logits
+        eager = model(input_ids=input_ids, attention_mask=attention_mask, task_name="amp_classification").logits
+    assert torch.equal(first, second)
+    torch.testing.assert_close(first, eager)
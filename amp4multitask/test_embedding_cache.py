@@ -0,0 +1,61 @@
+import os
+
+import torch
+from transformers.modeling_outputs import BaseModelOutputWithPooling
+
+from embedding_cache import EmbeddingCache, INDEX_FILE
+
+HIDDEN_SIZE = 8
+
+def _outputs(sequences, seed=0):
+    """fake encoder outputs of a right-padded batch, one token per residue"""
+    generator = torch.Generator().manual_seed(seed)
+    max_length = max(len(sequence) for sequence in sequences)
+    attention_mask = torch.zeros(len(sequences), max_length, dtype=torch.long)
+    for row, sequence in enumerate(sequences):
+        attention_mask[row, :len(sequence)] = 1
+    outputs = BaseModelOutputWithPooling(
+        last_hidden_state=torch.randn(len(sequences), max_length, HIDDEN_SIZE, generator=generator),
+        pooler_output=torch.randn(len(sequences), HIDDEN_SIZE, generator=generator))
+    return outputs, attention_mask
+
+def _store(path, sequences, seed):
+    cache = EmbeddingCache(path)
+    entries = cache.store(sequences, *_outputs(sequences, seed))
+    return dict(zip(sequences, entries))
+
+def _assert_reads_back(path, expected):
+    cache = EmbeddingCache(path, memory_entries=0)
+    entries = cache.lookup(list(expected))
+    assert cache.counters['disk_hits'] == len(expected)
+    for (tokens, pooled), (expected_tokens, expected_pooled) in zip(entries, expected.values()):
+        assert torch.equal(tokens, expected_tokens)
+        assert torch.equal(pooled, expected_pooled)
+
+def test_append_after_torn_index_line(tmp_path):
+    expected = _store(tmp_path, ["GIGKFLHSAK", "KWKLFKKI"], seed=0)
+    # an interrupted write: the data of one more entry and half of its index line
+    index_path = os.path.join(tmp_path, INDEX_FILE)
+    with open(index_path, 'r', encoding='utf-8') as f:
+        line = f.readline()
+    _store(tmp_path, ["FLPIIAKLLSGLL"], seed=1)
+    with open(index_path, 'r+', encoding='utf-8') as f:
+        f.truncate(len(f.read()) - len(line) // 2)
+
+    expected |= _store(tmp_path, ["ILPWKWPWWPWRR", "RRWQWR"], seed=2)
+    _assert_reads_back(tmp_path, expected)
+
+def test_append_after_corrupt_middle_line(tmp_path):
+    expected = _store(tmp_path, ["GIGKFLHSAK"], seed=0)
+    lost = _store(tmp_path, ["FLPIIAKLLSGLL"], seed=1)
+    expected |= _store(tmp_path, ["KWKLFKKI"], seed=2)
+    index_path = os.path.join(tmp_path, INDEX_FILE)
+    with open(index_path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    lines[1] = lines[1][:len(lines[1]) // 2] + "\n"
+    with open(index_path, 'w', encoding='utf-8') as f:
+        f.writelines(lines)
+
+    expected |= _store(tmp_path, ["ILPWKWPWWPWRR", "RRWQWR"], seed=3)
+    _assert_reads_back(tmp_path, expected)
+    assert EmbeddingCache(tmp_path).lookup(list(lost)) == [None]